@@ -1,38 +1,175 @@
 import os
 import json
+import logging
+import functools
 import random
 import string
+import threading
 import requests
-import httplib2
-from flask import Flask, render_template, request, redirect, jsonify, \
-    url_for, flash, Markup, make_response, send_from_directory
-from sqlalchemy import create_engine, asc
-from sqlalchemy.orm import sessionmaker
-from database_setup import Base, Category, Product, ProductPhoto, User
+from flask import Flask, render_template, request, redirect, \
+    url_for, flash, Markup, make_response, send_from_directory, abort, \
+    Response, stream_with_context, current_app
+from sqlalchemy.orm import sessionmaker, scoped_session, selectinload
+from database import createEngine, databaseUrl
+from database_setup import Category, Product, ProductPhoto, User, \
+    SkuCounter, parsePrice
+from catalog_queries import latestProducts, allProducts, categoryProducts, \
+    countCategoryProducts, keysetPage, keysetQuery, installStatementBudgets, \
+    countStatements, productFilter, filterProducts, productOrder, \
+    LATEST_ORDER, CATEGORY_ORDER, PRICE_ORDER, CATEGORY_PRICE_ORDER, \
+    PRODUCT_FILTER_ARGS, NO_FILTER, PAGE_SIZE, MAX_PAGE_SIZE
+from catalog_cache import categoryList
+from catalog_version import catalogVersion, trackCatalogWrites
+from catalog_search import searchProducts
+from catalog_facets import productFacets, serializeFacets, priceBuckets
+from catalog_fragments import cachedFragment
+from catalog_snapshot import catalogDocument, packedCatalogDocument
+from catalog_skus import reserveSkus, claimSku
+from catalog_slugs import findCategory, findProduct, trackSlugs
+from catalog_export import catalogChunks, catalogLines, productsChunks, \
+    productLines, rowDict, CATEGORY_COLUMNS, PRODUCT_COLUMNS
+from catalog_batch import batchKeys, productBatchColumns, productBatchQuery, \
+    productBatch, categoryBatchQuery, categoryBatch, PRODUCT_KEYS, \
+    CATEGORY_KEYS
+from catalog_formats import encodeDocument, responseFormat, JSON, MSGPACK
+from catalog_metrics import installMetrics, instrumentEngine, timed
+from catalog_delete import purgeCategory, purgeProduct
+from login_providers import GoogleProvider, LoginFailed
+from photo_variants import queueVariants, deletePhotos, variantFor, \
+    DENSITIES
 from flask import session as login_session
-from flask_wtf.csrf import CSRFProtect
 from werkzeug.utils import secure_filename
-from oauth2client.client import flow_from_clientsecrets
-from oauth2client.client import FlowExchangeError
 
 
-app = Flask(__name__)
-
-# Google client secrets
-CLIENT_ID = json.loads(
-    open('client_secrets.json', 'r').read())['web']['client_id']
 APPLICATION_NAME = "Store Catalog Application"
 
-# Connect to Database and create database session
-engine = create_engine('postgresql+psycopg2:///mystore')
-Base.metadata.bind = engine
-
-DBSession = sessionmaker(bind=engine)
-session = DBSession()
+# Maximum number of SQL statements each listing route may issue. Checked on
+# every request when current_app.config['ASSERT_STATEMENT_BUDGETS'] is set.
+STATEMENT_BUDGETS = {
+    'showCatalog': 6,
+    'showCatalogAll': 6,
+    'showCategory': 9,
+    'catalogJSON': 3,
+    'productsBatchJSON': 2,
+    'categoriesBatchJSON': 2,
+}
 
 # Photo upload constants
 ALLOWED_EXTENSIONS = set(['png', 'jpg', 'jpeg', 'gif'])
-app.config['UPLOAD_FOLDER'] = './static/uploads'
+
+
+########################################
+# APPLICATION FACTORY
+########################################
+
+# Views collected by @route, added to every app createApp makes
+views = []
+
+
+def route(rule, **options):
+    '''Register the decorated view, like app.route, for every app'''
+    def decorator(view):
+        views.append((rule, view, options))
+        return view
+    return decorator
+
+
+def createApp(config=None):
+    '''Create the catalog app.
+
+    config overrides the defaults below, e.g. {'DATABASE_URL': 'sqlite://'}
+    in tests. Nothing is connected or read from disk here: the engine is
+    created by the first request that needs it and the Google client
+    secrets when someone signs in.
+    '''
+    app = Flask(__name__)
+    app.config.update(
+        DATABASE_URL=databaseUrl(),
+        CLIENT_SECRETS_FILE='client_secrets.json',
+        # Sign-in provider, see loginProvider
+        LOGIN_PROVIDER=None,
+        UPLOAD_FOLDER='./static/uploads',
+        # Resized copies made by the worker (photo_variants.py), named
+        # after their content
+        VARIANT_FOLDER='./static/uploads/variants',
+    )
+    if config:
+        app.config.update(config)
+    app.extensions['catalog'] = {'engine': None, 'login_provider': None,
+                                 'lock': threading.Lock()}
+
+    for rule, view, options in views:
+        app.add_url_rule(rule, view_func=view, **options)
+    app.add_template_global(photoUrl)
+    app.add_template_global(photoSrcset)
+    app.add_template_global(priceBuckets)
+    app.teardown_appcontext(removeSession)
+
+    installStatementBudgets(app, STATEMENT_BUDGETS)
+    # Request, SQL and rendering metrics served at /metrics. Statements
+    # slower than SLOW_QUERY_SECONDS (environment, default 0.5) are logged.
+    installMetrics(app)
+    return app
+
+
+def getEngine(app=None):
+    '''Engine for the DATABASE_URL of app (default: the current app).
+
+    It is created on first use, see database.py for the pool settings.
+    '''
+    if app is None:
+        app = current_app._get_current_object()
+    state = app.extensions['catalog']
+    if state['engine'] is None:
+        with state['lock']:
+            if state['engine'] is None:
+                engine = createEngine(app.config['DATABASE_URL'])
+                countStatements(engine)
+                instrumentEngine(app, engine)
+                state['engine'] = engine
+    return state['engine']
+
+
+def disposeEngine(app):
+    '''Close the pooled connections of app, if it has connected'''
+    engine = app.extensions['catalog']['engine']
+    if engine is not None:
+        engine.dispose()
+
+
+# Each thread gets its own session, bound to the engine of the app serving
+# the request. It is removed at the end of the request so no identity map
+# or open transaction outlives it.
+DBSession = sessionmaker()
+trackCatalogWrites(DBSession)
+trackSlugs(DBSession)
+
+
+def createSession():
+    return DBSession(bind=getEngine())
+
+
+session = scoped_session(createSession)
+
+
+def removeSession(exception=None):
+    session.remove()
+
+
+def loginProvider():
+    '''Sign-in provider of the current app, see login_providers.py.
+
+    LOGIN_PROVIDER may be set to a provider (e.g. a LocalProvider in
+    tests); otherwise Google is used with CLIENT_SECRETS_FILE.
+    '''
+    state = current_app.extensions['catalog']
+    if state['login_provider'] is None:
+        with state['lock']:
+            if state['login_provider'] is None:
+                state['login_provider'] = \
+                    current_app.config.get('LOGIN_PROVIDER') or \
+                    GoogleProvider(current_app.config['CLIENT_SECRETS_FILE'])
+    return state['login_provider']
 
 
 ########################################
@@ -45,18 +182,125 @@ def allowed_file(filename):
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
-@app.route('/uploads/<filename>')
+@route('/uploads/<filename>')
 def viewUploadFile(filename):
     '''View images'''
-    print(app.config['UPLOAD_FOLDER'])
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    return send_from_directory(current_app.config['UPLOAD_FOLDER'], filename)
+
+
+@route('/media/<filename>')
+def viewVariantFile(filename):
+    '''View resized photos. The content never changes for a given name.'''
+    response = send_from_directory(current_app.config['VARIANT_FOLDER'],
+                                   filename)
+    response.cache_control.public = True
+    response.cache_control.max_age = 31536000
+    response.headers['Cache-Control'] += ', immutable'
+    return response
+
+
+def photoUrl(photo, size):
+    '''URL of the 1x variant of photo, or of the upload if there is none'''
+    variant = variantFor(photo, size)
+    if variant is None:
+        return url_for('viewUploadFile', filename=photo.filename)
+    return url_for('viewVariantFile', filename=variant.filename)
+
+
+def photoSrcset(photo, size, format=None):
+    '''srcset listing each density of a variant, or None without variants'''
+    candidates = []
+    for density in DENSITIES:
+        variant = variantFor(photo, size, format, density)
+        if variant is not None:
+            candidates.append('{0} {1}x'.format(
+                url_for('viewVariantFile', filename=variant.filename),
+                density))
+    return ', '.join(candidates) or None
+
+
+########################################
+# PAGINATION
+########################################
+
+def pageArgs(cursor_arg='cursor'):
+    '''Read the cursor and limit query arguments, aborting on bad input'''
+    try:
+        limit = int(request.args.get('limit', PAGE_SIZE))
+    except ValueError:
+        abort(400)
+    if limit < 1 or limit > MAX_PAGE_SIZE:
+        abort(400)
+    return request.args.get(cursor_arg), limit
+
+
+def isPaged():
+    '''Determine if a JSON request asked for a single page of results'''
+    return 'cursor' in request.args or 'limit' in request.args
+
+
+def linkArgs(*names):
+    '''Arguments for links to other pages of the current view: its view
+    arguments, limit and whichever of the query arguments names it got'''
+    args = dict(request.view_args or {})
+    args.update((arg, request.args[arg]) for arg in ('limit',) + names
+                if request.args.get(arg))
+    return args
+
+
+def getPage(query_function, *args, **kwargs):
+    '''Run a paged query, answering 400 if the cursor is malformed'''
+    try:
+        return query_function(*args, **kwargs)
+    except ValueError:
+        abort(400)
+
+
+def productFilterArgs():
+    '''Read the price filter and sort arguments, aborting on bad input'''
+    try:
+        return productFilter(request.args)
+    except ValueError:
+        abort(400)
+
+
+def batchArgs(keys):
+    '''Read the keys of a batch request, aborting on bad input'''
+    try:
+        return batchKeys(request.args, keys)
+    except ValueError:
+        abort(400)
+
+
+def categoryBySlug(slug):
+    '''Category with slug from the URL, aborting with 404 if there is none'''
+    category = findCategory(session, slug)
+    if category is None:
+        abort(404)
+    return category
+
+
+def productBySlug(slug):
+    '''Product with slug from the URL, aborting with 404 if there is none'''
+    product = findProduct(session, slug)
+    if product is None:
+        abort(404)
+    return product
+
+
+def listProducts(query, product_filter, default_order, price_order):
+    '''All products of query, filtered and sorted as product_filter asks'''
+    columns, descending = productOrder(product_filter, default_order,
+                                       price_order)
+    return keysetQuery(filterProducts(query, product_filter), columns,
+                       descending=descending).all()
 
 
 ########################################
 # LOGIN / LOGOUT
 ########################################
 
-@app.route('/login')
+@route('/login')
 def showLogin():
     '''Create anti-forgery state token'''
     state = ''.join(random.choice(string.ascii_uppercase + string.digits)
@@ -67,7 +311,7 @@ def showLogin():
 
 
 # Google connect
-@app.route('/gconnect', methods=['POST'])
+@route('/gconnect', methods=['POST'])
 def gconnect():
     # Validate state token
     if request.args.get('state') != login_session['state']:
@@ -78,71 +322,40 @@ def gconnect():
     code = request.data
 
     try:
-        # Upgrade the authorization code into a credentials object
-        oauth_flow = flow_from_clientsecrets('client_secrets.json', scope='')
-        oauth_flow.redirect_uri = 'postmessage'
-        credentials = oauth_flow.step2_exchange(code)
-    except FlowExchangeError:
-        response = make_response(
-            json.dumps('Failed to upgrade the authorization code.'), 401)
-        response.headers['Content-Type'] = 'application/json'
-        return response
-
-    # Check that the access token is valid.
-    access_token = credentials.access_token
-    url = ('https://www.googleapis.com/oauth2/v1/tokeninfo?access_token=%s'
-           % access_token)
-    h = httplib2.Http()
-    result = json.loads(h.request(url, 'GET')[1])
-    # If there was an error in the access token info, abort.
-    if result.get('error') is not None:
-        response = make_response(json.dumps(result.get('error')), 500)
+        identity = loginProvider().login(code)
+    except LoginFailed as e:
+        response = make_response(json.dumps(str(e)), 401)
+        current_app.logger.warning('Login failed: %s', e)
         response.headers['Content-Type'] = 'application/json'
         return response
-
-    # Verify that the access token is used for the intended user.
-    gplus_id = credentials.id_token['sub']
-    if result['user_id'] != gplus_id:
-        response = make_response(
-            json.dumps("Token's user ID doesn't match given user ID."), 401)
-        response.headers['Content-Type'] = 'application/json'
-        return response
-
-    # Verify that the access token is valid for this app.
-    if result['issued_to'] != CLIENT_ID:
+    except requests.RequestException:
+        current_app.logger.exception('Sign-in provider unavailable')
         response = make_response(
-            json.dumps("Token's client ID does not match app's."), 401)
-        print "Token's client ID does not match app's."
+            json.dumps('Sign-in is unavailable, please try again.'), 503)
         response.headers['Content-Type'] = 'application/json'
         return response
+    gplus_id = identity['id']
 
-    stored_credentials = login_session.get('credentials')
+    stored_access_token = login_session.get('access_token')
     stored_gplus_id = login_session.get('gplus_id')
-    if stored_credentials is not None and gplus_id == stored_gplus_id:
+    if stored_access_token is not None and gplus_id == stored_gplus_id:
         response = make_response(json.dumps('Current user is already '
                                             'connected.'), 200)
         response.headers['Content-Type'] = 'application/json'
         return response
 
     # Store the access token in the session for later use.
-    login_session['access_token'] = credentials.access_token
+    login_session['access_token'] = identity['access_token']
     login_session['gplus_id'] = gplus_id
 
-    # Get user info
-    userinfo_url = "https://www.googleapis.com/oauth2/v1/userinfo"
-    params = {'access_token': credentials.access_token, 'alt': 'json'}
-    answer = requests.get(userinfo_url, params=params)
-
-    data = answer.json()
-    print(data)
-    login_session['username'] = data['name']
-    login_session['picture'] = data['picture']
-    login_session['email'] = data['email']
+    login_session['username'] = identity['name']
+    login_session['picture'] = identity['picture']
+    login_session['email'] = identity['email']
     # ADD PROVIDER TO LOGIN SESSION
-    login_session['provider'] = 'google'
+    login_session['provider'] = loginProvider().name
 
     # see if user exists, if it doesn't make a new one
-    user_id = getUserID(data["email"])
+    user_id = getUserID(identity['email'])
     if not user_id:
         user_id = createUser(login_session)
     login_session['user_id'] = user_id
@@ -157,7 +370,7 @@ def gconnect():
         'height: 150px;border-radius: 150px; ' \
         '-webkit-border-radius: 150px;-moz-border-radius: 150px;"> '
     flash("You are now logged in as %s" % login_session['email'])
-    print "done!"
+    current_app.logger.info('User %s logged in', login_session['user_id'])
     return output
 
 
@@ -187,36 +400,40 @@ def getUserID(email):
         return None
 
 
-@app.route('/gdisconnect')
+@route('/gdisconnect')
 def gdisconnect():
     ''' Revoke a current user's token and reset their login_session'''
     # Only disconnect a connected user.
-    credentials = login_session.get('credentials')
-    if credentials is None:
+    access_token = login_session.get('access_token')
+    if access_token is None:
         response = make_response(
             json.dumps('Current user not connected.'), 401)
         response.headers['Content-Type'] = 'application/json'
         return response
-    access_token = credentials.access_token
-    url = 'https://accounts.google.com/o/oauth2/revoke?token=%s' % access_token
-    h = httplib2.Http()
-    result = h.request(url, 'GET')[0]
-    if result['status'] != '200':
+    try:
+        revoked = loginProvider().revoke(access_token)
+    except requests.RequestException:
+        current_app.logger.exception('Sign-in provider unavailable')
+        revoked = False
+    if not revoked:
         # For whatever reason, the given token was invalid.
         response = make_response(
             json.dumps('Failed to revoke token for given user.'), 400)
         response.headers['Content-Type'] = 'application/json'
         return response
+    del login_session['access_token']
+    response = make_response(json.dumps('Successfully disconnected.'), 200)
+    response.headers['Content-Type'] = 'application/json'
+    return response
 
 
-@app.route('/disconnect')
+@route('/disconnect')
 def disconnect():
     '''Disconnect based on provider'''
     if 'provider' in login_session:
-        if login_session['provider'] == 'google':
-            gdisconnect()
-            del login_session['gplus_id']
-            # del login_session['credentials']
+        gdisconnect()
+        login_session.pop('access_token', None)
+        del login_session['gplus_id']
         del login_session['username']
         del login_session['email']
         del login_session['picture']
@@ -233,84 +450,279 @@ def disconnect():
 # JSON APIs
 ########################################
 
-@app.route('/catalog.json')
+def conditional(view):
+    '''Answer conditional GETs for catalog data from the catalog version.
+
+    Clients sending back the ETag or Last-Modified of an earlier response
+    get a 304 without the view running, until a category, product or photo
+    is written.
+    '''
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        version, modified = catalogVersion(session)
+        etag = 'catalog-{0}'.format(version)
+        # JSON and MessagePack responses need validators of their own
+        if acceptedFormat() == MSGPACK:
+            etag += '-msgpack'
+        if request.if_none_match:
+            not_modified = request.if_none_match.contains_weak(etag)
+        elif request.if_modified_since:
+            since = request.if_modified_since.replace(tzinfo=None)
+            not_modified = modified <= since
+        else:
+            not_modified = False
+        if not_modified:
+            response = Response(status=304)
+        else:
+            response = make_response(view(*args, **kwargs))
+        response.set_etag(etag, weak=True)
+        response.last_modified = modified
+        response.cache_control.no_cache = True
+        response.vary.add('Accept')
+        return response
+    return wrapper
+
+
+def acceptedFormat():
+    '''MIME type the client's Accept header asks the data endpoints for'''
+    return responseFormat(request.accept_mimetypes)
+
+
+def dataResponse(**data):
+    '''Like jsonify, but encoded as MessagePack when the client asked for
+    it (see catalog_formats.py)'''
+    mimetype = acceptedFormat()
+    return Response(encodeDocument(data, mimetype), mimetype=mimetype)
+
+
+def productRows(rows):
+    '''Serialize rows selecting PRODUCT_COLUMNS like Product.serialize'''
+    return [rowDict(row, PRODUCT_COLUMNS) for row in rows]
+
+
+def streamResponse(chunks, mimetype='application/json'):
+    '''Stream generated chunks while keeping the request context alive'''
+    return Response(stream_with_context(chunks), mimetype=mimetype)
+
+
+def isStreamed():
+    '''Determine if a JSON request asked for a streamed response'''
+    return request.args.get('stream') in ('1', 'true') and \
+        acceptedFormat() == JSON
+
+
+@route('/catalog.json')
+@conditional
 def catalogJSON():
-    categories = session.query(Category).all()
-    return jsonify(Category=[i.serializeWithProducts for i in categories])
+    if isStreamed():
+        return streamResponse(catalogChunks(session))
+    if acceptedFormat() == MSGPACK:
+        return Response(packedCatalogDocument(session), mimetype=MSGPACK)
+    return Response(catalogDocument(session), mimetype=JSON)
+
+
+@route('/catalog.ndjson')
+@conditional
+def catalogNDJSON():
+    return streamResponse(catalogLines(session), 'application/x-ndjson')
 
 
-@app.route('/categories.json')
+@route('/categories.json')
+@conditional
 def categoriesJSON():
-    categories = session.query(Category).all()
-    return jsonify(Category=[i.serialize for i in categories])
+    categories = session.query(*CATEGORY_COLUMNS).order_by(Category.id)
+    return dataResponse(Category=[rowDict(row, CATEGORY_COLUMNS)
+                                  for row in categories])
 
 
-@app.route('/products.json')
+@route('/products.json')
+@conditional
 def productsJSON():
-    products = session.query(Product).all()
-    return jsonify(Product=[i.serialize for i in products])
+    product_filter = productFilterArgs()
+    query = filterProducts(session.query(*PRODUCT_COLUMNS), product_filter)
+    if isPaged():
+        cursor, limit = pageArgs()
+        columns, descending = productOrder(product_filter, LATEST_ORDER,
+                                           PRICE_ORDER)
+        products, next_cursor = getPage(
+            keysetPage, query, columns, cursor, limit, descending)
+        return dataResponse(Product=productRows(products),
+                            next_cursor=next_cursor)
+    if product_filter != NO_FILTER:
+        products = listProducts(query, product_filter, LATEST_ORDER,
+                                PRICE_ORDER)
+        return dataResponse(Product=productRows(products))
+    if isStreamed():
+        return streamResponse(productsChunks(session))
+    return dataResponse(Product=productRows(query.order_by(Product.id)))
+
+
+@route('/products.ndjson')
+@conditional
+def productsNDJSON():
+    return streamResponse(productLines(session), 'application/x-ndjson')
+
+
+@route('/category/<category_slug>/items.json')
+@conditional
+def categoryItemsJSON(category_slug):
+    product_filter = productFilterArgs()
+    category_id = categoryBySlug(category_slug).id
+    # The sort key columns come along so cursors can be read off the rows
+    query = session.query(Product.category_id, *PRODUCT_COLUMNS) \
+        .filter(Product.category_id == category_id)
+    if isPaged():
+        cursor, limit = pageArgs()
+        columns, descending = productOrder(product_filter, CATEGORY_ORDER,
+                                           CATEGORY_PRICE_ORDER)
+        items, next_cursor = getPage(
+            keysetPage, filterProducts(query, product_filter), columns,
+            cursor, limit, descending)
+        return dataResponse(Product=productRows(items),
+                            next_cursor=next_cursor)
+    if product_filter != NO_FILTER:
+        items = listProducts(query, product_filter, CATEGORY_ORDER,
+                             CATEGORY_PRICE_ORDER)
+        return dataResponse(Product=productRows(items))
+    return dataResponse(Product=productRows(query.order_by(Product.id)))
+
+
+@route('/category/<category_slug>/details.json')
+@conditional
+def categoryJSON(category_slug):
+    category = categoryBySlug(category_slug)
+    return dataResponse(Category=rowDict(category, CATEGORY_COLUMNS))
+
+
+@route('/product/<product_slug>/details.json')
+@conditional
+def productJSON(product_slug):
+    product = productBySlug(product_slug)
+    return dataResponse(Product=rowDict(product, PRODUCT_COLUMNS))
+
+
+@route('/products/batch.json')
+@conditional
+def productsBatchJSON():
+    column, values = batchArgs(PRODUCT_KEYS)
+    rows = productBatchQuery(session.query(*productBatchColumns()), column,
+                             values)
+    products, missing = productBatch(rows, column, values)
+    return dataResponse(Product=products, missing=missing)
+
+
+@route('/categories/batch.json')
+@conditional
+def categoriesBatchJSON():
+    column, values = batchArgs(CATEGORY_KEYS)
+    rows = categoryBatchQuery(session.query(*CATEGORY_COLUMNS), column,
+                              values)
+    categories, missing = categoryBatch(rows, column, values)
+    return dataResponse(Category=categories, missing=missing)
+
+
+@route('/facets.json')
+@conditional
+def facetsJSON():
+    return dataResponse(Facets=serializeFacets(productFacets(session),
+                                               categoryList(session)))
+
+
+@route('/search.json')
+@conditional
+def searchJSON():
+    cursor, limit = pageArgs()
+    products = searchProducts(session, request.args.get('q', ''), limit)
+    return dataResponse(Product=[i.serialize for i in products])
 
 
-@app.route('/category/<category_name>/items.json')
-def categoryItemsJSON(category_name):
-    category = session.query(Category).filter_by(name=category_name).one()
-    items = session.query(Product).filter_by(
-        category_id=category.id).all()
-    return jsonify(Product=[i.serialize for i in items])
+########################################
+# FRAGMENTS
+########################################
+
+def renderGrid(products, next_cursor=None):
+    '''Thumbnail grid of products, with what list.html needs around it'''
+    return {'html': render_template('category/grid.html',
+                                    products=products),
+            'count': len(products),
+            'next_cursor': next_cursor}
 
 
-@app.route('/category/<category_name>/details.json')
-def categoryJSON(category_name):
-    category = session.query(Category).filter_by(name=category_name).one()
-    return jsonify(Category=category.serialize)
+def productGrid(name, query_function, cursor, limit):
+    '''Grid of a page of query_function, cached as a fragment'''
+    def render():
+        return renderGrid(*getPage(query_function, session, cursor, limit))
+    return cachedFragment(session, name, [cursor, limit], render)
 
 
-@app.route('/product/<product_name>/details.json')
-def productJSON(product_name):
-    product = session.query(Product).filter_by(name=product_name).one()
-    return jsonify(Product=product.serialize)
+def categorySidebar():
+    '''Category list and counts of the sidebar, cached as a fragment'''
+    return cachedFragment(session, 'sidebar', [], lambda: render_template(
+        'category/sidebar.html', categories=categoryList(session),
+        facets=productFacets(session)))
 
 
 ########################################
 # CATEGORIES
 ########################################
 
-@app.route('/')
-@app.route('/catalog')
+@route('/')
+@route('/catalog')
 def showCatalog():
     ''' Display latest items in catalog '''
     current_category = 'Latest Items'
-    categories = session.query(Category).order_by(Category.name)
-    products = session.query(Product).order_by(Product.id.desc()).all()
+    cursor, limit = pageArgs()
     return render_template('category/list.html',
-                           categories=categories,
-                           products=products,
+                           sidebar=categorySidebar(),
+                           grid=productGrid('latest', latestProducts,
+                                            cursor, limit),
+                           page_args=linkArgs(),
                            current_category=current_category)
 
 
-@app.route('/catalog/all')
+@route('/catalog/all')
 def showCatalogAll():
     ''' Display all categories and all of their products'''
     current_category = 'All'
-    categories = session.query(Category).order_by(asc(Category.name))
-    products = session.query(Product).order_by(
-        Product.category_id, Product.name).all()
+    cursor, limit = pageArgs()
     return render_template('category/list.html',
-                           categories=categories,
-                           products=products,
+                           sidebar=categorySidebar(),
+                           grid=productGrid('all', allProducts, cursor,
+                                            limit),
+                           page_args=linkArgs(),
                            current_category=current_category)
 
 
-@app.route('/catalog/<category_name>/items', methods=['GET', 'POST'])
-def showCategory(category_name):
+@route('/search')
+def searchCatalog():
+    ''' Display products matching the search query '''
+    query = request.args.get('q', '')
+    cursor, limit = pageArgs()
+    products = searchProducts(session, query, limit)
+    # Searches are too varied to be worth caching
+    return render_template('category/list.html',
+                           sidebar=categorySidebar(),
+                           grid=renderGrid(products),
+                           current_category='Search results for "{0}"'
+                           .format(query))
+
+
+@route('/catalog/<category_slug>/items', methods=['GET', 'POST'])
+def showCategory(category_slug):
     '''Display specific category and their products'''
-    current_category = category_name
-    category = session.query(Category).filter_by(name=category_name).first()
-    categories = session.query(Category).order_by(asc(Category.name)).all()
-    products = session.query(Product).filter_by(
-        category_id=category.id, status=1).order_by(asc(Product.name)).all()
-    inactive_products = session.query(Product).filter_by(
-        category_id=category.id, status=0).order_by(asc(Product.name)).all()
+    category = categoryBySlug(category_slug)
+    current_category = category.name
+    categories = categoryList(session)
+    cursor, limit = pageArgs()
+    inactive_cursor = request.args.get('inactive_cursor')
+    product_filter = productFilterArgs()
+    products, next_cursor = getPage(
+        categoryProducts, session, category.id, 1, cursor, limit,
+        product_filter)
+    inactive_products, next_inactive_cursor = getPage(
+        categoryProducts, session, category.id, 0, inactive_cursor, limit,
+        product_filter)
+    active_count = countCategoryProducts(session, category.id, 1)
     # Determine if logged in user is category owner
     if 'username' in login_session and \
             category.user_id == login_session['user_id']:
@@ -324,10 +736,16 @@ def showCategory(category_name):
                            products=products,
                            current_category=current_category,
                            user_can_edit=user_can_edit,
-                           inactive_products=inactive_products)
+                           inactive_products=inactive_products,
+                           active_count=active_count,
+                           next_cursor=next_cursor,
+                           inactive_cursor=inactive_cursor,
+                           next_inactive_cursor=next_inactive_cursor,
+                           product_filter=product_filter,
+                           page_args=linkArgs(*PRODUCT_FILTER_ARGS))
 
 
-@app.route('/catalog/new/', methods=['GET', 'POST'])
+@route('/catalog/new/', methods=['GET', 'POST'])
 def newCategory():
     '''Create a new category'''
     # determine if user logged in
@@ -339,6 +757,9 @@ def newCategory():
                                    sku_code=request.form['sku_code'],
                                    user_id=login_session['user_id'])
             session.add(newCategory)
+            session.flush()
+            session.add(SkuCounter(category_id=newCategory.id,
+                                   next_number=1))
             flash(
                 Markup('New category <b>{0}</b> successfully created'
                        .format(newCategory.name)))
@@ -349,10 +770,10 @@ def newCategory():
     return render_template('category/new.html', category=None)
 
 
-@app.route('/category/<category_name>/edit', methods=['GET', 'POST'])
-def editCategory(category_name):
+@route('/category/<category_slug>/edit', methods=['GET', 'POST'])
+def editCategory(category_slug):
     '''Edit category'''
-    category = session.query(Category).filter_by(name=category_name).first()
+    category = categoryBySlug(category_slug)
     # Determine if user logged in
     if 'username' not in login_session:
         return redirect('/login')
@@ -363,47 +784,37 @@ def editCategory(category_name):
             # if new sku code entered
             if category.sku_code != request.form['sku_code']:
                 # Make sure SKU Code entered is unique
-                if isUniqueSkuCode(request.form['sku_code']):
-                    sku_code = request.form['sku_code']
-                else:
+                if not isUniqueSkuCode(request.form['sku_code']):
                     flash('SKU code must be unique', 'danger')
                     return render_template('category/edit.html',
                                            category=category)
-            category = Category(name=request.form['name'],
-                                sku_code=request.form['sku_code'],
-                                user_id=login_session['user_id'])
-            session.add(category)
-            flash(Markup('New category <b>{0}</b> successfully created'
+            # The slug follows the new name when the session flushes
+            category.name = request.form['name']
+            category.sku_code = request.form['sku_code']
+            flash(Markup('<b>{0}</b> successfully edited'
                          .format(category.name)))
             session.commit()
             return redirect(url_for('showCatalog'))
     else:
         flash("You do not have permission to edit this category.", "danger")
-        return redirect(url_for('showCategory', category_name=category.name))
+        return redirect(url_for('showCategory', category_slug=category.slug))
     return render_template('category/edit.html', category=category)
 
 
-@app.route('/category/<category_name>/delete', methods=['GET', 'POST'])
-def deleteCategory(category_name):
+@route('/category/<category_slug>/delete', methods=['GET', 'POST'])
+def deleteCategory(category_slug):
     '''Delete category'''
-    category = session.query(Category).filter_by(name=category_name).first()
-    products = session.query(Product).filter_by(category_id=category.id).all()
+    category = categoryBySlug(category_slug)
     # Determine if logged in
     if 'username' not in login_session:
         return redirect('/login')
     # determine if uesr is category owner
     if category.user_id == login_session['user_id']:
         if request.method == 'POST':
-            if products:
-                # delete all associated products
-                for product in products:
-                    # delete photos
-                    deleteProductPhotos(product.id)
-                    # delete product
-                    session.delete(product)
-                    session.commit()
-            # delete category
-            session.delete(category)
+            # delete category with its products, photos and SKU counter
+            purgeCategory(session, category,
+                          current_app.config['UPLOAD_FOLDER'],
+                          current_app.config['VARIANT_FOLDER'])
             flash(Markup('<b>{0}</b> successfully deleted'
                          .format(category.name)))
             session.commit()
@@ -418,44 +829,56 @@ def deleteCategory(category_name):
 # PRODUCTS
 ########################################
 
-@app.route('/catalog/<category_name>/<product_name>', methods=['GET', 'POST'])
-def showProduct(category_name, product_name):
+@route('/catalog/<category_slug>/<product_slug>', methods=['GET', 'POST'])
+def showProduct(category_slug, product_slug):
     '''Display product'''
-    category = session.query(Category).filter_by(name=category_name).first()
-    product = session.query(Product).filter_by(
-        name=product_name, category_id=category.id).first()
-    productPhoto = session.query(ProductPhoto).filter_by(
-        product_id=product.id).first()
+    category = categoryBySlug(category_slug)
+    product = productBySlug(product_slug)
+    if product.category_id != category.id:
+        abort(404)
     # Determine if logged in user is product owner
     if 'username' in login_session and \
             product.user_id == login_session['user_id']:
         user_can_edit = 1
     else:
         user_can_edit = 0
+    # The photos are only loaded when the body is rendered
+    body = cachedFragment(session, 'product', [product.id], lambda:
+                          render_template('product/body.html',
+                                          product=product))
 
     return render_template('product/detail.html',
                            product=product,
                            category=category,
                            user_can_edit=user_can_edit,
-                           productPhoto=productPhoto)
+                           body=body)
 
 
-@app.route('/catalog/<category_name>/new', methods=['GET', 'POST'])
-def newProduct(category_name):
+@route('/catalog/<category_slug>/new', methods=['GET', 'POST'])
+def newProduct(category_slug):
     '''Create a new product'''
-    categories = session.query(Category).order_by(Category.name).all()
-    preselected_category = session.query(
-        Category).filter_by(name=category_name).first()
+    categories = categoryList(session)
+    preselected_category = findCategory(session, category_slug)
     # determine if user is logged in
     if 'username' not in login_session:
         return redirect('/login')
     if request.method == 'POST':
         category_id = request.form['category_id']
+        try:
+            price = parsePrice(request.form['price'])
+        except ValueError:
+            flash('Price must be a number', 'danger')
+            return render_template('product/new.html',
+                                   product=None,
+                                   categories=categories,
+                                   preselected_category=preselected_category)
 
         # check to see if sku was left blank, auto-populate if empty
         if request.form['sku']:
             if isUniqueSku(request.form['sku']):
                 sku = request.form['sku']
+                claimSku(session, session.query(Category).get(category_id),
+                         sku)
             else:
                 flash('SKU code must be unique', 'danger')
                 return render_template('product/new.html',
@@ -472,14 +895,15 @@ def newProduct(category_name):
             if file.filename != '':
                 if file and allowed_file(file.filename):
                     filename = secure_filename(file.filename)
-                    file.save(os.path.join(
-                        app.config['UPLOAD_FOLDER'], filename))
+                    with timed('photo_io'):
+                        file.save(os.path.join(
+                            current_app.config['UPLOAD_FOLDER'], filename))
                     photo_uploaded = True
 
         # create new product
         newProduct = Product(name=request.form['name'],
                              sku=sku,
-                             price=request.form['price'],
+                             price=price,
                              status=request.form['status'],
                              category_id=category_id,
                              description=request.form['description'],
@@ -492,6 +916,10 @@ def newProduct(category_name):
                                     order_placement=1,
                                     product=newProduct)
             session.add(newPhoto)
+            session.flush()
+            queueVariants(session, newPhoto,
+                          current_app.config['UPLOAD_FOLDER'],
+                          current_app.config['VARIANT_FOLDER'])
 
         flash(Markup('New product <b>{0}</b> successfully created'
                      .format(newProduct.name)))
@@ -504,14 +932,12 @@ def newProduct(category_name):
                                preselected_category=preselected_category)
 
 
-@app.route('/catalog/<product_name>/edit', methods=['GET', 'POST'])
-def editProduct(product_name):
+@route('/catalog/<product_slug>/edit', methods=['GET', 'POST'])
+def editProduct(product_slug):
     '''Edit product'''
-    product = session.query(Product).filter_by(name=product_name).first()
-    category = session.query(Category) \
-                      .filter_by(name=product.category.name) \
-                      .first()
-    categories = session.query(Category).order_by(Category.name).all()
+    product = productBySlug(product_slug)
+    category = product.category
+    categories = categoryList(session)
     preselected_category = category
     # Determine if logged in
     if 'username' not in login_session:
@@ -520,6 +946,14 @@ def editProduct(product_name):
     if product.user_id == login_session['user_id']:
         # get form data
         if request.method == 'POST':
+            try:
+                price = parsePrice(request.form['price'])
+            except ValueError:
+                flash('Price must be a number', 'danger')
+                return render_template('product/edit.html',
+                                       category=category,
+                                       product=product,
+                                       categories=categories)
 
             # check if photo was uploaded
             photo_uploaded = False
@@ -528,14 +962,17 @@ def editProduct(product_name):
                 if file.filename != '':
                     if file and allowed_file(file.filename):
                         filename = secure_filename(file.filename)
-                        file.save(os.path.join(
-                            app.config['UPLOAD_FOLDER'], filename))
+                        with timed('photo_io'):
+                            file.save(os.path.join(
+                                current_app.config['UPLOAD_FOLDER'], filename))
                         photo_uploaded = True
 
             # check to see if sku was changed
             if request.form['sku'] != product.sku:
                 if isUniqueSku(request.form['sku']):
                     product.sku = request.form['sku']
+                    claimSku(session, session.query(Category).get(
+                        request.form['category_id']), product.sku)
                 else:
                     flash('SKU code must be unique', 'danger')
                     return render_template('product/edit.html',
@@ -545,7 +982,7 @@ def editProduct(product_name):
 
             # update product
             product.name = request.form['name']
-            product.price = request.form['price']
+            product.price = price
             product.status = request.form['status']
             product.category_id = request.form['category_id']
             product.description = request.form['description']
@@ -561,6 +998,10 @@ def editProduct(product_name):
                                         order_placement=1,
                                         product=product)
                 session.add(newPhoto)
+                session.flush()
+                queueVariants(session, newPhoto,
+                              current_app.config['UPLOAD_FOLDER'],
+                              current_app.config['VARIANT_FOLDER'])
 
             flash(
                 Markup('<b>{0}</b> successfully edited'.format(product.name))
@@ -568,8 +1009,8 @@ def editProduct(product_name):
             session.commit()
 
             return redirect(url_for('showProduct',
-                                    category_name=category.name,
-                                    product_name=product.name))
+                                    category_slug=product.category.slug,
+                                    product_slug=product.slug))
         return render_template('product/edit.html',
                                category=category,
                                product=product,
@@ -580,26 +1021,25 @@ def editProduct(product_name):
         return redirect(url_for('showCatalog'))
 
 
-@app.route('/catalog/<product_name>/delete', methods=['GET', 'POST'])
-def deleteProduct(product_name):
+@route('/catalog/<product_slug>/delete', methods=['GET', 'POST'])
+def deleteProduct(product_slug):
     '''Delete product'''
-    product = session.query(Product).filter_by(name=product_name).first()
-    category = session.query(Category).filter_by(
-        name=product.category.name).first()
+    product = productBySlug(product_slug)
+    category = product.category
     # Determine if logged in
     if 'username' not in login_session:
         return redirect('/login')
     # Determine if logged in user is product owner
     if product.user_id == login_session['user_id']:
         if request.method == 'POST':
-            # delete product
-            deleteProductPhotos(product.id)
-            session.delete(product)
+            # delete product and its photos
+            purgeProduct(session, product, current_app.config['UPLOAD_FOLDER'],
+                         current_app.config['VARIANT_FOLDER'])
             flash(Markup('<b>{0}</b> successfully deleted'
                          .format(product.name)))
             session.commit()
             return redirect(url_for('showCategory',
-                                    category_name=category.name))
+                                    category_slug=category.slug))
         return render_template('product/delete.html',
                                category=category,
                                product=product)
@@ -609,14 +1049,12 @@ def deleteProduct(product_name):
 
 
 def deleteProductPhotos(product_id):
-    ''' Find all photos for each product and delete the files '''
-    photos = session.query(ProductPhoto).filter_by(product_id=product_id).all()
-    for photo in photos:
-        # delete file
-        os.remove(os.path.join(app.config['UPLOAD_FOLDER'], photo.filename))
-        # delete database entry
-        session.delete(photo)
-        session.commit()
+    ''' Delete the photos of a product and queue removal of their files '''
+    photos = session.query(ProductPhoto) \
+        .options(selectinload(ProductPhoto.variants)) \
+        .filter_by(product_id=product_id).all()
+    deletePhotos(session, photos, current_app.config['UPLOAD_FOLDER'],
+                 current_app.config['VARIANT_FOLDER'])
     return True
 
 ########################################
@@ -625,27 +1063,9 @@ def deleteProductPhotos(product_id):
 
 
 def getNextSku(category_id):
-    ''' Return the next available sku number for the given category'''
-    # get sku code from category
+    ''' Return the next available sku for the given category'''
     category = session.query(Category).filter_by(id=category_id).first()
-    # find the highest sku code for products in that category
-    product_last_sku = session.query(Product).filter_by(
-        category_id=category_id).order_by(Product.sku.desc()).first()
-    if product_last_sku:
-        # parse product sku number
-        try:
-            last_sku_code, last_sku_number = product_last_sku.sku.split("-")
-            print(last_sku_number)
-        except:
-            last_sku_number = product_last_sku.sku
-        # increment sku number
-        product_next_sku = int(last_sku_number) + 1
-    else:
-        # default sku to 0001
-        product_next_sku = '1'
-    # concatenate sku code and sku number
-    sku = str(category.sku_code) + "-" + str(product_next_sku)
-    return sku
+    return reserveSkus(session, category)[0]
 
 
 def isUniqueSkuCode(sku_code):
@@ -665,6 +1085,8 @@ def isUniqueSku(sku):
 
 
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    app = createApp()
     app.secret_key = 'super_secret_key'
     app.debug = True
-    app.run(host='0.0.0.0', port=8000)
+    app.run(host='0.0.0.0', port=8000, threaded=True)
@@ -0,0 +1,445 @@
+'''Read-only JSON API on asyncio, for any ASGI server:
+
+    uvicorn async_api:app --host 0.0.0.0 --port 8001
+
+It answers the JSON endpoints of application.py with the same documents,
+paging arguments and ETag/Last-Modified validators, reading the models in
+database_setup.py through an asyncio driver:
+
+    /catalog.json
+    /categories.json
+    /category/<category_slug>/details.json
+    /category/<category_slug>/items.json
+    /products.json
+    /product/<product_slug>/details.json
+    /products/batch.json
+    /categories/batch.json
+
+A request only holds a pooled connection while its queries run and waits
+on the database without a thread, so one process serves thousands of
+concurrent clients. Route GET requests for these paths here and everything
+else to the Flask app. Like the Flask app it selects plain rows rather
+than model objects and answers in MessagePack when the Accept header asks
+for it (see catalog_formats.py).
+
+Needs Python 3 with SQLAlchemy 1.4 or later and asyncpg (PostgreSQL) or
+aiosqlite (SQLite). DATABASE_URL and the pool settings are read as in
+database.py, with the driver switched to the asyncio one.
+'''
+import asyncio
+import json
+import re
+import time
+from collections import namedtuple
+from urllib.parse import parse_qsl
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import sessionmaker
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import http_date, parse_accept_header, parse_date, \
+    parse_etags, quote_etag
+from database import createAsyncEngine
+from database_setup import Category, Product
+from catalog_export import categoryColumns, categoryDocuments, rowDict, \
+    encode, CATEGORY_COLUMNS, PRODUCT_COLUMNS, STREAM_BATCH_SIZE
+from catalog_batch import batchKeys, productBatchColumns, productBatchQuery, \
+    productBatch, categoryBatchQuery, categoryBatch, PRODUCT_KEYS, \
+    CATEGORY_KEYS
+from catalog_formats import encodeDocument, encodeMsgpack, responseFormat, \
+    JSON, MSGPACK
+from catalog_queries import keysetQuery, pageRows, productFilter, \
+    filterProducts, productOrder, LATEST_ORDER, CATEGORY_ORDER, PRICE_ORDER, \
+    CATEGORY_PRICE_ORDER, NO_FILTER, PAGE_SIZE, MAX_PAGE_SIZE
+from catalog_version import version_table, CATALOG_VERSION_TTL
+
+ROUTES = (
+    (r'/catalog\.json', 'catalogJSON'),
+    (r'/categories\.json', 'categoriesJSON'),
+    (r'/category/(?P<category_slug>[^/]+)/details\.json', 'categoryJSON'),
+    (r'/category/(?P<category_slug>[^/]+)/items\.json', 'categoryItemsJSON'),
+    (r'/products\.json', 'productsJSON'),
+    (r'/product/(?P<product_slug>[^/]+)/details\.json', 'productJSON'),
+    (r'/products/batch\.json', 'productsBatchJSON'),
+    (r'/categories/batch\.json', 'categoriesBatchJSON'),
+)
+
+# What a view gets: its session, the query arguments, the catalog version
+# and the MIME type to answer with
+Request = namedtuple('Request', 'session args version mimetype')
+
+
+class HTTPError(Exception):
+    '''Answer the request with status and a JSON message'''
+
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+        self.message = message
+
+
+class Response(object):
+    '''Complete body, or chunks from an async iterator'''
+
+    def __init__(self, body=b'', status=200, chunks=None,
+                 content_type=JSON):
+        self.body = body
+        self.status = status
+        self.chunks = chunks
+        self.headers = [(b'content-type', content_type.encode('latin-1'))]
+
+    def setHeader(self, name, value):
+        self.headers.append((name.encode('latin-1'), value.encode('latin-1')))
+
+    async def send(self, send, head=False):
+        headers = list(self.headers)
+        if self.chunks is None:
+            headers.append((b'content-length',
+                            str(len(self.body)).encode('latin-1')))
+        await send({'type': 'http.response.start', 'status': self.status,
+                    'headers': headers})
+        if self.chunks is not None and not head:
+            async for chunk in self.chunks:
+                await send({'type': 'http.response.body', 'body': chunk,
+                            'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        else:
+            await send({'type': 'http.response.body',
+                        'body': b'' if head else self.body})
+
+
+def jsonResponse(data, status=200):
+    '''Response with the same JSON as Flask's jsonify'''
+    return Response((json.dumps(data, sort_keys=True, separators=(',', ':'))
+                     + '\n').encode('utf-8'), status)
+
+
+def dataResponse(request, **data):
+    '''Response encoded like dataResponse in application.py'''
+    return Response(encodeDocument(data, request.mimetype),
+                    content_type=request.mimetype)
+
+
+def productRows(rows):
+    return [rowDict(row, PRODUCT_COLUMNS) for row in rows]
+
+
+def pageArgs(args):
+    '''Read the cursor and limit query arguments'''
+    try:
+        limit = int(args.get('limit', PAGE_SIZE))
+    except ValueError:
+        raise HTTPError(400, 'Invalid limit')
+    if limit < 1 or limit > MAX_PAGE_SIZE:
+        raise HTTPError(400, 'Invalid limit')
+    return args.get('cursor'), limit
+
+
+def isPaged(args):
+    return 'cursor' in args or 'limit' in args
+
+
+def productFilterArgs(args):
+    '''Read the price filter and sort query arguments'''
+    try:
+        return productFilter(args)
+    except ValueError:
+        raise HTTPError(400, 'Invalid price filter')
+
+
+def batchArgs(args, keys):
+    '''Read the keys of a batch request'''
+    try:
+        return batchKeys(args, keys)
+    except ValueError as e:
+        raise HTTPError(400, str(e))
+
+
+async def keysetPage(session, query, columns, cursor, limit,
+                     descending=False):
+    '''One page of the rows selected by query and the next cursor'''
+    try:
+        query = keysetQuery(query, columns, cursor, descending)
+    except ValueError:
+        raise HTTPError(400, 'Invalid cursor')
+    result = await session.execute(query.limit(limit + 1))
+    return pageRows(result.all(), columns, limit)
+
+
+async def listProducts(session, query, product_filter, default_order,
+                       price_order):
+    '''Products selected by query, filtered and sorted by product_filter'''
+    columns, descending = productOrder(product_filter, default_order,
+                                       price_order)
+    result = await session.execute(keysetQuery(
+        filterProducts(query, product_filter), columns,
+        descending=descending))
+    return result.all()
+
+
+async def first(session, query, message):
+    '''First row selected by query, answering 404 if there is none'''
+    row = (await session.execute(query.limit(1))).first()
+    if row is None:
+        raise HTTPError(404, message)
+    return row
+
+
+async def bySlug(session, query, model, slug, message):
+    '''First row of query for the slug, or for the name of URLs made
+    before slugs existed, answering 404 if there is none'''
+    row = (await session.execute(
+        query.where(model.slug == slug).limit(1))).first()
+    if row is not None:
+        return row
+    return await first(session, query.where(model.name == slug)
+                       .order_by(model.id), message)
+
+
+async def catalogDocument(session):
+    '''catalog.json as bytes, built from one streamed query'''
+    query = select(*categoryColumns()) \
+        .outerjoin(Product, Category.id == Product.category_id) \
+        .order_by(Category.id, Product.id)
+    result = await session.stream(query)
+    parts = []
+    rows = []
+    async for partition in result.partitions(STREAM_BATCH_SIZE):
+        for row in partition:
+            if rows and rows[-1].category_id != row.category_id:
+                parts.extend(document for category_id, document
+                             in categoryDocuments(rows))
+                rows = []
+            rows.append(row)
+    parts.extend(document for category_id, document
+                 in categoryDocuments(rows))
+    return ('{"Category": [' + ', '.join(parts) + ']}\n').encode('utf-8')
+
+
+async def productsChunks(session):
+    '''Yield products.json a batch of rows at a time'''
+    result = await session.stream(
+        select(*PRODUCT_COLUMNS).order_by(Product.id))
+    piece = '{"Product": ['
+    separator = ''
+    async for partition in result.partitions(STREAM_BATCH_SIZE):
+        for row in partition:
+            piece += separator + encode(rowDict(row, PRODUCT_COLUMNS))
+            separator = ', '
+        yield piece.encode('utf-8')
+        piece = ''
+    yield (piece + ']}\n').encode('utf-8')
+
+
+class CatalogAPI(object):
+    '''ASGI application serving the read-only JSON endpoints'''
+
+    def __init__(self, database_url=None):
+        self.database_url = database_url
+        self.routes = [(re.compile(pattern), getattr(self, name))
+                       for pattern, name in ROUTES]
+        self._engine = None
+        self._session_factory = None
+        self._version = None
+        self._version_read = 0
+        self._document = None
+        self._packed_document = None
+        self._document_lock = None
+
+    def sessionFactory(self):
+        '''Session factory on the engine, created on first use'''
+        if self._session_factory is None:
+            self._engine = createAsyncEngine(self.database_url)
+            self._session_factory = sessionmaker(
+                self._engine, class_=AsyncSession, expire_on_commit=False)
+        return self._session_factory
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+        async with self.sessionFactory()() as session:
+            try:
+                response = await self.handle(session, scope)
+            except HTTPError as e:
+                response = jsonResponse({'error': e.message}, e.status)
+            await response.send(send, head=scope['method'] == 'HEAD')
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self._engine is not None:
+                    await self._engine.dispose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def handle(self, session, scope):
+        '''Route the request, answering conditional GETs like conditional
+        in application.py'''
+        for pattern, view in self.routes:
+            match = pattern.fullmatch(scope['path'])
+            if match is not None:
+                break
+        else:
+            raise HTTPError(404, 'Not found')
+        if scope['method'] not in ('GET', 'HEAD'):
+            raise HTTPError(405, 'Method not allowed')
+        headers = dict((name.decode('latin-1'), value.decode('latin-1'))
+                       for name, value in scope['headers'])
+        # Blank values are kept and the first of repeated ones wins, as in
+        # Flask's request.args
+        args = {}
+        for name, value in parse_qsl(scope['query_string'].decode('latin-1'),
+                                     keep_blank_values=True):
+            args.setdefault(name, value)
+        mimetype = responseFormat(parse_accept_header(
+            headers.get('accept'), MIMEAccept))
+
+        version, modified = await self.catalogVersion(session)
+        etag = 'catalog-{0}'.format(version)
+        if mimetype == MSGPACK:
+            etag += '-msgpack'
+        if 'if-none-match' in headers:
+            not_modified = parse_etags(
+                headers['if-none-match']).contains_weak(etag)
+        elif parse_date(headers.get('if-modified-since')) is not None:
+            since = parse_date(headers['if-modified-since'])
+            # Last-Modified has whole seconds
+            not_modified = modified.replace(microsecond=0) <= \
+                since.replace(tzinfo=None)
+        else:
+            not_modified = False
+        if not_modified:
+            response = Response(status=304)
+        else:
+            response = await view(Request(session, args, version, mimetype),
+                                  **match.groupdict())
+        response.setHeader('etag', quote_etag(etag, weak=True))
+        response.setHeader('last-modified', http_date(modified))
+        response.setHeader('cache-control', 'no-cache')
+        response.setHeader('vary', 'Accept')
+        return response
+
+    async def catalogVersion(self, session):
+        '''(version, last modified), read every CATALOG_VERSION_TTL'''
+        now = time.time()
+        if self._version is None or \
+                now - self._version_read >= CATALOG_VERSION_TTL:
+            result = await session.execute(
+                select(version_table.c.version, version_table.c.modified)
+                .where(version_table.c.id == 1))
+            row = result.first()
+            self._version = (row.version, row.modified)
+            self._version_read = now
+        return self._version
+
+    ########################################
+    # VIEWS
+    ########################################
+
+    async def catalogJSON(self, request):
+        # Built once per catalog version and shared by waiting requests
+        if self._document_lock is None:
+            self._document_lock = asyncio.Lock()
+        async with self._document_lock:
+            if self._document is None or \
+                    self._document[0] != request.version:
+                self._document = (request.version,
+                                  await catalogDocument(request.session))
+            if request.mimetype == MSGPACK:
+                if self._packed_document is None or \
+                        self._packed_document[0] != self._document[0]:
+                    self._packed_document = (self._document[0], encodeMsgpack(
+                        json.loads(self._document[1].decode('utf-8'))))
+                return Response(self._packed_document[1],
+                                content_type=MSGPACK)
+        return Response(self._document[1])
+
+    async def categoriesJSON(self, request):
+        result = await request.session.execute(
+            select(*CATEGORY_COLUMNS).order_by(Category.id))
+        return dataResponse(request, Category=[
+            rowDict(row, CATEGORY_COLUMNS) for row in result])
+
+    async def categoryJSON(self, request, category_slug):
+        category = await bySlug(
+            request.session, select(*CATEGORY_COLUMNS), Category,
+            category_slug, 'Unknown category')
+        return dataResponse(request,
+                            Category=rowDict(category, CATEGORY_COLUMNS))
+
+    async def categoryItemsJSON(self, request, category_slug):
+        category = await bySlug(
+            request.session, select(Category.id), Category, category_slug,
+            'Unknown category')
+        product_filter = productFilterArgs(request.args)
+        # The sort key columns come along so cursors can be read off rows
+        query = select(Product.category_id, *PRODUCT_COLUMNS) \
+            .where(Product.category_id == category.id)
+        if isPaged(request.args):
+            cursor, limit = pageArgs(request.args)
+            columns, descending = productOrder(
+                product_filter, CATEGORY_ORDER, CATEGORY_PRICE_ORDER)
+            items, next_cursor = await keysetPage(
+                request.session, filterProducts(query, product_filter),
+                columns, cursor, limit, descending)
+            return dataResponse(request, Product=productRows(items),
+                                next_cursor=next_cursor)
+        if product_filter != NO_FILTER:
+            items = await listProducts(request.session, query,
+                                       product_filter, CATEGORY_ORDER,
+                                       CATEGORY_PRICE_ORDER)
+            return dataResponse(request, Product=productRows(items))
+        result = await request.session.execute(query.order_by(Product.id))
+        return dataResponse(request, Product=productRows(result))
+
+    async def productsJSON(self, request):
+        product_filter = productFilterArgs(request.args)
+        if isPaged(request.args):
+            cursor, limit = pageArgs(request.args)
+            columns, descending = productOrder(product_filter, LATEST_ORDER,
+                                               PRICE_ORDER)
+            products, next_cursor = await keysetPage(
+                request.session,
+                filterProducts(select(*PRODUCT_COLUMNS), product_filter),
+                columns, cursor, limit, descending)
+            return dataResponse(request, Product=productRows(products),
+                                next_cursor=next_cursor)
+        if product_filter != NO_FILTER:
+            products = await listProducts(
+                request.session, select(*PRODUCT_COLUMNS), product_filter,
+                LATEST_ORDER, PRICE_ORDER)
+            return dataResponse(request, Product=productRows(products))
+        if request.mimetype == JSON:
+            return Response(chunks=productsChunks(request.session))
+        result = await request.session.execute(
+            select(*PRODUCT_COLUMNS).order_by(Product.id))
+        return dataResponse(request, Product=productRows(result))
+
+    async def productJSON(self, request, product_slug):
+        product = await bySlug(
+            request.session, select(*PRODUCT_COLUMNS), Product, product_slug,
+            'Unknown product')
+        return dataResponse(request,
+                            Product=rowDict(product, PRODUCT_COLUMNS))
+
+    async def productsBatchJSON(self, request):
+        column, values = batchArgs(request.args, PRODUCT_KEYS)
+        result = await request.session.execute(productBatchQuery(
+            select(*productBatchColumns()), column, values))
+        products, missing = productBatch(result, column, values)
+        return dataResponse(request, Product=products, missing=missing)
+
+    async def categoriesBatchJSON(self, request):
+        column, values = batchArgs(request.args, CATEGORY_KEYS)
+        result = await request.session.execute(categoryBatchQuery(
+            select(*CATEGORY_COLUMNS), column, values))
+        categories, missing = categoryBatch(result, column, values)
+        return dataResponse(request, Category=categories, missing=missing)
+
+
+app = CatalogAPI()
@@ -0,0 +1,417 @@
+'''Benchmark the app against a synthetic catalog.
+
+    python benchmark.py generate --categories 1000 --products 1000000
+    python benchmark.py run --requests 100 --concurrency 8 --save base.json
+    python benchmark.py run --baseline base.json
+
+generate fills the database at DATABASE_URL (use an empty one, e.g.
+DATABASE_URL=sqlite:///benchmark.db) with categories, products and photo
+rows, in batches through the bulk import code.
+
+run requests every HTML and JSON read route in turn, with the given number
+of requests per route spread over --concurrency threads, and prints the
+throughput, latency percentiles and SQL statements per request of each
+route. By default requests go through Flask's test client in this process,
+logged in as the owner of the generated catalog so the owner-only forms
+are included, and SQL statements are counted on the app's engine. With
+--url they go over HTTP to a running server instead; only public routes
+are requested and SQL is not counted. Form submissions and the OAuth
+routes are not benchmarked.
+
+--save writes the results to a JSON file, and --baseline compares a run
+with a saved one: the exit status is 1 if any route's p95 latency grew by
+more than --tolerance or it issues more SQL statements than before.
+'''
+import argparse
+import decimal
+import json
+import os
+import random
+import sys
+import threading
+import time
+try:
+    from urllib.parse import quote
+except ImportError:
+    from urllib import quote
+from sqlalchemy import create_engine, event, func, literal, select
+from sqlalchemy.orm import sessionmaker
+from database import databaseUrl
+from database_setup import Category, Product, ProductPhoto, SkuCounter, User
+from catalog_import import insertRows, batches, ownerId, BATCH_SIZE
+from catalog_slugs import assignSlugs
+from catalog_version import markCatalogChanged
+
+OWNER_EMAIL = 'benchmark@example.com'
+UPLOAD_FOLDER = './static/uploads'
+PHOTO_FILENAME = 'benchmark.png'
+# 1x1 transparent PNG shared by every generated photo row
+PHOTO_DATA = (
+    b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x01\x00\x00\x00\x01'
+    b'\x08\x06\x00\x00\x00\x1f\x15\xc4\x89\x00\x00\x00\rIDATx\x9cc\xf8\x0f'
+    b'\x00\x00\x01\x01\x00\x05\x18\xd8N\x00\x00\x00\x00IEND\xaeB`\x82')
+WORDS = ('wool', 'cotton', 'leather', 'canvas', 'silk', 'linen', 'red',
+         'blue', 'black', 'grey', 'green', 'classic', 'slim', 'summer',
+         'winter', 'vintage', 'sport', 'travel', 'waterproof', 'limited')
+
+# (endpoint, path, owner only). Paths are filled in with a random sample
+# category, product, search word and upload for each request, and the
+# batch endpoints with BATCH_SAMPLE_SIZE products or their categories.
+ROUTES = [
+    ('showCatalog', '/', False),
+    ('showCatalogAll', '/catalog/all', False),
+    ('showCategory', '/catalog/{category}/items', False),
+    ('showCategory?price', '/catalog/{category}/items?min_price=100'
+     '&max_price=200&sort=-price', False),
+    ('showProduct', '/catalog/{category}/{product}', False),
+    ('searchCatalog', '/search?q={word}', False),
+    ('showLogin', '/login', False),
+    ('viewUploadFile', '/uploads/{upload}', False),
+    ('newCategory', '/catalog/new/', True),
+    ('editCategory', '/category/{category}/edit', True),
+    ('deleteCategory', '/category/{category}/delete', True),
+    ('newProduct', '/catalog/{category}/new', True),
+    ('editProduct', '/catalog/{product}/edit', True),
+    ('deleteProduct', '/catalog/{product}/delete', True),
+    ('catalogJSON', '/catalog.json', False),
+    ('catalogJSON?stream', '/catalog.json?stream=1', False),
+    ('catalogNDJSON', '/catalog.ndjson', False),
+    ('categoriesJSON', '/categories.json', False),
+    ('productsJSON', '/products.json', False),
+    ('productsJSON?limit', '/products.json?limit=48', False),
+    ('productsJSON?price', '/products.json?limit=48&min_price=100'
+     '&max_price=200&sort=price', False),
+    ('productsNDJSON', '/products.ndjson', False),
+    ('categoryItemsJSON', '/category/{category}/items.json', False),
+    ('categoryJSON', '/category/{category}/details.json', False),
+    ('productJSON', '/product/{product}/details.json', False),
+    ('productsBatchJSON', '/products/batch.json?slugs={products}', False),
+    ('categoriesBatchJSON', '/categories/batch.json?slugs={categories}',
+     False),
+    ('searchJSON', '/search.json?q={word}', False),
+    ('facetsJSON', '/facets.json', False),
+]
+SAMPLE_SIZE = 200
+BATCH_SAMPLE_SIZE = 100
+
+
+########################################
+# GENERATOR
+########################################
+
+def description(rng):
+    return u' '.join(rng.choice(WORDS) for i in range(rng.randint(3, 8)))
+
+
+def generate(session, category_count, product_count, photos_per_product,
+             batch_size=BATCH_SIZE, seed=1, out=sys.stderr):
+    '''Add a synthetic catalog owned by OWNER_EMAIL'''
+    rng = random.Random(seed)
+    owner = ownerId(session, OWNER_EMAIL)
+    codes = ['B{0}'.format(i) for i in range(category_count)]
+    for batch in batches(codes, batch_size):
+        rows = [{'name': u'Bench {0}'.format(code), 'sku_code': code,
+                 'user_id': owner} for code in batch]
+        assignSlugs(session, Category, rows)
+        insertRows(session, Category.__table__, rows)
+    session.commit()
+    category_ids = dict((row.sku_code, row.id) for row in session.query(
+        Category.sku_code, Category.id).filter(Category.user_id == owner))
+    started = time.time()
+    numbers = dict((code, 0) for code in codes)
+    for first in range(0, product_count, batch_size):
+        rows = []
+        for n in range(first, min(first + batch_size, product_count)):
+            code = codes[n % category_count]
+            numbers[code] += 1
+            rows.append({'name': u'Bench product {0}'.format(n),
+                         'sku': u'{0}-{1}'.format(code, numbers[code]),
+                         'price': decimal.Decimal(rng.randint(100, 50099))
+                         / 100,
+                         'status': rng.randint(0, 1),
+                         'description': description(rng),
+                         'category_id': category_ids[code],
+                         'user_id': owner})
+        assignSlugs(session, Product, rows)
+        insertRows(session, Product.__table__, rows)
+        session.commit()
+        out.write('products: {0} rows ({1:.0f} rows/s)\n'.format(
+            first + len(rows), (first + len(rows)) /
+            max(time.time() - started, 1e-6)))
+    insertRows(session, SkuCounter.__table__, [
+        {'category_id': category_ids[code], 'next_number': numbers[code] + 1}
+        for code in codes])
+    products = Product.__table__
+    for placement in range(1, photos_per_product + 1):
+        # One INSERT ... SELECT per photo position
+        session.execute(ProductPhoto.__table__.insert().from_select(
+            ['filename', 'order_placement', 'product_id'],
+            select([literal(PHOTO_FILENAME), literal(placement),
+                    products.c.id]).where(products.c.user_id == owner)))
+    markCatalogChanged(session, Product)
+    session.commit()
+    if photos_per_product:
+        if not os.path.isdir(UPLOAD_FOLDER):
+            os.makedirs(UPLOAD_FOLDER)
+        with open(os.path.join(UPLOAD_FOLDER, PHOTO_FILENAME), 'wb') as f:
+            f.write(PHOTO_DATA)
+
+
+########################################
+# LOAD DRIVER
+########################################
+
+def samples(session, rng):
+    '''Slugs to fill the route paths with, picked at random'''
+    lowest, highest = session.query(func.min(Product.id),
+                                    func.max(Product.id)).one()
+    if lowest is None:
+        sys.exit('The catalog is empty, run "benchmark.py generate" first')
+    ids = [rng.randint(lowest, highest) for i in range(SAMPLE_SIZE)]
+    products = session.query(Product.slug, Category.slug) \
+        .join(Category, Product.category_id == Category.id) \
+        .filter(Product.id.in_(ids)).all()
+    uploads = [row.filename for row in session.query(ProductPhoto.filename)
+               .limit(SAMPLE_SIZE)] or [PHOTO_FILENAME]
+    return {'products': [tuple(row) for row in products],
+            'words': list(WORDS),
+            'uploads': uploads}
+
+
+def percentile(values, p):
+    '''Nearest-rank percentile of sorted values'''
+    if not values:
+        return 0
+    return values[min(len(values) - 1,
+                      max(0, int(round(p / 100.0 * len(values))) - 1))]
+
+
+class TestClientDriver(object):
+    '''Requests through Flask's test client, counting SQL statements'''
+
+    counts_sql = True
+
+    def __init__(self):
+        import application
+        self.app = application.createApp()
+        with self.app.app_context():
+            self.user_id = application.session.query(User.id) \
+                .filter_by(email=OWNER_EMAIL).scalar()
+        self.app.secret_key = 'benchmark'
+        self.local = threading.local()
+        event.listen(application.getEngine(self.app), 'before_cursor_execute',
+                     self.countStatement)
+
+    def countStatement(self, *args):
+        self.local.statements = getattr(self.local, 'statements', 0) + 1
+
+    def client(self):
+        client = getattr(self.local, 'client', None)
+        if client is None:
+            client = self.local.client = self.app.test_client()
+            if self.user_id is not None:
+                with client.session_transaction() as login_session:
+                    login_session['username'] = OWNER_EMAIL
+                    login_session['user_id'] = self.user_id
+        return client
+
+    def get(self, path):
+        '''Return (status, statements) for a GET of path'''
+        self.local.statements = 0
+        response = self.client().get(path)
+        response.get_data()
+        response.close()
+        return response.status_code, self.local.statements
+
+
+class HttpDriver(object):
+    '''Requests to a running server, one pooled connection per thread'''
+
+    counts_sql = False
+
+    def __init__(self, url):
+        import requests
+        self.requests = requests
+        self.url = url.rstrip('/')
+        self.local = threading.local()
+
+    def get(self, path):
+        http = getattr(self.local, 'http', None)
+        if http is None:
+            http = self.local.http = self.requests.Session()
+        response = http.get(self.url + path, allow_redirects=False)
+        response.content
+        return response.status_code, None
+
+
+def fillPath(template, sample, rng):
+    '''Fill a route path with a sample product and its category, or a batch
+    of them'''
+    product, category = rng.choice(sample['products'])
+    batch = rng.sample(sample['products'],
+                       min(BATCH_SAMPLE_SIZE, len(sample['products'])))
+    return template.format(
+        product=quote(product.encode('utf-8')),
+        category=quote(category.encode('utf-8')),
+        products=quote(','.join(row[0] for row in batch).encode('utf-8')),
+        categories=quote(','.join(row[1] for row in batch).encode('utf-8')),
+        word=rng.choice(sample['words']),
+        upload=quote(rng.choice(sample['uploads']).encode('utf-8')))
+
+
+def benchmarkRoute(driver, paths, concurrency):
+    '''Request paths over concurrency threads and summarize the results'''
+    latencies = []
+    statements = []
+    errors = [0]
+    lock = threading.Lock()
+    remaining = list(paths)
+
+    def worker():
+        while True:
+            with lock:
+                if not remaining:
+                    return
+                path = remaining.pop()
+            started = time.time()
+            status, count = driver.get(path)
+            elapsed = time.time() - started
+            with lock:
+                latencies.append(elapsed * 1000)
+                if count is not None:
+                    statements.append(count)
+                if status >= 400:
+                    errors[0] += 1
+
+    started = time.time()
+    threads = [threading.Thread(target=worker) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.time() - started
+    latencies.sort()
+    return {'requests': len(latencies),
+            'errors': errors[0],
+            'throughput': len(latencies) / max(wall, 1e-6),
+            'p50': percentile(latencies, 50),
+            'p95': percentile(latencies, 95),
+            'p99': percentile(latencies, 99),
+            'sql_mean': (float(sum(statements)) / len(statements)
+                         if statements else None),
+            'sql_max': max(statements) if statements else None}
+
+
+def run(driver, sample, requests, concurrency, warmup, only=None,
+        seed=1, out=sys.stdout):
+    '''Benchmark each route and return {endpoint: results}'''
+    rng = random.Random(seed)
+    results = {}
+    for endpoint, template, owner_only in ROUTES:
+        if only and endpoint.split('?')[0] not in only:
+            continue
+        if owner_only and not driver.counts_sql:
+            continue
+        paths = [fillPath(template, sample, rng)
+                 for i in range(requests + warmup)]
+        for path in paths[:warmup]:
+            driver.get(path)
+        results[endpoint] = benchmarkRoute(driver, paths[warmup:],
+                                           concurrency)
+        out.write(formatRow(endpoint, results[endpoint]) + '\n')
+        out.flush()
+    return results
+
+
+########################################
+# REPORT
+########################################
+
+HEADER = '{0:<20} {1:>6} {2:>6} {3:>9} {4:>9} {5:>9} {6:>9} {7:>8} {8:>7}' \
+    .format('route', 'reqs', 'errors', 'req/s', 'p50 ms', 'p95 ms',
+            'p99 ms', 'sql avg', 'sql max')
+
+
+def formatRow(endpoint, result):
+    sql_mean = result['sql_mean']
+    return '{0:<20} {1:>6} {2:>6} {3:>9.1f} {4:>9.2f} {5:>9.2f} {6:>9.2f} ' \
+        '{7:>8} {8:>7}'.format(
+            endpoint, result['requests'], result['errors'],
+            result['throughput'], result['p50'], result['p95'],
+            result['p99'],
+            '-' if sql_mean is None else '{0:.1f}'.format(sql_mean),
+            '-' if result['sql_max'] is None else result['sql_max'])
+
+
+def regressions(results, baseline, tolerance):
+    '''Describe each route that got slower or issues more SQL'''
+    found = []
+    for endpoint, result in sorted(results.items()):
+        before = baseline.get(endpoint)
+        if before is None:
+            continue
+        if result['p95'] > before['p95'] * (1 + tolerance):
+            found.append('{0}: p95 {1:.2f} ms, was {2:.2f} ms'.format(
+                endpoint, result['p95'], before['p95']))
+        if result['sql_max'] is not None and \
+                before['sql_max'] is not None and \
+                result['sql_max'] > before['sql_max']:
+            found.append('{0}: {1} SQL statements, was {2}'.format(
+                endpoint, result['sql_max'], before['sql_max']))
+    return found
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the catalog app')
+    commands = parser.add_subparsers(dest='command')
+    generate_args = commands.add_parser(
+        'generate', help='add a synthetic catalog to the database')
+    generate_args.add_argument('--categories', type=int, default=1000)
+    generate_args.add_argument('--products', type=int, default=100000)
+    generate_args.add_argument('--photos', type=int, default=1,
+                               help='photos per product')
+    generate_args.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    generate_args.add_argument('--seed', type=int, default=1)
+    run_args = commands.add_parser('run', help='benchmark every route')
+    run_args.add_argument('--url', help='server to benchmark over HTTP')
+    run_args.add_argument('--requests', type=int, default=50,
+                          help='requests per route')
+    run_args.add_argument('--concurrency', type=int, default=4)
+    run_args.add_argument('--warmup', type=int, default=3,
+                          help='unmeasured requests per route')
+    run_args.add_argument('--routes', help='comma separated endpoints')
+    run_args.add_argument('--seed', type=int, default=1)
+    run_args.add_argument('--save', help='write the results to this file')
+    run_args.add_argument('--baseline', help='results file to compare with')
+    run_args.add_argument('--tolerance', type=float, default=0.25,
+                          help='allowed p95 growth over the baseline')
+    args = parser.parse_args(argv)
+
+    session = sessionmaker(bind=create_engine(databaseUrl()))()
+    if args.command == 'generate':
+        generate(session, args.categories, args.products, args.photos,
+                 args.batch_size, args.seed)
+        return
+    if args.command != 'run':
+        parser.error('choose generate or run')
+    sample = samples(session, random.Random(args.seed))
+    session.close()
+    driver = HttpDriver(args.url) if args.url else TestClientDriver()
+    print(HEADER)
+    results = run(driver, sample, args.requests, args.concurrency,
+                  args.warmup, args.routes and args.routes.split(','),
+                  args.seed)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(results, json.load(f), args.tolerance)
+        for line in found:
+            print('REGRESSION ' + line)
+        if found:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
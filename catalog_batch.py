@@ -0,0 +1,107 @@
+'''Multi-get of products and categories for the batch JSON endpoints.
+
+A client that needs many specific products or categories names them all in
+one request, by id, SKU (SKU code for categories) or slug:
+
+    /products/batch.json?ids=1,2,3
+    /products/batch.json?skus=HT-1,HT-2
+    /categories/batch.json?slugs=hats,shirts
+
+and gets them from a single IN query; products come with their photos,
+which are joined in the same query. Items are returned in the order they
+were asked for, and the keys that matched nothing are listed as missing.
+
+The queries are built on a Query or a select, so async_api.py shares them.
+'''
+from catalog_export import rowDict, CATEGORY_COLUMNS, PRODUCT_COLUMNS
+from database_setup import Category, Product, ProductPhoto
+
+MAX_BATCH_SIZE = 500
+# (query argument, column) a batch can be asked for by
+PRODUCT_KEYS = (('ids', Product.id), ('skus', Product.sku),
+                ('slugs', Product.slug))
+CATEGORY_KEYS = (('ids', Category.id), ('sku_codes', Category.sku_code),
+                 ('slugs', Category.slug))
+PHOTO_COLUMNS = (ProductPhoto.id, ProductPhoto.filename,
+                 ProductPhoto.order_placement)
+
+
+def batchKeys(args, keys):
+    '''Return (column, values) for the one argument of keys in args.
+
+    Values are comma separated and repeats are dropped. Raises ValueError
+    unless exactly one of the arguments is given, with 1 to MAX_BATCH_SIZE
+    values, and ids are all integers.
+    '''
+    given = [(name, column) for name, column in keys if args.get(name)]
+    if len(given) != 1:
+        raise ValueError('Expected one of {0}'.format(
+            ', '.join(name for name, column in keys)))
+    name, column = given[0]
+    values = []
+    seen = set()
+    for value in args[name].split(','):
+        value = value.strip()
+        if name == 'ids' and value:
+            if not value.isdigit():
+                raise ValueError('Invalid id {0}'.format(value))
+            value = int(value)
+        if value != '' and value not in seen:
+            seen.add(value)
+            values.append(value)
+    if not values or len(values) > MAX_BATCH_SIZE:
+        raise ValueError('Expected 1 to {0} {1}'.format(MAX_BATCH_SIZE, name))
+    return column, values
+
+
+def inRequestOrder(items, values):
+    '''items (a dict keyed by value) in the order of values, and the values
+    that have no item'''
+    return ([items[value] for value in values if value in items],
+            [value for value in values if value not in items])
+
+
+def productBatchColumns():
+    '''Product and photo columns labelled for productBatch'''
+    return [column.label('product_' + column.key)
+            for column in PRODUCT_COLUMNS] + \
+        [column.label('photo_' + column.key) for column in PHOTO_COLUMNS]
+
+
+def productBatchQuery(query, column, values):
+    '''Restrict query, which selects productBatchColumns(), to the products
+    whose column is in values, one row per photo'''
+    return query \
+        .outerjoin(ProductPhoto, Product.id == ProductPhoto.product_id) \
+        .filter(column.in_(values)) \
+        .order_by(Product.id, ProductPhoto.order_placement, ProductPhoto.id)
+
+
+def productBatch(rows, column, values):
+    '''Products serialized from the rows of productBatchQuery, each with
+    its photos, in the order of values; and the values that matched none'''
+    products = {}
+    for row in rows:
+        key = getattr(row, 'product_' + column.key)
+        product = products.get(key)
+        if product is None:
+            product = rowDict(row, PRODUCT_COLUMNS, 'product_')
+            product['photos'] = []
+            products[key] = product
+        if row.photo_id is not None:
+            product['photos'].append(rowDict(row, PHOTO_COLUMNS, 'photo_'))
+    return inRequestOrder(products, values)
+
+
+def categoryBatchQuery(query, column, values):
+    '''Restrict query, which selects CATEGORY_COLUMNS, to the categories
+    whose column is in values'''
+    return query.filter(column.in_(values))
+
+
+def categoryBatch(rows, column, values):
+    '''Categories serialized from the rows of categoryBatchQuery in the
+    order of values; and the values that matched none'''
+    return inRequestOrder(dict((getattr(row, column.key),
+                                rowDict(row, CATEGORY_COLUMNS))
+                               for row in rows), values)
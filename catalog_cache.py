@@ -0,0 +1,181 @@
+'''Caching for catalog data that is read far more often than it changes.
+
+Values live in a per-process LocalCache by default. Setting CACHE_URL to a
+redis:// URL shares them between processes through Redis, so a write in
+one worker invalidates the cached value for all of them.
+
+Everything cached belongs to the database engine it was read through (see
+cacheScope), so apps on different databases in one process, such as tests
+creating an app each, never see each other's values.
+'''
+import os
+import pickle
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from database_setup import Category
+
+# Safety net for lists cached by a process that missed a version change
+CATEGORY_LIST_TIMEOUT = 300
+# Versioned so lists cached before categories had slugs, or without their
+# catalog version, are not read
+CATEGORY_LIST_KEY = 'catalog:categories:3'
+# Values a LocalCache holds before dropping the least recently set ones
+LOCAL_CACHE_MAX_ENTRIES = 10000
+
+
+class LocalCache(object):
+    '''Thread-safe in-process cache holding at most max_entries values'''
+
+    def __init__(self, max_entries=LOCAL_CACHE_MAX_ENTRIES):
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.max_entries = max_entries
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires is not None and expires < time.time():
+                del self._data[key]
+                return None
+            return value
+
+    def set(self, key, value, timeout=None):
+        expires = time.time() + timeout if timeout else None
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, expires)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def getMany(self, keys):
+        return [self.get(key) for key in keys]
+
+    def setMany(self, values, timeout=None):
+        for key, value in values.items():
+            self.set(key, value, timeout)
+
+    def deleteMany(self, keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+
+class RedisCache(object):
+    '''Cache shared between processes through Redis'''
+
+    def __init__(self, url, prefix='store-catalog:'):
+        try:
+            import redis
+        except ImportError:
+            raise ImportError('CACHE_URL is set but the redis package is '
+                              'not installed')
+        self._client = redis.StrictRedis.from_url(url)
+        self._prefix = prefix
+
+    def get(self, key):
+        value = self._client.get(self._prefix + key)
+        if value is None:
+            return None
+        return pickle.loads(value)
+
+    def set(self, key, value, timeout=None):
+        self._client.set(self._prefix + key,
+                         pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+                         ex=timeout)
+
+    def delete(self, key):
+        self._client.delete(self._prefix + key)
+
+    def getMany(self, keys):
+        if not keys:
+            return []
+        return [None if value is None else pickle.loads(value) for value in
+                self._client.mget([self._prefix + key for key in keys])]
+
+    def setMany(self, values, timeout=None):
+        pipeline = self._client.pipeline(transaction=False)
+        for key, value in values.items():
+            pipeline.set(self._prefix + key,
+                         pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+                         ex=timeout)
+        pipeline.execute()
+
+    def deleteMany(self, keys):
+        if keys:
+            self._client.delete(*[self._prefix + key for key in keys])
+
+
+class CacheScope(object):
+    '''The cache and the in-process state kept for one database engine'''
+
+    def __init__(self, engine):
+        url = os.environ.get('CACHE_URL')
+        # Processes on the same database share its Redis entries
+        self.cache = RedisCache(url, 'store-catalog:{0}:{1}/{2}:'.format(
+            engine.url.host or '', engine.url.port or '',
+            engine.url.database or '')) if url else LocalCache()
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def get(self, name, factory):
+        '''The value kept under name, made by factory() on first use'''
+        with self._lock:
+            if name not in self._values:
+                self._values[name] = factory()
+            return self._values[name]
+
+
+_scopes = weakref.WeakKeyDictionary()
+_scopes_lock = threading.Lock()
+
+
+def cacheScope(session):
+    '''Return the CacheScope of the engine session is bound to'''
+    engine = session.get_bind().engine
+    with _scopes_lock:
+        scope = _scopes.get(engine)
+        if scope is None:
+            scope = _scopes[engine] = CacheScope(engine)
+    return scope
+
+
+def getCache(session):
+    '''Return the cache configured by CACHE_URL for session's database'''
+    return cacheScope(session).cache
+
+
+########################################
+# CATEGORY NAVIGATION
+########################################
+
+def categoryList(session):
+    '''Categories ordered by name for the sidebar and dropdowns.
+
+    Returns dicts with id, name, slug and sku_code rather than ORM objects
+    so the list can be shared between requests and processes. The list is
+    cached with the catalog version it was read at, so any committed write,
+    including one from another process or an import, refreshes it.
+    '''
+    # catalog_version reads the version through this module's getCache
+    from catalog_version import catalogVersion
+    cache = getCache(session)
+    version = catalogVersion(session)[0]
+    cached = cache.get(CATEGORY_LIST_KEY)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    rows = session.query(Category.id, Category.name, Category.slug,
+                         Category.sku_code).order_by(Category.name)
+    categories = [{'id': row.id, 'name': row.name, 'slug': row.slug,
+                   'sku_code': row.sku_code} for row in rows]
+    cache.set(CATEGORY_LIST_KEY, (version, categories),
+              CATEGORY_LIST_TIMEOUT)
+    return categories
@@ -0,0 +1,76 @@
+'''Set-based deletes of products and categories.
+
+Deleting products removes their variants, photos and rows with one
+statement per table, whichever products the condition selects, so deleting
+a category with thousands of products takes the same dozen statements as
+deleting one. The caller commits, and the photo files are removed
+afterwards by the worker in batches (see photo_variants.queueFileRemoval).
+'''
+from sqlalchemy import select
+from catalog_version import markCatalogChanged, recordChange, CatalogChange
+from database_setup import Category, Product, ProductPhoto, \
+    ProductPhotoVariant, SkuCounter
+from photo_variants import queueFileRemoval
+
+categories = Category.__table__
+products = Product.__table__
+photos = ProductPhoto.__table__
+variants = ProductPhotoVariant.__table__
+counters = SkuCounter.__table__
+
+
+def recordDeleted(session, model, ids, values=None):
+    for ident in ids:
+        recordChange(session, CatalogChange(
+            model, ident, values(ident) if values else None, True, None))
+
+
+def deleteProductRows(session, condition, upload_folder, variant_folder):
+    '''Delete the products matching condition with their photos'''
+    session.flush()
+    product_ids = select([products.c.id]).where(condition)
+    photo_ids = select([photos.c.id]) \
+        .where(photos.c.product_id.in_(product_ids))
+    deleted_products = dict(
+        (row.id, row.category_id) for row in session.execute(
+            select([products.c.id, products.c.category_id]).where(condition)))
+    deleted_photos = session.execute(
+        select([photos.c.id, photos.c.filename])
+        .where(photos.c.product_id.in_(product_ids))).fetchall()
+    deleted_variants = session.execute(
+        select([variants.c.id, variants.c.filename])
+        .where(variants.c.photo_id.in_(photo_ids))).fetchall()
+    queueFileRemoval(session, [row.filename for row in deleted_photos],
+                     [row.filename for row in deleted_variants],
+                     upload_folder, variant_folder)
+    session.execute(variants.delete().where(
+        variants.c.photo_id.in_(photo_ids)))
+    session.execute(photos.delete().where(
+        photos.c.product_id.in_(product_ids)))
+    session.execute(products.delete().where(condition))
+    recordDeleted(session, ProductPhotoVariant,
+                  [row.id for row in deleted_variants])
+    recordDeleted(session, ProductPhoto, [row.id for row in deleted_photos])
+    recordDeleted(session, Product, deleted_products,
+                  lambda ident: {'category_id': deleted_products[ident]})
+
+
+def purgeProduct(session, product, upload_folder, variant_folder):
+    '''Delete a product and its photos'''
+    deleteProductRows(session, products.c.id == product.id, upload_folder,
+                      variant_folder)
+    markCatalogChanged(session)
+    session.expunge(product)
+
+
+def purgeCategory(session, category, upload_folder, variant_folder):
+    '''Delete a category with its products, photos and SKU counter'''
+    deleteProductRows(session, products.c.category_id == category.id,
+                      upload_folder, variant_folder)
+    session.execute(counters.delete().where(
+        counters.c.category_id == category.id))
+    session.execute(categories.delete().where(
+        categories.c.id == category.id))
+    recordDeleted(session, Category, [category.id])
+    markCatalogChanged(session)
+    session.expunge(category)
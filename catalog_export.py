@@ -0,0 +1,155 @@
+'''Streaming exports of the catalog.
+
+The generators here read plain rows from a server-side cursor and yield the
+response a piece at a time, so memory stays flat however big the catalog
+is and the first byte goes out as soon as the first batch arrives. The
+output has the same shape as the serialize and serializeWithProducts
+properties on the models. NDJSON variants write one category (with its
+products) or one product per line.
+
+rowDict is also the fast path for the JSON endpoints that are not
+streamed: they select these columns as plain rows instead of loading
+model objects to call serialize on them.
+'''
+import decimal
+from database_setup import Category, Product, formatPrice
+from catalog_formats import encodeJSON
+
+# Rows fetched from the server-side cursor per round trip
+STREAM_BATCH_SIZE = 1000
+# Bytes handed to the WSGI server per write
+CHUNK_SIZE = 64 * 1024
+
+CATEGORY_COLUMNS = (Category.id, Category.name, Category.slug,
+                    Category.sku_code)
+PRODUCT_COLUMNS = (Product.id, Product.name, Product.slug, Product.sku,
+                   Product.price, Product.status, Product.description)
+
+
+def streamRows(query):
+    '''Iterate a query in batches without buffering the whole result'''
+    return query.execution_options(stream_results=True) \
+        .yield_per(STREAM_BATCH_SIZE)
+
+
+def encode(data):
+    return encodeJSON(data)
+
+
+def buffered(pieces, size=CHUNK_SIZE):
+    '''Join small pieces into chunks of roughly size bytes'''
+    buf = []
+    length = 0
+    for piece in pieces:
+        buf.append(piece)
+        length += len(piece)
+        if length >= size:
+            yield ''.join(buf)
+            buf = []
+            length = 0
+    if buf:
+        yield ''.join(buf)
+
+
+def jsonValue(value):
+    '''Prices as strings, like Product.serialize'''
+    if isinstance(value, decimal.Decimal):
+        return formatPrice(value)
+    return value
+
+
+def rowDict(row, columns, prefix=''):
+    '''Serialize a row with the same keys as the model serialize property'''
+    return dict((column.key, jsonValue(getattr(row, prefix + column.key)))
+                for column in columns)
+
+
+def categoryColumns():
+    '''Category and product columns labelled for rowDict'''
+    return [column.label('category_' + column.key)
+            for column in CATEGORY_COLUMNS] + \
+        [column.label('product_' + column.key)
+         for column in PRODUCT_COLUMNS]
+
+
+def categoryRows(session, category_ids=None):
+    '''Categories joined to their products, one row per product'''
+    query = session.query(*categoryColumns()) \
+        .outerjoin(Product, Category.id == Product.category_id) \
+        .order_by(Category.id, Product.id)
+    if category_ids is not None:
+        query = query.filter(Category.id.in_(category_ids))
+    return streamRows(query)
+
+
+def productRows(session):
+    return streamRows(session.query(*PRODUCT_COLUMNS).order_by(Product.id))
+
+
+def catalogPieces(session):
+    current_id = None
+    separator = ''
+    yield '{"Category": ['
+    for row in categoryRows(session):
+        if row.category_id != current_id:
+            if current_id is not None:
+                yield ']}, '
+            category = rowDict(row, CATEGORY_COLUMNS, 'category_')
+            # Leave the closing brace off so the products can follow
+            yield encode(category)[:-1] + ', "products": ['
+            current_id = row.category_id
+            separator = ''
+        if row.product_id is not None:
+            yield separator + encode(rowDict(row, PRODUCT_COLUMNS,
+                                             'product_'))
+            separator = ', '
+    if current_id is not None:
+        yield ']}'
+    yield ']}\n'
+
+
+def catalogChunks(session):
+    '''Yield catalog.json incrementally'''
+    return buffered(catalogPieces(session))
+
+
+def categoryDocuments(rows):
+    '''Yield (id, JSON) for each category in rows from categoryRows'''
+    category = None
+    for row in rows:
+        if category is None or category['id'] != row.category_id:
+            if category is not None:
+                yield category['id'], encode(category)
+            category = rowDict(row, CATEGORY_COLUMNS, 'category_')
+            category['products'] = []
+        if row.product_id is not None:
+            category['products'].append(
+                rowDict(row, PRODUCT_COLUMNS, 'product_'))
+    if category is not None:
+        yield category['id'], encode(category)
+
+
+def catalogLines(session):
+    '''Yield one NDJSON line per category with its products'''
+    for category_id, document in categoryDocuments(categoryRows(session)):
+        yield document + '\n'
+
+
+def productsPieces(session):
+    separator = ''
+    yield '{"Product": ['
+    for row in productRows(session):
+        yield separator + encode(rowDict(row, PRODUCT_COLUMNS))
+        separator = ', '
+    yield ']}\n'
+
+
+def productsChunks(session):
+    '''Yield products.json incrementally'''
+    return buffered(productsPieces(session))
+
+
+def productLines(session):
+    '''Yield one NDJSON line per product'''
+    return buffered(encode(rowDict(row, PRODUCT_COLUMNS)) + '\n'
+                    for row in productRows(session))
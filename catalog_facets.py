@@ -0,0 +1,109 @@
+'''Product counts for faceted browsing.
+
+productFacets counts the products of every category by status and by price
+bucket with a single grouped query over products, instead of loading each
+category's products to count them. The counts are cached with the catalog
+version they were computed at, so any committed write to the catalog makes
+the next read compute them again.
+'''
+import decimal
+from sqlalchemy import case, func
+from catalog_cache import getCache
+from catalog_version import catalogVersion
+from database_setup import Product, formatPrice
+
+# Lower bounds of the price buckets; each bucket runs up to the next bound
+# and the last one has no upper bound
+PRICE_BUCKETS = tuple(decimal.Decimal(bound) for bound in
+                      ('0.00', '25.00', '50.00', '100.00', '250.00'))
+CENT = decimal.Decimal('0.01')
+FACETS_KEY = 'catalog:facets'
+# Safety net for counts cached by a process that missed a version change
+FACETS_TIMEOUT = 300
+
+
+def priceBuckets():
+    '''(min_price, max_price) of each bucket, inclusive, as Decimals.
+
+    max_price is None for the last bucket. The bounds can be passed
+    straight to the min_price and max_price arguments of the listings.
+    '''
+    return [(bound, PRICE_BUCKETS[n + 1] - CENT
+             if n + 1 < len(PRICE_BUCKETS) else None)
+            for n, bound in enumerate(PRICE_BUCKETS)]
+
+
+def bucketColumn():
+    '''Index of the price bucket of each product, NULL if it has no price'''
+    return case([(Product.price.is_(None), None)] +
+                [(Product.price < bound, n - 1)
+                 for n, bound in enumerate(PRICE_BUCKETS) if n > 0],
+                else_=len(PRICE_BUCKETS) - 1).label('bucket')
+
+
+def emptyCounts():
+    return {'products': 0, 'active': 0, 'inactive': 0,
+            'price': [0] * len(PRICE_BUCKETS), 'unpriced': 0}
+
+
+def addCounts(counts, status, bucket, count):
+    counts['products'] += count
+    counts['active' if status == 1 else 'inactive'] += count
+    if bucket is None:
+        counts['unpriced'] += count
+    else:
+        counts['price'][bucket] += count
+
+
+def countFacets(session):
+    '''Count products per category, status and price bucket.
+
+    Returns {'total': counts, 'categories': {category_id: counts}}, where
+    counts holds the number of products, of active and inactive ones, of
+    products in each price bucket and of unpriced ones. Categories without
+    products are left out.
+    '''
+    # Grouped by the label so the CASE and its parameters appear once
+    rows = session.query(Product.category_id, Product.status,
+                         bucketColumn(),
+                         func.count(Product.id).label('count')) \
+        .group_by(Product.category_id, Product.status, 'bucket')
+    total = emptyCounts()
+    categories = {}
+    for row in rows:
+        addCounts(total, row.status, row.bucket, row.count)
+        if row.category_id is not None:
+            addCounts(categories.setdefault(row.category_id, emptyCounts()),
+                      row.status, row.bucket, row.count)
+    return {'total': total, 'categories': categories}
+
+
+def productFacets(session):
+    '''Facet counts (see countFacets) for the current catalog version'''
+    cache = getCache(session)
+    version = catalogVersion(session)[0]
+    cached = cache.get(FACETS_KEY)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    facets = countFacets(session)
+    cache.set(FACETS_KEY, (version, facets), FACETS_TIMEOUT)
+    return facets
+
+
+def serializeFacets(facets, categories):
+    '''Facet counts as sent by /facets.json.
+
+    categories is the category list of catalog_cache.categoryList; every
+    category in it is listed, with zero counts if it has no products.
+    '''
+    return {
+        'price_buckets': [{'min_price': formatPrice(low),
+                           'max_price': formatPrice(high)}
+                          for low, high in priceBuckets()],
+        'total': facets['total'],
+        'categories': [dict(facets['categories'].get(category['id'])
+                            or emptyCounts(),
+                            id=category['id'], name=category['name'],
+                            slug=category['slug'])
+                       for category in categories],
+    }
@@ -0,0 +1,62 @@
+'''Encodings for the JSON endpoints.
+
+encodeJSON uses orjson or ujson when one is installed, either of which
+encodes the plain rows of the listings several times faster than the json
+module, and falls back to json otherwise. Clients that prefer
+application/msgpack (or application/x-msgpack) in their Accept header get
+the same documents as MessagePack when the msgpack package is installed,
+which is smaller on the wire and cheaper to encode and decode.
+
+Documents must hold plain JSON types only; prices are formatted as strings
+before they get here (see catalog_export.rowDict and the serialize
+properties).
+'''
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+MSGPACK_TYPES = (MSGPACK, 'application/x-msgpack')
+
+
+def encodeJSON(data):
+    '''data as a compact JSON string with sorted keys'''
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_SORT_KEYS) \
+            .decode('utf-8')
+    if ujson is not None:
+        return ujson.dumps(data, sort_keys=True,
+                           escape_forward_slashes=False)
+    return json.dumps(data, sort_keys=True, separators=(',', ':'))
+
+
+def encodeMsgpack(data):
+    '''data as MessagePack bytes, with every string as a str type'''
+    return msgpack.packb(data, use_bin_type=False)
+
+
+def responseFormat(accept):
+    '''MIME type to answer with for accept (a werkzeug MIMEAccept)'''
+    if msgpack is None:
+        return JSON
+    best = accept.best_match((JSON,) + MSGPACK_TYPES, default=JSON)
+    return MSGPACK if best in MSGPACK_TYPES else JSON
+
+
+def encodeDocument(data, mimetype):
+    '''data encoded as mimetype (from responseFormat), as bytes'''
+    if mimetype == MSGPACK:
+        return encodeMsgpack(data)
+    return (encodeJSON(data) + '\n').encode('utf-8')
@@ -0,0 +1,42 @@
+'''Rendered HTML fragments shared between visitors.
+
+The product grids, the category sidebar and the body of the product page
+look the same to everyone, so they are rendered once and kept in the cache
+(see catalog_cache.py) under the ids of what they show, tagged with the
+catalog version they were rendered at. Any committed write to the catalog
+moves the version, and the next request renders the fragment again.
+
+Anything that depends on who is signed in (the edit and delete buttons,
+"create a new product" links) must be rendered outside the fragments.
+'''
+import hashlib
+import json
+from catalog_cache import getCache
+from catalog_version import catalogVersion
+
+# Safety net for fragments cached by a process that missed a version change
+FRAGMENT_TIMEOUT = 300
+
+
+def fragmentKey(name, ids):
+    '''Cache key for fragment name showing ids, which may be user input'''
+    digest = hashlib.sha1(json.dumps(ids).encode('utf-8')).hexdigest()
+    return 'catalog:fragment:{0}:{1}'.format(name, digest)
+
+
+def cachedFragment(session, name, ids, render):
+    '''Return what render() returns for fragment name showing ids, cached
+    until the catalog version changes.
+
+    render must return something picklable: the HTML and whatever the page
+    needs besides it, such as the next page's cursor.
+    '''
+    cache = getCache(session)
+    version = catalogVersion(session)[0]
+    key = fragmentKey(name, ids)
+    cached = cache.get(key)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    fragment = render()
+    cache.set(key, (version, fragment), FRAGMENT_TIMEOUT)
+    return fragment
@@ -0,0 +1,325 @@
+'''Bulk import of categories, products and photo references.
+
+    python catalog_import.py --user-email owner@example.com \\
+        --categories categories.csv --products products.jsonl \\
+        --photos photos.csv
+
+Files are CSV (with a header row) or JSON Lines (.jsonl/.ndjson), read as a
+stream and inserted in batches, with COPY on PostgreSQL. Columns:
+
+    categories  name, sku_code
+    products    name, category (SKU code), sku, price, status, description
+    photos      product (SKU), filename, order_placement
+
+Products without a sku get the next numbers from their category's SKU
+counter, reserved a block per batch. Each batch is committed together with
+the number of records read from its file, so an interrupted import picks
+up after the last committed batch when run again with the same files.
+'''
+import argparse
+import csv
+import datetime
+import io
+import json
+import os
+import sys
+import time
+from itertools import islice
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from database import databaseUrl
+from database_setup import Category, Product, ProductPhoto, User, \
+    SkuCounter, ImportCheckpoint, parsePrice
+from catalog_skus import reserveNumbers, claimNumber, formatSku, skuNumber
+from catalog_slugs import assignSlugs
+from catalog_version import markCatalogChanged, trackCatalogWrites
+
+BATCH_SIZE = 5000
+
+
+class ImportFailed(Exception):
+    '''A record refers to a category or product that does not exist, or
+    has a malformed value'''
+
+
+########################################
+# READING
+########################################
+
+def readCsv(path):
+    if sys.version_info[0] < 3:
+        with open(path, 'rb') as f:
+            for row in csv.DictReader(f):
+                yield dict((key.decode('utf-8'),
+                            value.decode('utf-8') if value else value)
+                           for key, value in row.items())
+    else:
+        with io.open(path, encoding='utf-8', newline='') as f:
+            for row in csv.DictReader(f):
+                yield row
+
+
+def readJsonLines(path):
+    with io.open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def readRecords(path):
+    '''Yield the records in a CSV or JSON Lines file as dicts'''
+    if path.endswith(('.jsonl', '.ndjson')):
+        return readJsonLines(path)
+    return readCsv(path)
+
+
+def batches(records, size):
+    records = iter(records)
+    while True:
+        batch = list(islice(records, size))
+        if not batch:
+            return
+        yield batch
+
+
+def text(record, key):
+    '''Value of a field with empty strings read as missing'''
+    value = record.get(key)
+    if value is None or value == '':
+        return None
+    return u'{0}'.format(value)
+
+
+def price(record):
+    '''Price of a product record as a Decimal'''
+    try:
+        return parsePrice(text(record, 'price'))
+    except ValueError:
+        raise ImportFailed('Invalid price {0!r} for product {1}'.format(
+            record.get('price'), text(record, 'name')))
+
+
+def status(record):
+    '''Status of a product record as an int, 0 when missing'''
+    try:
+        return int(text(record, 'status') or 0)
+    except ValueError:
+        raise ImportFailed('Invalid status {0!r} for product {1}'.format(
+            record.get('status'), text(record, 'name')))
+
+
+def orderPlacement(record):
+    '''Position of a photo record among its product's photos, 1 when
+    missing'''
+    try:
+        return int(text(record, 'order_placement') or 1)
+    except ValueError:
+        raise ImportFailed('Invalid order_placement {0!r} for photo {1} of '
+                           'product {2}'.format(record.get('order_placement'),
+                                                text(record, 'filename'),
+                                                text(record, 'product')))
+
+
+########################################
+# WRITING
+########################################
+
+def copyValue(value):
+    if value is None:
+        return u'\\N'
+    return u'{0}'.format(value).replace(u'\\', u'\\\\') \
+        .replace(u'\t', u'\\t').replace(u'\n', u'\\n').replace(u'\r', u'\\r')
+
+
+def insertRows(session, table, rows):
+    '''Insert rows (dicts with the same keys) into table'''
+    if not rows:
+        return
+    if session.get_bind().dialect.name != 'postgresql':
+        session.execute(table.insert(), rows)
+        return
+    columns = list(rows[0].keys())
+    data = u''.join(u'\t'.join(copyValue(row[column]) for column in columns)
+                    + u'\n' for row in rows)
+    cursor = session.connection().connection.cursor()
+    cursor.copy_expert('COPY {0} ({1}) FROM STDIN'.format(
+        table.name, ', '.join(columns)), io.BytesIO(data.encode('utf-8')))
+
+
+class Importer(object):
+    '''Insert batches of records, resolving references between them'''
+
+    def __init__(self, session, user_id):
+        self.session = session
+        self.user_id = user_id
+        self.categories = {}
+
+    def categoryId(self, sku_code):
+        if sku_code not in self.categories:
+            self.categories = dict(
+                (row.sku_code, row.id) for row in
+                self.session.query(Category.sku_code, Category.id))
+        if sku_code not in self.categories:
+            raise ImportFailed('Unknown category {0}'.format(sku_code))
+        return self.categories[sku_code]
+
+    def importCategories(self, records):
+        rows = [{'name': text(record, 'name'),
+                 'sku_code': text(record, 'sku_code'),
+                 'user_id': self.user_id} for record in records]
+        assignSlugs(self.session, Category, rows)
+        insertRows(self.session, Category.__table__, rows)
+        ids = [row.id for row in self.session.query(Category.id).filter(
+            Category.sku_code.in_([row['sku_code'] for row in rows]))]
+        insertRows(self.session, SkuCounter.__table__,
+                   [{'category_id': category_id, 'next_number': 1}
+                    for category_id in ids])
+        markCatalogChanged(self.session, Category, ids)
+
+    def importProducts(self, records):
+        rows = []
+        unnumbered = {}
+        highest = {}
+        for record in records:
+            code = text(record, 'category')
+            row = {'name': text(record, 'name'),
+                   'sku': text(record, 'sku'),
+                   'price': price(record),
+                   'status': status(record),
+                   'description': text(record, 'description'),
+                   'category_id': self.categoryId(code),
+                   'user_id': self.user_id}
+            if row['sku'] is None:
+                unnumbered.setdefault(code, []).append(row)
+            elif skuNumber(row['sku']) is not None:
+                highest[row['category_id']] = max(
+                    highest.get(row['category_id'], 0),
+                    skuNumber(row['sku']))
+            rows.append(row)
+        for category_id, number in highest.items():
+            claimNumber(self.session, category_id, number)
+        for code, numbered_rows in unnumbered.items():
+            first = reserveNumbers(self.session, self.categoryId(code),
+                                   len(numbered_rows))
+            for number, row in enumerate(numbered_rows, first):
+                row['sku'] = formatSku(code, number)
+        assignSlugs(self.session, Product, rows)
+        insertRows(self.session, Product.__table__, rows)
+        markCatalogChanged(self.session, Product)
+
+    def importPhotos(self, records):
+        skus = set(text(record, 'product') for record in records)
+        products = dict((row.sku, row.id) for row in self.session.query(
+            Product.sku, Product.id).filter(Product.sku.in_(skus)))
+        rows = []
+        for record in records:
+            sku = text(record, 'product')
+            if sku not in products:
+                raise ImportFailed('Unknown product {0}'.format(sku))
+            rows.append({'product_id': products[sku],
+                         'filename': text(record, 'filename'),
+                         'order_placement': orderPlacement(record)})
+        insertRows(self.session, ProductPhoto.__table__, rows)
+        markCatalogChanged(self.session, ProductPhoto)
+
+
+########################################
+# CHECKPOINTS AND PROGRESS
+########################################
+
+def checkpoint(session, source):
+    row = session.query(ImportCheckpoint).get(source)
+    return row.position if row else 0
+
+
+def saveCheckpoint(session, source, position):
+    row = session.query(ImportCheckpoint).get(source)
+    if row is None:
+        row = ImportCheckpoint(source=source)
+        session.add(row)
+    row.position = position
+    row.updated = datetime.datetime.utcnow()
+
+
+class Progress(object):
+    '''Report rows imported and throughput on stderr'''
+
+    def __init__(self, name, out=sys.stderr):
+        self.name = name
+        self.out = out
+        self.rows = 0
+        self.started = time.time()
+
+    def rate(self):
+        return self.rows / max(time.time() - self.started, 1e-6)
+
+    def update(self, count):
+        self.rows += count
+        self.out.write('{0}: {1} rows ({2:.0f} rows/s)\n'.format(
+            self.name, self.rows, self.rate()))
+
+    def finish(self):
+        self.out.write('{0}: done, {1} rows in {2:.1f}s ({3:.0f} rows/s)\n'
+                       .format(self.name, self.rows,
+                               time.time() - self.started, self.rate()))
+
+
+def importFile(session, insert, path, batch_size=BATCH_SIZE):
+    '''Import the records of path after the last committed batch'''
+    source = os.path.abspath(path)
+    position = checkpoint(session, source)
+    progress = Progress(os.path.basename(path))
+    if position:
+        progress.out.write('{0}: resuming after {1} records\n'.format(
+            progress.name, position))
+    for batch in batches(islice(readRecords(path), position, None),
+                         batch_size):
+        insert(batch)
+        position += len(batch)
+        saveCheckpoint(session, source, position)
+        session.commit()
+        progress.update(len(batch))
+    progress.finish()
+
+
+def ownerId(session, email):
+    '''Id of the user owning imported rows, created if missing'''
+    user = session.query(User).filter_by(email=email).first()
+    if user is None:
+        user = User(name=email, email=email, picture='')
+        session.add(user)
+        session.commit()
+    return user.id
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Bulk import the catalog')
+    parser.add_argument('--user-email', required=True,
+                        help='owner of the imported categories and products')
+    parser.add_argument('--categories', help='CSV or JSON Lines file')
+    parser.add_argument('--products', help='CSV or JSON Lines file')
+    parser.add_argument('--photos', help='CSV or JSON Lines file')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    args = parser.parse_args(argv)
+
+    session_factory = sessionmaker(bind=create_engine(databaseUrl()))
+    trackCatalogWrites(session_factory)
+    session = session_factory()
+    importer = Importer(session, ownerId(session, args.user_email))
+    try:
+        if args.categories:
+            importFile(session, importer.importCategories, args.categories,
+                       args.batch_size)
+        if args.products:
+            importFile(session, importer.importProducts, args.products,
+                       args.batch_size)
+        if args.photos:
+            importFile(session, importer.importPhotos, args.photos,
+                       args.batch_size)
+    except ImportFailed as e:
+        session.rollback()
+        sys.exit('Import stopped: {0}'.format(e))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,235 @@
+'''Per-request instrumentation exposed in the Prometheus text format.
+
+installMetrics() times every request and records, per endpoint, the
+response status and size, how many SQL statements it issued (on engines
+passed to instrumentEngine()) and how long they took, and the time spent
+rendering templates and reading or writing photos (wrap that I/O in
+timed('photo_io')). Statements slower than SLOW_QUERY_SECONDS are logged
+with the endpoint that issued them.
+
+Metrics are kept in each process; with several worker processes each one
+reports its own requests.
+'''
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from flask import g, request, has_request_context, Response
+from jinja2 import Template
+from sqlalchemy import event
+
+log = logging.getLogger(__name__)
+
+DEFAULT_SLOW_QUERY_SECONDS = 0.5
+SLOW_QUERY_LOG_LENGTH = 1000
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                    10.0)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 50, 100, 250)
+SIZE_BUCKETS = (1024, 10240, 102400, 1048576, 10485760, 104857600)
+
+# name: (type, help, histogram buckets)
+METRICS = {
+    'catalog_http_requests_total': (
+        'counter', 'Requests handled, by endpoint, method and status', None),
+    'catalog_http_request_duration_seconds': (
+        'histogram', 'Time to handle a request, including streaming',
+        DURATION_BUCKETS),
+    'catalog_http_response_size_bytes': (
+        'histogram', 'Size of response bodies', SIZE_BUCKETS),
+    'catalog_sql_statements_per_request': (
+        'histogram', 'SQL statements issued by a request', STATEMENT_BUCKETS),
+    'catalog_request_phase_seconds_total': (
+        'counter', 'Time spent in SQL, template rendering and photo I/O',
+        None),
+    'catalog_slow_queries_total': (
+        'counter', 'SQL statements slower than the slow query threshold',
+        None),
+}
+
+
+class Registry(object):
+    '''Thread-safe counters and histograms keyed by name and labels'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+
+    def inc(self, name, labels, amount=1):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, labels, value):
+        key = (name, tuple(sorted(labels.items())))
+        buckets = METRICS[name][2]
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = \
+                    [[0] * len(buckets), 0, 0]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def render(self):
+        '''Return every metric in the Prometheus text format'''
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, (list(value[0]), value[1], value[2]))
+                                for key, value in self._histograms.items())
+        lines = []
+        for name in sorted(METRICS):
+            kind, description, buckets = METRICS[name]
+            lines.append('# HELP {0} {1}'.format(name, description))
+            lines.append('# TYPE {0} {1}'.format(name, kind))
+            for (metric, labels), value in counters:
+                if metric == name:
+                    lines.append(sample(name, labels, value))
+            for (metric, labels), (counts, total, count) in histograms:
+                if metric != name:
+                    continue
+                for bound, bucket_count in zip(buckets, counts):
+                    lines.append(sample(name + '_bucket',
+                                        labels + (('le', bound),),
+                                        bucket_count))
+                lines.append(sample(name + '_bucket',
+                                    labels + (('le', '+Inf'),), count))
+                lines.append(sample(name + '_sum', labels, total))
+                lines.append(sample(name + '_count', labels, count))
+        return '\n'.join(lines) + '\n'
+
+
+def sample(name, labels, value):
+    if labels:
+        name += '{' + ','.join(
+            '{0}="{1}"'.format(key, str(label).replace('\\', '\\\\')
+                               .replace('"', '\\"').replace('\n', '\\n'))
+            for key, label in labels) + '}'
+    return '{0} {1}'.format(name, repr(float(value)) if
+                            isinstance(value, float) else value)
+
+
+registry = Registry()
+
+
+def endpoint():
+    return request.endpoint or 'unmatched'
+
+
+def addPhase(phase, seconds):
+    if has_request_context() and hasattr(g, 'metrics_phases'):
+        g.metrics_phases[phase] = g.metrics_phases.get(phase, 0) + seconds
+
+
+@contextmanager
+def timed(phase):
+    '''Add the time spent in the block to phase for the current request'''
+    started = time.time()
+    try:
+        yield
+    finally:
+        addPhase(phase, time.time() - started)
+
+
+class TimedTemplate(Template):
+    '''Template recording its rendering time as the render phase'''
+
+    def render(self, *args, **kwargs):
+        with timed('render'):
+            return super(TimedTemplate, self).render(*args, **kwargs)
+
+
+def countBytes(chunks, labels):
+    '''Pass a streamed body through, recording its size at the end'''
+    size = 0
+    try:
+        for chunk in chunks:
+            size += len(chunk)
+            yield chunk
+    finally:
+        registry.observe('catalog_http_response_size_bytes', labels, size)
+
+
+def installMetrics(app, slow_query_seconds=None):
+    '''Instrument app and serve the metrics at /metrics.
+
+    SQL is only measured on engines passed to instrumentEngine.
+    '''
+    if slow_query_seconds is None:
+        slow_query_seconds = float(os.environ.get(
+            'SLOW_QUERY_SECONDS', DEFAULT_SLOW_QUERY_SECONDS))
+    app.config.setdefault('SLOW_QUERY_SECONDS', slow_query_seconds)
+    app.jinja_env.template_class = TimedTemplate
+
+    @app.before_request
+    def startRequest():
+        g.metrics_started = time.time()
+        g.metrics_statements = 0
+        g.metrics_phases = {}
+
+    @app.after_request
+    def recordResponse(response):
+        labels = {'endpoint': endpoint()}
+        g.metrics_status = response.status_code
+        if response.content_length is not None:
+            registry.observe('catalog_http_response_size_bytes', labels,
+                             response.content_length)
+        elif response.is_streamed and not response.direct_passthrough:
+            response.response = countBytes(response.response, labels)
+        return response
+
+    # Runs after a streamed response has been sent
+    @app.teardown_request
+    def recordRequest(exception=None):
+        started = getattr(g, 'metrics_started', None)
+        if started is None:
+            return
+        name = endpoint()
+        labels = {'endpoint': name}
+        status = getattr(g, 'metrics_status', 500)
+        registry.inc('catalog_http_requests_total',
+                     {'endpoint': name, 'method': request.method,
+                      'status': status})
+        registry.observe('catalog_http_request_duration_seconds', labels,
+                         time.time() - started)
+        registry.observe('catalog_sql_statements_per_request', labels,
+                         g.metrics_statements)
+        for phase, seconds in g.metrics_phases.items():
+            registry.inc('catalog_request_phase_seconds_total',
+                         {'endpoint': name, 'phase': phase}, seconds)
+        del g.metrics_started
+
+    @app.route('/metrics')
+    def metrics():
+        return Response(registry.render(),
+                        mimetype='text/plain; version=0.0.4')
+
+
+def instrumentEngine(app, engine):
+    '''Time the statements engine runs and log the slow ones'''
+    @event.listens_for(engine, 'before_cursor_execute')
+    def startQuery(conn, cursor, statement, parameters, context,
+                   executemany):
+        if context is not None:
+            context.metrics_started = time.time()
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def endQuery(conn, cursor, statement, parameters, context, executemany):
+        started = getattr(context, 'metrics_started', None)
+        if started is None:
+            return
+        elapsed = time.time() - started
+        in_request = has_request_context() and hasattr(g, 'metrics_phases')
+        if in_request:
+            g.metrics_statements += 1
+            addPhase('sql', elapsed)
+        if elapsed >= app.config['SLOW_QUERY_SECONDS']:
+            name = endpoint() if in_request else 'none'
+            registry.inc('catalog_slow_queries_total', {'endpoint': name})
+            log.warning('Slow query (%.3fs, endpoint %s): %s', elapsed, name,
+                        statement[:SLOW_QUERY_LOG_LENGTH])
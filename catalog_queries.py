@@ -0,0 +1,226 @@
+'''Query layer for the catalog listing pages.
+
+The listing templates touch product.category and product.photos for every
+thumbnail, so the queries here load both relationships up front instead of
+leaving the template to issue a lazy SELECT per product.
+
+Listings are paged with keyset cursors: each page filters on the sort key of
+the last row seen rather than using OFFSET, so page N costs the same as
+page 1.
+'''
+import base64
+import decimal
+import json
+from collections import namedtuple
+from sqlalchemy import event, func, literal, tuple_, Numeric
+from sqlalchemy.orm import joinedload, selectinload
+from flask import g, has_request_context, request
+from database_setup import Product, ProductPhoto, parsePrice
+
+PAGE_SIZE = 48
+MAX_PAGE_SIZE = 500
+
+# Sort keys for paged listings. The id column breaks ties between products
+# sharing a name so cursors stay stable. Each key is the column list of an
+# index (see database_setup.py) so the cursor predicate is a range scan.
+LATEST_ORDER = (Product.id,)
+CATEGORY_ORDER = (Product.category_id, Product.name, Product.id)
+CATEGORY_STATUS_ORDER = (Product.category_id, Product.status, Product.name,
+                         Product.id)
+# The same listings sorted by price (see productFilter)
+PRICE_ORDER = (Product.price, Product.id)
+CATEGORY_PRICE_ORDER = (Product.category_id, Product.price, Product.id)
+CATEGORY_STATUS_PRICE_ORDER = (Product.category_id, Product.status,
+                               Product.price, Product.id)
+
+
+def cursorValue(value):
+    '''Encode prices in cursors as strings'''
+    if isinstance(value, decimal.Decimal):
+        return str(value)
+    raise TypeError('{0!r} is not JSON serializable'.format(value))
+
+
+def encodeCursor(values):
+    '''Encode the sort key of the last row on a page as an opaque cursor'''
+    return base64.urlsafe_b64encode(
+        json.dumps(values, separators=(',', ':'),
+                   default=cursorValue).encode('utf-8')).decode('ascii')
+
+
+def decodeCursor(cursor, columns):
+    '''Decode a cursor, raising ValueError if it does not match columns'''
+    try:
+        values = json.loads(
+            base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+    except (TypeError, UnicodeError, ValueError):
+        raise ValueError('Invalid cursor')
+    if not isinstance(values, list) or len(values) != len(columns):
+        raise ValueError('Invalid cursor')
+    return values
+
+
+def cursorLiteral(value, column):
+    '''Bind a value read from a cursor with the type of its column'''
+    if isinstance(column.type, Numeric) and value is not None:
+        try:
+            value = decimal.Decimal(value)
+        except (decimal.InvalidOperation, TypeError):
+            raise ValueError('Invalid cursor')
+    return literal(value, column.type)
+
+
+def keysetQuery(query, columns, cursor=None, descending=False):
+    '''Order query (a Query or select) by columns, starting after cursor'''
+    if cursor:
+        values = [cursorLiteral(value, column) for value, column in
+                  zip(decodeCursor(cursor, columns), columns)]
+        if descending:
+            query = query.filter(tuple_(*columns) < tuple_(*values))
+        else:
+            query = query.filter(tuple_(*columns) > tuple_(*values))
+    if descending:
+        return query.order_by(*[column.desc() for column in columns])
+    return query.order_by(*columns)
+
+
+def pageRows(rows, columns, limit):
+    '''Split the limit + 1 rows of a keyset query into a page and cursor'''
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encodeCursor(
+            [getattr(rows[-1], column.key) for column in columns])
+    return rows, next_cursor
+
+
+def keysetPage(query, columns, cursor=None, limit=PAGE_SIZE,
+               descending=False):
+    '''Return one page of query ordered by columns and the next cursor.
+
+    The next cursor is None on the last page.
+    '''
+    query = keysetQuery(query, columns, cursor, descending)
+    return pageRows(query.limit(limit + 1).all(), columns, limit)
+
+
+def listingOptions():
+    '''Loader options for products rendered as thumbnails'''
+    return (joinedload(Product.category),
+            selectinload(Product.photos).selectinload(ProductPhoto.variants))
+
+
+def latestProducts(session, cursor=None, limit=PAGE_SIZE):
+    '''Page of products for the "Latest Items" page, newest first'''
+    query = session.query(Product).options(*listingOptions())
+    return keysetPage(query, LATEST_ORDER, cursor, limit, descending=True)
+
+
+def allProducts(session, cursor=None, limit=PAGE_SIZE):
+    '''Page of products for the "All" page, grouped by category'''
+    query = session.query(Product).options(*listingOptions())
+    return keysetPage(query, CATEGORY_ORDER, cursor, limit)
+
+
+def categoryProducts(session, category_id, status, cursor=None,
+                     limit=PAGE_SIZE, product_filter=None):
+    '''Page of products in a category with the given status, by name or
+    as product_filter asks'''
+    query = session.query(Product).options(*listingOptions()) \
+        .filter_by(category_id=category_id, status=status)
+    columns, descending = productOrder(product_filter, CATEGORY_STATUS_ORDER,
+                                       CATEGORY_STATUS_PRICE_ORDER)
+    return keysetPage(filterProducts(query, product_filter), columns, cursor,
+                      limit, descending)
+
+
+def countCategoryProducts(session, category_id, status):
+    '''Number of products in a category with the given status'''
+    return session.query(func.count(Product.id)) \
+        .filter_by(category_id=category_id, status=status).scalar()
+
+
+########################################
+# PRICE FILTERS
+########################################
+
+# Query arguments read by productFilter
+PRODUCT_FILTER_ARGS = ('min_price', 'max_price', 'sort')
+SORTS = ('price', '-price')
+
+ProductFilter = namedtuple('ProductFilter', 'min_price max_price sort')
+NO_FILTER = ProductFilter(None, None, None)
+
+
+def productFilter(args):
+    '''Read the min_price, max_price and sort (price or -price) arguments.
+
+    Raises ValueError if they are malformed.
+    '''
+    sort = args.get('sort') or None
+    if sort is not None and sort not in SORTS:
+        raise ValueError('Invalid sort {0}'.format(sort))
+    return ProductFilter(parsePrice(args.get('min_price')),
+                         parsePrice(args.get('max_price')), sort)
+
+
+def filterProducts(query, product_filter):
+    '''Restrict query (a Query or select) to the products in the price range.
+
+    Products without a price are left out when filtering or sorting by
+    price, as they have no place in the order.
+    '''
+    if product_filter is None or product_filter == NO_FILTER:
+        return query
+    if product_filter.min_price is not None:
+        query = query.filter(Product.price >= product_filter.min_price)
+    if product_filter.max_price is not None:
+        query = query.filter(Product.price <= product_filter.max_price)
+    return query.filter(Product.price.isnot(None))
+
+
+def productOrder(product_filter, default_order, price_order):
+    '''Return the keyset columns and direction product_filter asks for'''
+    if product_filter is None or product_filter.sort is None:
+        return default_order, False
+    return price_order, product_filter.sort == '-price'
+
+
+########################################
+# STATEMENT BUDGETS
+########################################
+
+def installStatementBudgets(app, budgets):
+    '''Check the SQL statements issued by each request.
+
+    budgets maps endpoint names to the maximum number of statements the
+    route may issue. When app.config['ASSERT_STATEMENT_BUDGETS'] is set
+    (e.g. in tests) a request going over its budget raises AssertionError
+    listing the statements it ran. Statements are only counted on engines
+    passed to countStatements.
+    '''
+    @app.before_request
+    def startStatementCount():
+        g.sql_statements = []
+
+    @app.after_request
+    def checkStatementBudget(response):
+        if not app.config.get('ASSERT_STATEMENT_BUDGETS'):
+            return response
+        budget = budgets.get(request.endpoint)
+        statements = getattr(g, 'sql_statements', [])
+        if budget is not None and len(statements) > budget:
+            raise AssertionError(
+                '{0} issued {1} SQL statements, budget is {2}:\n{3}'.format(
+                    request.endpoint, len(statements), budget,
+                    '\n'.join(statements)))
+        return response
+
+
+def countStatements(engine):
+    '''Record the statements engine runs during a request'''
+    @event.listens_for(engine, 'before_cursor_execute')
+    def countStatement(conn, cursor, statement, parameters, context,
+                       executemany):
+        if has_request_context() and hasattr(g, 'sql_statements'):
+            g.sql_statements.append(statement)
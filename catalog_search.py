@@ -0,0 +1,214 @@
+'''Product search over name, description and SKU.
+
+On PostgreSQL searches use the full-text and trigram indexes created in
+database_setup.py. Other databases fall back to an InvertedIndex held in
+each process for each engine (see catalog_cache.cacheScope): it is
+built from the products table on the first search and then kept up to
+date from committed product writes (see catalog_version.onCatalogCommit),
+so a query only touches the posting lists of its own terms. Writes made by
+other processes are only seen as a new catalog version, upon which the
+index is rebuilt.
+
+Every term must match. The last term also matches as a prefix so results
+can be shown while the user is typing.
+'''
+import bisect
+import heapq
+import re
+import threading
+from sqlalchemy import func, literal_column, or_
+from catalog_cache import cacheScope
+from catalog_export import streamRows
+from catalog_queries import listingOptions
+from catalog_version import catalogVersion, onCatalogCommit
+from database_setup import Product, PRODUCT_SEARCH_DOCUMENT
+
+SEARCH_LIMIT = 48
+# Prefixes shorter than this match exact terms only
+MIN_PREFIX_LENGTH = 2
+
+TOKEN_PATTERN = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+    '''Split text into lower-case search terms'''
+    return TOKEN_PATTERN.findall(text.lower()) if text else []
+
+
+def documentTerms(name, description, sku):
+    '''Terms indexed for a product'''
+    terms = set(tokenize(name))
+    terms.update(tokenize(description))
+    terms.update(tokenize(sku))
+    return terms
+
+
+class InvertedIndex(object):
+    '''Map of search terms to the ids of the products containing them'''
+
+    def __init__(self):
+        self._postings = {}
+        self._terms = {}
+        self._vocabulary = []
+        self._lock = threading.RLock()
+        self.ready = False
+        # Catalog version up to which every commit has been applied
+        self.version = None
+
+    def add(self, product_id, terms):
+        with self._lock:
+            self.remove(product_id)
+            self._terms[product_id] = frozenset(terms)
+            for term in terms:
+                posting = self._postings.get(term)
+                if posting is None:
+                    posting = self._postings[term] = set()
+                    bisect.insort(self._vocabulary, term)
+                posting.add(product_id)
+
+    def remove(self, product_id):
+        with self._lock:
+            for term in self._terms.pop(product_id, ()):
+                posting = self._postings[term]
+                posting.discard(product_id)
+                if not posting:
+                    del self._postings[term]
+                    del self._vocabulary[
+                        bisect.bisect_left(self._vocabulary, term)]
+
+    def clear(self):
+        with self._lock:
+            self._postings = {}
+            self._terms = {}
+            self._vocabulary = []
+            self.ready = False
+            self.version = None
+
+    def prefixMatches(self, prefix):
+        '''Union of the postings of every term starting with prefix'''
+        matches = set()
+        start = bisect.bisect_left(self._vocabulary, prefix)
+        for term in self._vocabulary[start:]:
+            if not term.startswith(prefix):
+                break
+            matches.update(self._postings[term])
+        return matches
+
+    def search(self, terms, limit):
+        '''Ids of the newest products matching every term'''
+        if not terms:
+            return []
+        last = terms[-1]
+        prefix = len(last) >= MIN_PREFIX_LENGTH
+        exact = terms[:-1] if prefix else terms
+        with self._lock:
+            if exact:
+                # Intersect starting from the rarest term, then check the
+                # few survivors for the prefix instead of expanding it
+                postings = sorted((self._postings.get(term, set())
+                                   for term in exact), key=len)
+                matches = set(postings[0])
+                for posting in postings[1:]:
+                    if not matches:
+                        break
+                    matches.intersection_update(posting)
+                if prefix:
+                    matches = set(
+                        product_id for product_id in matches
+                        if any(term.startswith(last)
+                               for term in self._terms[product_id]))
+            else:
+                matches = self.prefixMatches(last)
+            return heapq.nlargest(limit, matches)
+
+
+def searchIndex(session):
+    '''The in-process index of session's database'''
+    return cacheScope(session).get('search', InvertedIndex)
+
+
+def buildIndex(session, version):
+    '''Load every product into the in-process index unless it is up to
+    date with version'''
+    index = searchIndex(session)
+    with index._lock:
+        if index.ready and index.version == version:
+            return
+        # Other processes may have written since it was built
+        index.clear()
+        rows = streamRows(session.query(Product.id, Product.name,
+                                        Product.description, Product.sku))
+        for row in rows:
+            index.add(row.id, documentTerms(row.name, row.description,
+                                            row.sku))
+        index.ready = True
+        index.version = version
+
+
+@onCatalogCommit
+def updateIndex(session, changes, version):
+    '''Apply committed product writes to the in-process index'''
+    index = searchIndex(session)
+    # Holding the lock makes a write committed during a build wait for it
+    # and then apply over whatever the build read
+    with index._lock:
+        if not index.ready:
+            return
+        for change in changes:
+            if change.model is not Product:
+                continue
+            if change.id is None:
+                # Bulk writes; rebuild on the next search
+                index.clear()
+                return
+            if change.deleted:
+                index.remove(change.id)
+            elif change.values is not None and (
+                    # Columns an insert left unset are NULL
+                    change.previous is None or
+                    all(key in change.values
+                        for key in ('name', 'description', 'sku'))):
+                index.add(change.id, documentTerms(
+                    change.values.get('name'),
+                    change.values.get('description'),
+                    change.values.get('sku')))
+            else:
+                # Unknown rows or columns; rebuild on the next search
+                index.clear()
+                return
+        if index.version is not None and index.version == version - 1:
+            index.version = version
+
+
+def postgresqlSearch(session, text, terms, limit):
+    '''Ids of matching products using the PostgreSQL indexes'''
+    tsquery = func.to_tsquery(
+        'simple', ' & '.join(terms[:-1] + [terms[-1] + ':*']))
+    document = literal_column(PRODUCT_SEARCH_DOCUMENT)
+    sku_pattern = text.strip().replace('\\', '\\\\') \
+        .replace('%', '\\%').replace('_', '\\_') + '%'
+    rows = session.query(Product.id) \
+        .filter(or_(document.op('@@')(tsquery),
+                    Product.sku.ilike(sku_pattern, escape='\\'))) \
+        .order_by(func.ts_rank(document, tsquery).desc(),
+                  Product.id.desc()) \
+        .limit(limit)
+    return [row.id for row in rows]
+
+
+def searchProducts(session, text, limit=SEARCH_LIMIT):
+    '''Products matching text, loaded for rendering as thumbnails'''
+    terms = tokenize(text)
+    if not terms:
+        return []
+    if session.get_bind().dialect.name == 'postgresql':
+        ids = postgresqlSearch(session, text, terms, limit)
+    else:
+        buildIndex(session, catalogVersion(session)[0])
+        ids = searchIndex(session).search(terms, limit)
+    if not ids:
+        return []
+    products = session.query(Product).options(*listingOptions()) \
+        .filter(Product.id.in_(ids)).all()
+    position = dict((product_id, i) for i, product_id in enumerate(ids))
+    return sorted(products, key=lambda product: position[product.id])
@@ -0,0 +1,96 @@
+'''Per-category SKU allocation.
+
+Each category has a row in sku_counters holding the next SKU number to
+hand out. Reserving numbers is a single-row UPDATE, so concurrent writers
+queue on the row lock instead of racing to read the highest SKU, and a bulk
+import can reserve a whole block of numbers in one statement.
+'''
+import re
+from sqlalchemy import select
+from sqlalchemy.dialects import postgresql
+from database_setup import Product, SkuCounter
+
+counters = SkuCounter.__table__
+
+SKU_PATTERN = re.compile(r'^(.*)-(\d+)$')
+
+
+def skuNumber(sku):
+    '''Return the number at the end of a SKU such as HT-10, or None'''
+    match = SKU_PATTERN.match(sku or '')
+    return int(match.group(2)) if match else None
+
+
+def formatSku(sku_code, number):
+    return '{0}-{1}'.format(sku_code, number)
+
+
+def nextNumberFromProducts(session, category_id):
+    '''First number above every numbered SKU already in the category'''
+    numbers = [skuNumber(row.sku) for row in
+               session.query(Product.sku).filter_by(category_id=category_id)]
+    return max([number for number in numbers if number is not None] or
+               [0]) + 1
+
+
+def createCounter(session, category_id):
+    '''Create the counter row for a category that does not have one yet'''
+    values = {'category_id': category_id,
+              'next_number': nextNumberFromProducts(session, category_id)}
+    # A concurrent request may create the row first; keep whichever wins
+    dialect = session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        statement = postgresql.insert(counters).values(**values) \
+            .on_conflict_do_nothing()
+    elif dialect == 'sqlite':
+        statement = counters.insert().prefix_with('OR IGNORE').values(**values)
+    else:
+        statement = counters.insert().values(**values)
+    session.execute(statement)
+
+
+def reserveNumbers(session, category_id, count=1):
+    '''Reserve count consecutive SKU numbers and return the first one'''
+    increment = counters.update() \
+        .where(counters.c.category_id == category_id) \
+        .values(next_number=counters.c.next_number + count)
+    if session.get_bind().dialect.name == 'postgresql':
+        next_number = session.execute(
+            increment.returning(counters.c.next_number)).scalar()
+    else:
+        # The UPDATE holds the write lock until commit, so reading the row
+        # back in the same transaction sees only our own increment
+        if session.execute(increment).rowcount:
+            next_number = session.execute(
+                select([counters.c.next_number])
+                .where(counters.c.category_id == category_id)).scalar()
+        else:
+            next_number = None
+    if next_number is None:
+        createCounter(session, category_id)
+        return reserveNumbers(session, category_id, count)
+    return next_number - count
+
+
+def reserveSkus(session, category, count=1):
+    '''Reserve count new SKUs in category'''
+    first = reserveNumbers(session, category.id, count)
+    return [formatSku(category.sku_code, number)
+            for number in range(first, first + count)]
+
+
+def claimNumber(session, category_id, number):
+    '''Make sure the counter for category_id will not hand out number'''
+    if session.query(SkuCounter).get(category_id) is None:
+        createCounter(session, category_id)
+    session.execute(counters.update()
+                    .where(counters.c.category_id == category_id)
+                    .where(counters.c.next_number <= number)
+                    .values(next_number=number + 1))
+
+
+def claimSku(session, category, sku):
+    '''Keep the counter ahead of a SKU entered by hand in category'''
+    number = skuNumber(sku)
+    if number is not None:
+        claimNumber(session, category.id, number)
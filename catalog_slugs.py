@@ -0,0 +1,179 @@
+'''URL slugs for categories and products.
+
+Every category and product has a unique slug made from its name, e.g.
+"Grey Crest" -> grey-crest, with -2, -3... appended when another row of the
+same kind already has it. Sessions passed to trackSlugs fill in the slug of
+new rows and of renamed ones when they flush; bulk inserts call
+assignSlugs on their rows instead.
+
+findCategory and findProduct resolve the slug in a URL. Each process keeps
+a bounded LRU map of slug -> id for each engine (see
+catalog_cache.cacheScope), so a slug seen before costs one primary
+key lookup (none if the row is already in the session). The id is only a
+hint: the row is checked to still have the slug, and the entry is dropped
+when it does not, so renames and deletes made by other processes are
+picked up on the next request.
+'''
+import re
+import threading
+import unicodedata
+from collections import OrderedDict
+from sqlalchemy import event, inspect, or_, select
+from catalog_cache import cacheScope
+from database_setup import Category, Product
+
+SLUG_MODELS = (Category, Product)
+# Leaves room for a -N suffix within the slug columns
+MAX_SLUG_LENGTH = 90
+SLUG_CACHE_SIZE = 10000
+# Slug of a name with no letters or digits in it
+DEFAULT_SLUG = 'item'
+
+
+def slugify(name):
+    '''Lower case ASCII letters and digits of name, joined by hyphens'''
+    text = unicodedata.normalize('NFKD', u'{0}'.format(name or u''))
+    text = text.encode('ascii', 'ignore').decode('ascii').lower()
+    slug = re.sub(r'[^a-z0-9]+', '-', text).strip('-')
+    return slug[:MAX_SLUG_LENGTH].rstrip('-') or DEFAULT_SLUG
+
+
+def takenSlugs(session, table, base, exclude_id=None):
+    '''Slugs in table that are base or base with a suffix'''
+    # base only holds [a-z0-9-], so it needs no escaping in LIKE
+    query = select([table.c.slug]).where(or_(
+        table.c.slug == base, table.c.slug.like(base + '-%')))
+    if exclude_id is not None:
+        query = query.where(table.c.id != exclude_id)
+    return set(row.slug for row in session.execute(query))
+
+
+def freeSlug(base, used):
+    '''base, or base-2, base-3... whichever is first not in used'''
+    slug = base
+    number = 1
+    while slug in used:
+        number += 1
+        slug = '{0}-{1}'.format(base, number)
+    return slug
+
+
+def uniqueSlug(session, model, name, exclude_id=None, used=()):
+    '''Slug for name that no other row of model (nor one in used) has'''
+    base = slugify(name)
+    return freeSlug(base, takenSlugs(session, model.__table__, base,
+                                     exclude_id) | set(used))
+
+
+def assignSlugs(session, model, rows):
+    '''Set 'slug' in each row dict to be inserted into model's table.
+
+    Takes one query for the whole batch, plus one for each name that is
+    already taken.
+    '''
+    table = model.__table__
+    bases = [slugify(row['name']) for row in rows]
+    used = set(row.slug for row in session.execute(
+        select([table.c.slug]).where(table.c.slug.in_(set(bases)))))
+    checked = set()
+    for row, base in zip(rows, bases):
+        if base in used and base not in checked:
+            used.update(takenSlugs(session, table, base))
+            checked.add(base)
+        row['slug'] = freeSlug(base, used)
+        used.add(row['slug'])
+
+
+def beforeFlush(session, flush_context, instances):
+    used = dict((model, set()) for model in SLUG_MODELS)
+    for obj in list(session.new) + list(session.dirty):
+        if not isinstance(obj, SLUG_MODELS):
+            continue
+        state = inspect(obj)
+        if state.persistent:
+            # Renamed rows get a new slug unless one was set explicitly
+            if not state.attrs.name.history.has_changes() or \
+                    state.attrs.slug.history.has_changes():
+                continue
+        elif obj.slug is not None:
+            continue
+        model = type(obj)
+        obj.slug = uniqueSlug(session, model, obj.name,
+                              obj.id if state.persistent else None,
+                              used[model])
+        used[model].add(obj.slug)
+
+
+def trackSlugs(session_factory):
+    '''Give new and renamed rows from session_factory's sessions a slug'''
+    event.listen(session_factory, 'before_flush', beforeFlush)
+
+
+########################################
+# RESOLVING SLUGS
+########################################
+
+class SlugCache(object):
+    '''Thread-safe LRU map of slug -> id holding up to max_entries'''
+
+    def __init__(self, max_entries=SLUG_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, slug):
+        with self.lock:
+            entity_id = self.entries.pop(slug, None)
+            if entity_id is not None:
+                self.entries[slug] = entity_id
+            return entity_id
+
+    def set(self, slug, entity_id):
+        with self.lock:
+            self.entries.pop(slug, None)
+            self.entries[slug] = entity_id
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def delete(self, slug):
+        with self.lock:
+            self.entries.pop(slug, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+def slugIds(session, model):
+    '''The SlugCache of model for session's database'''
+    return cacheScope(session).get('slugs', lambda: dict(
+        (slug_model, SlugCache()) for slug_model in SLUG_MODELS))[model]
+
+
+def findBySlug(session, model, slug):
+    '''The row of model with slug, or None.
+
+    Falls back to the first row named slug, so URLs made before slugs
+    existed keep working; those are not cached.
+    '''
+    cache = slugIds(session, model)
+    entity_id = cache.get(slug)
+    if entity_id is not None:
+        entity = session.query(model).get(entity_id)
+        if entity is not None and entity.slug == slug:
+            return entity
+        cache.delete(slug)
+    entity = session.query(model).filter_by(slug=slug).first()
+    if entity is not None:
+        cache.set(slug, entity.id)
+        return entity
+    return session.query(model).filter_by(name=slug) \
+        .order_by(model.id).first()
+
+
+def findCategory(session, slug):
+    return findBySlug(session, Category, slug)
+
+
+def findProduct(session, slug):
+    return findBySlug(session, Product, slug)
@@ -0,0 +1,157 @@
+'''Pre-serialized catalog.json, maintained incrementally.
+
+The cache holds the JSON of each category with its products (the shape of
+Category.serializeWithProducts) and the whole document joined from them,
+tagged with the catalog version it was built at. Committed writes (see
+catalog_version.onCatalogCommit) drop the entries of the categories they
+touched, so /catalog.json is a cache read and after a write only the
+changed categories are queried again.
+
+With the default per-process cache a process cannot see the entries other
+processes drop. It keeps using its entries only while it has seen every
+commit since they were built, and rebuilds them all otherwise.
+
+The MessagePack form of the document is converted from the JSON one and
+cached beside it, once per catalog version.
+'''
+import json
+import threading
+from catalog_cache import cacheScope, getCache, LocalCache
+from catalog_export import categoryRows, categoryDocuments
+from catalog_formats import encodeMsgpack
+from catalog_version import catalogVersion, onCatalogCommit
+from database_setup import Category, Product
+
+# Safety net for entries built just before a concurrent invalidation
+SNAPSHOT_TIMEOUT = 300
+SNAPSHOT_KEY = 'catalog:snapshot'
+PACKED_SNAPSHOT_KEY = 'catalog:snapshot:msgpack'
+CATEGORY_IDS_KEY = 'catalog:snapshot:categories'
+GENERATION_KEY = 'catalog:snapshot:generation'
+# Rebuild everything rather than query more categories than this by id
+MAX_PARTIAL_REBUILD = 500
+
+
+class SeenVersion(object):
+    '''Catalog version up to which this process has seen every commit'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = None
+
+
+def seenVersion(session):
+    return cacheScope(session).get('snapshot', SeenVersion)
+
+
+def categoryKey(generation, category_id):
+    return 'catalog:snapshot:{0}:{1}'.format(generation, category_id)
+
+
+def changedCategories(change):
+    '''Categories whose products a product change touched, or None'''
+    values = change.values or {}
+    if change.id is None or 'category_id' not in values:
+        return None
+    categories = set([values['category_id']])
+    if change.previous and 'category_id' in change.previous:
+        categories.add(change.previous['category_id'])
+    # Form data can leave the id as a string until the row is reloaded
+    return set(int(category_id) for category_id in categories
+               if category_id is not None)
+
+
+@onCatalogCommit
+def updateSnapshot(session, changes, version):
+    '''Drop the cached categories a commit wrote'''
+    categories = set()
+    everything = False
+    category_set_changed = False
+    for change in changes:
+        if change.model is Category:
+            category_set_changed = True
+            if change.id is None:
+                everything = True
+            else:
+                categories.add(change.id)
+        elif change.model is Product:
+            touched = changedCategories(change)
+            if touched is None:
+                everything = True
+            else:
+                categories.update(touched)
+    cache = getCache(session)
+    seen = seenVersion(session)
+    with seen.lock:
+        generation = cache.get(GENERATION_KEY) or 0
+        if everything:
+            cache.set(GENERATION_KEY, generation + 1)
+        elif categories:
+            cache.deleteMany([categoryKey(generation, category_id)
+                              for category_id in categories])
+        if category_set_changed:
+            cache.delete(CATEGORY_IDS_KEY)
+        cache.delete(SNAPSHOT_KEY)
+        if seen.version is not None and seen.version == version - 1:
+            seen.version = version
+
+
+def categoryParts(session, version):
+    '''JSON of every category, in id order, built where not cached'''
+    cache = getCache(session)
+    seen = seenVersion(session)
+    with seen.lock:
+        if isinstance(cache, LocalCache) and seen.version != version:
+            # Other processes may have written since the entries were
+            # built; start a new generation
+            cache.set(GENERATION_KEY, (cache.get(GENERATION_KEY) or 0) + 1)
+            cache.delete(CATEGORY_IDS_KEY)
+            seen.version = version
+        generation = cache.get(GENERATION_KEY) or 0
+    category_ids = cache.get(CATEGORY_IDS_KEY)
+    if category_ids is None:
+        category_ids = [row.id for row in
+                        session.query(Category.id).order_by(Category.id)]
+        cache.set(CATEGORY_IDS_KEY, category_ids, SNAPSHOT_TIMEOUT)
+    parts = cache.getMany([categoryKey(generation, category_id)
+                           for category_id in category_ids])
+    missing = [category_id for category_id, part in
+               zip(category_ids, parts) if part is None]
+    if not missing:
+        return parts
+    rows = categoryRows(session, missing if
+                        len(missing) <= MAX_PARTIAL_REBUILD else None)
+    built = dict(categoryDocuments(rows))
+    cache.setMany(dict((categoryKey(generation, category_id),
+                        built[category_id])
+                       for category_id in missing if category_id in built),
+                  SNAPSHOT_TIMEOUT)
+    # A category deleted since the id list was read is left out
+    return [part if part is not None else built.get(category_id)
+            for category_id, part in zip(category_ids, parts)
+            if part is not None or category_id in built]
+
+
+def catalogDocument(session):
+    '''Return catalog.json as a string'''
+    cache = getCache(session)
+    version = catalogVersion(session)[0]
+    snapshot = cache.get(SNAPSHOT_KEY)
+    if snapshot is not None and snapshot[0] == version:
+        return snapshot[1]
+    document = '{"Category": [' + \
+        ', '.join(categoryParts(session, version)) + ']}\n'
+    cache.set(SNAPSHOT_KEY, (version, document), SNAPSHOT_TIMEOUT)
+    return document
+
+
+def packedCatalogDocument(session):
+    '''Return catalog.json as MessagePack bytes'''
+    cache = getCache(session)
+    version = catalogVersion(session)[0]
+    packed = cache.get(PACKED_SNAPSHOT_KEY)
+    if packed is not None and packed[0] == version:
+        return packed[1]
+    document = encodeMsgpack(json.loads(catalogDocument(session)))
+    cache.set(PACKED_SNAPSHOT_KEY, (version, document), SNAPSHOT_TIMEOUT)
+    return document
@@ -0,0 +1,159 @@
+'''Catalog version marker used for conditional JSON responses.
+
+The catalog_version row is bumped in the same transaction as any write to a
+category, product or photo, so the marker is correct however many
+processes serve the app. After the commit the new version is published to
+the cache (see catalog_cache.py) and reads are answered from there, falling
+back to the row at most every CATALOG_VERSION_TTL seconds.
+
+Modules that keep derived data in memory register with onCatalogCommit to
+hear about each committed write.
+'''
+import datetime
+from collections import namedtuple
+from sqlalchemy import event, inspect, select
+from catalog_cache import getCache
+from database_setup import Category, Product, ProductPhoto, \
+    ProductPhotoVariant, CatalogVersion
+
+CATALOG_VERSION_KEY = 'catalog:version'
+CATALOG_VERSION_TTL = 2
+CATALOG_MODELS = (Category, Product, ProductPhoto, ProductPhotoVariant)
+
+version_table = CatalogVersion.__table__
+
+# A committed write. values holds the column values flushed for an insert
+# or update, or the last known values of a deleted row, and is None when
+# they are not known. previous holds the old values of the columns an
+# update changed, and is None for inserts and deletes. id is None when the
+# rows written are unknown (bulk and Core statements), in which case
+# listeners should refresh everything they hold for model.
+CatalogChange = namedtuple('CatalogChange', 'model id values deleted previous')
+
+_commit_listeners = []
+
+
+def onCatalogCommit(listener):
+    '''Call listener(session, changes, version) after each commit of
+    catalog data.
+
+    version is the catalog version the commit produced. Listeners keep
+    what they hold per database, see catalog_cache.cacheScope(session).
+    '''
+    _commit_listeners.append(listener)
+    return listener
+
+
+def recordChange(session, change):
+    session.info.setdefault('catalog_changes', []).append(change)
+
+
+def markCatalogChanged(session, model=None, ids=None, deleted=False):
+    '''Bump the catalog version within the session's transaction.
+
+    Flushed ORM writes are detected automatically; call this after writing
+    catalog tables with bulk or Core statements, passing the model and ids
+    written when they are known.
+    '''
+    if model is not None:
+        for ident in (ids if ids is not None else [None]):
+            recordChange(session, CatalogChange(model, ident, None, deleted,
+                                                None))
+    now = datetime.datetime.utcnow().replace(microsecond=0)
+    session.execute(version_table.update()
+                    .where(version_table.c.id == 1)
+                    .values(version=version_table.c.version + 1,
+                            modified=now))
+    row = session.execute(select([version_table.c.version,
+                                  version_table.c.modified])
+                          .where(version_table.c.id == 1)).first()
+    session.info['catalog_version'] = (row.version, row.modified)
+
+
+def catalogVersion(session):
+    '''Return (version, last modified) for the catalog'''
+    cache = getCache(session)
+    marker = cache.get(CATALOG_VERSION_KEY)
+    if marker is None:
+        row = session.execute(select([version_table.c.version,
+                                      version_table.c.modified])
+                              .where(version_table.c.id == 1)).first()
+        marker = (row.version, row.modified)
+        cache.set(CATALOG_VERSION_KEY, marker, CATALOG_VERSION_TTL)
+    return marker
+
+
+def flushedChange(obj, deleted, updated):
+    state = inspect(obj)
+    # Read the instance dict so unloaded attributes are left out rather
+    # than loaded in the middle of the flush
+    values = dict((attr.key, state.dict[attr.key])
+                  for attr in state.mapper.column_attrs
+                  if attr.key in state.dict)
+    previous = None
+    if updated:
+        # Attribute history still holds the pre-flush values here
+        previous = {}
+        for attr in state.mapper.column_attrs:
+            replaced = state.attrs[attr.key].history.deleted
+            if replaced:
+                previous[attr.key] = replaced[0]
+    # Pending rows get their identity only after the flush, but their
+    # primary key is already set on the instance
+    ident = state.identity[0] if state.identity else \
+        state.mapper.primary_key_from_instance(obj)[0]
+    return CatalogChange(type(obj), ident, values, deleted, previous)
+
+
+def afterFlush(session, flush_context):
+    changed = False
+    for obj in session.new:
+        if isinstance(obj, CATALOG_MODELS):
+            recordChange(session, flushedChange(obj, False, False))
+            changed = True
+    for obj in session.dirty:
+        if isinstance(obj, CATALOG_MODELS):
+            recordChange(session, flushedChange(obj, False, True))
+            changed = True
+    for obj in session.deleted:
+        if isinstance(obj, CATALOG_MODELS):
+            recordChange(session, flushedChange(obj, True, False))
+            changed = True
+    if changed:
+        markCatalogChanged(session)
+
+
+def afterBulkUpdate(context):
+    if issubclass(context.mapper.class_, CATALOG_MODELS):
+        markCatalogChanged(context.session, context.mapper.class_)
+
+
+def afterBulkDelete(context):
+    if issubclass(context.mapper.class_, CATALOG_MODELS):
+        markCatalogChanged(context.session, context.mapper.class_,
+                           deleted=True)
+
+
+def afterCommit(session):
+    marker = session.info.pop('catalog_version', None)
+    changes = session.info.pop('catalog_changes', [])
+    if marker is not None:
+        getCache(session).set(CATALOG_VERSION_KEY, marker,
+                              CATALOG_VERSION_TTL)
+    if changes and marker is not None:
+        for listener in _commit_listeners:
+            listener(session, changes, marker[0])
+
+
+def afterRollback(session):
+    session.info.pop('catalog_version', None)
+    session.info.pop('catalog_changes', None)
+
+
+def trackCatalogWrites(session_factory):
+    '''Keep the catalog version up to date for sessions from session_factory'''
+    event.listen(session_factory, 'after_flush', afterFlush)
+    event.listen(session_factory, 'after_bulk_update', afterBulkUpdate)
+    event.listen(session_factory, 'after_bulk_delete', afterBulkDelete)
+    event.listen(session_factory, 'after_commit', afterCommit)
+    event.listen(session_factory, 'after_rollback', afterRollback)
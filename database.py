@@ -0,0 +1,69 @@
+'''Database connection settings shared by the application and scripts.
+
+Settings are read from the environment:
+
+    DATABASE_URL            SQLAlchemy URL (default postgresql+psycopg2:///mystore)
+    DATABASE_POOL_SIZE      connections kept open per process (default 5)
+    DATABASE_MAX_OVERFLOW   extra connections allowed under load (default 10)
+    DATABASE_POOL_TIMEOUT   seconds to wait for a free connection (default 30)
+    DATABASE_POOL_RECYCLE   seconds before a connection is replaced (default 1800)
+    DATABASE_POOL_PRE_PING  test connections before use, 1 or 0 (default 1)
+
+Each process should size its pool for the number of threads serving
+requests, e.g. pool size 4 for a worker running 4 threads. The asyncio
+engine used by async_api.py shares its pool between all the requests of
+the process, so size it for the queries they run at once.
+'''
+import os
+from sqlalchemy import create_engine
+from sqlalchemy.engine.url import make_url
+
+DEFAULT_DATABASE_URL = 'postgresql+psycopg2:///mystore'
+
+
+def databaseUrl(environ=os.environ):
+    '''Return the configured database URL'''
+    return environ.get('DATABASE_URL', DEFAULT_DATABASE_URL)
+
+
+def poolSettings(url, environ=os.environ):
+    '''Return connection pool arguments for create_engine'''
+    settings = {
+        'pool_pre_ping': environ.get('DATABASE_POOL_PRE_PING', '1') == '1',
+        'pool_recycle': int(environ.get('DATABASE_POOL_RECYCLE', 1800)),
+    }
+    # SQLite connections are not pooled in a QueuePool
+    if make_url(url).get_backend_name() != 'sqlite':
+        settings.update({
+            'pool_size': int(environ.get('DATABASE_POOL_SIZE', 5)),
+            'max_overflow': int(environ.get('DATABASE_MAX_OVERFLOW', 10)),
+            'pool_timeout': int(environ.get('DATABASE_POOL_TIMEOUT', 30)),
+        })
+    return settings
+
+
+def createEngine(url=None, environ=os.environ):
+    '''Create an engine for url using the pool settings from environ'''
+    url = url or databaseUrl(environ)
+    return create_engine(url, **poolSettings(url, environ))
+
+
+# Drivers used by createAsyncEngine for each database
+ASYNC_DRIVERS = {
+    'postgresql': 'postgresql+asyncpg',
+    'sqlite': 'sqlite+aiosqlite',
+}
+
+
+def asyncUrl(url):
+    '''Return url with its driver replaced by the asyncio one'''
+    url = make_url(url)
+    return url.set(drivername=ASYNC_DRIVERS.get(url.get_backend_name(),
+                                                url.drivername))
+
+
+def createAsyncEngine(url=None, environ=os.environ):
+    '''Create an asyncio engine for url (SQLAlchemy 1.4 or later)'''
+    from sqlalchemy.ext.asyncio import create_async_engine
+    url = asyncUrl(url or databaseUrl(environ))
+    return create_async_engine(url, **poolSettings(url, environ))
@@ -1,16 +1,20 @@
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 
+from database import databaseUrl
 from database_setup import Base, Category, Product, ProductPhoto, User
+from catalog_slugs import trackSlugs
 
 #engine = create_engine('sqlite:///restaurantmenuwithusers.db')
-engine = create_engine('postgresql+psycopg2:///mystore')
+engine = create_engine(databaseUrl())
 
 # Bind the engine to the metadata of the Base class so that the
 # declaratives can be accessed through a DBSession instance
 Base.metadata.bind = engine
 
 DBSession = sessionmaker(bind=engine)
+# Categories and products get their URL slugs when they are flushed
+trackSlugs(DBSession)
 # A DBSession() instance establishes all conversations with the database
 # and represents a "staging zone" for all the objects loaded into the
 # database session object. Any change made against the objects in the
@@ -1,7 +1,10 @@
-from sqlalchemy import Column, ForeignKey, Integer, String
+import decimal
+from sqlalchemy import Column, ForeignKey, Integer, String, DateTime, Index, \
+    Text, Numeric
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from sqlalchemy import create_engine, UniqueConstraint
+from database import databaseUrl
 
 Base = declarative_base()
 
@@ -17,7 +20,9 @@ class Category(Base):
     __tablename__ = 'categories'
 
     id = Column(Integer, primary_key=True)
-    name = Column(String(250), nullable=False)
+    name = Column(String(250), nullable=False, index=True)
+    # Unique name for URLs, see catalog_slugs.py
+    slug = Column(String(100), nullable=False, unique=True, index=True)
     sku_code = Column(String(10), unique=True)
     user_id = Column(Integer, ForeignKey('users.id'))
     user = relationship(User)
@@ -29,6 +34,7 @@ class Category(Base):
        return {
            'id'         : self.id,
            'name'       : self.name,
+           'slug'       : self.slug,
            'sku_code'   : self.sku_code
        }
 
@@ -38,10 +44,12 @@ class Category(Base):
        return {
            'id'         : self.id,
            'name'       : self.name,
+           'slug'       : self.slug,
            'sku_code'   : self.sku_code,
            'products'   : [{'id': product.id,
                             'name': product.name,
-                            'price':product.price,
+                            'slug': product.slug,
+                            'price':formatPrice(product.price),
                             'sku':product.sku,
                             'status':product.status,
                             'description':product.description}
@@ -50,11 +58,24 @@ class Category(Base):
 
 class Product(Base):
     __tablename__ = 'products'
+    __table_args__ = (
+        # Category pages: filter on category and status, keyset on name, id
+        Index('ix_products_category_status_name',
+              'category_id', 'status', 'name', 'id'),
+        # All page and category items.json: keyset on category, name, id
+        Index('ix_products_category_name', 'category_id', 'name', 'id'),
+        # Price ranges and sorting (catalog_queries.productFilter)
+        Index('ix_products_price', 'price', 'id'),
+        Index('ix_products_category_price', 'category_id', 'price', 'id'),
+        Index('ix_products_category_status_price',
+              'category_id', 'status', 'price', 'id'),
+    )
 
     id = Column(Integer, primary_key = True)
-    name = Column(String(80), nullable = False)
+    name = Column(String(80), nullable = False, index = True)
+    slug = Column(String(100), nullable = False, unique = True, index = True)
     description = Column(String(250))
-    price = Column(String(8))
+    price = Column(Numeric(10, 2))
     sku = Column(String(50), unique=True)
     status = Column(Integer)
     category_id = Column(Integer,ForeignKey('categories.id'))
@@ -69,8 +90,9 @@ class Product(Base):
        return {
            'id'           : self.id,
            'name'         : self.name,
+           'slug'         : self.slug,
            'sku'          : self.sku,
-           'price'        : self.price,
+           'price'        : formatPrice(self.price),
            'status'       : self.status,
            'description'  : self.description,
        }
@@ -81,8 +103,9 @@ class ProductPhoto(Base):
     id = Column(Integer, primary_key = True)
     filename = Column(String(80), nullable = False)
     order_placement = Column(Integer)
-    product_id = Column(Integer, ForeignKey('products.id'))
+    product_id = Column(Integer, ForeignKey('products.id'), index = True)
     product = relationship(Product)
+    variants = relationship("ProductPhotoVariant")
 
     @property
     def serialize(self):
@@ -93,7 +116,97 @@ class ProductPhoto(Base):
            'id'         : self.id,
        }
 
-engine = create_engine('postgresql+psycopg2:///mystore')
+class ProductPhotoVariant(Base):
+    """Resized copy of a product photo, see photo_variants.py"""
+    __tablename__ = 'product_photo_variants'
+
+    id = Column(Integer, primary_key = True)
+    photo_id = Column(Integer, ForeignKey('product_photos.id'),
+                      nullable = False, index = True)
+    size = Column(String(20), nullable = False)
+    density = Column(Integer, nullable = False)
+    format = Column(String(10), nullable = False)
+    filename = Column(String(80), nullable = False)
+    width = Column(Integer)
+    height = Column(Integer)
+
+class SkuCounter(Base):
+    """Next SKU number to hand out in a category, see catalog_skus.py"""
+    __tablename__ = 'sku_counters'
+
+    category_id = Column(Integer, ForeignKey('categories.id'),
+                         primary_key = True)
+    next_number = Column(Integer, nullable = False)
 
+class ImportCheckpoint(Base):
+    """Records imported so far from each catalog_import.py source file"""
+    __tablename__ = 'import_checkpoints'
 
-Base.metadata.create_all(engine)
+    source = Column(String(500), primary_key = True)
+    position = Column(Integer, nullable = False)
+    updated = Column(DateTime, nullable = False)
+
+class CatalogVersion(Base):
+    """Single row bumped whenever a category, product or photo is written"""
+    __tablename__ = 'catalog_version'
+
+    id = Column(Integer, primary_key = True)
+    version = Column(Integer, nullable = False)
+    modified = Column(DateTime, nullable = False)
+
+class Job(Base):
+    """Queued background work, see jobs.py"""
+    __tablename__ = 'jobs'
+
+    id = Column(Integer, primary_key = True)
+    kind = Column(String(50), nullable = False)
+    payload = Column(Text, nullable = False)
+    attempts = Column(Integer, nullable = False, default = 0)
+    run_at = Column(DateTime, nullable = False, index = True)
+    locked_until = Column(DateTime)
+    failed_at = Column(DateTime)
+    last_error = Column(Text)
+    created = Column(DateTime, nullable = False)
+
+# Largest price Product.price holds
+MAX_PRICE = decimal.Decimal('99999999.99')
+CENTS = decimal.Decimal('0.01')
+
+
+def parsePrice(text):
+    """Read a price entered as text, e.g. '25', '$1,299.5', as a Decimal.
+
+    Returns None for a blank price and raises ValueError if text is not one.
+    """
+    if text is None:
+        return None
+    text = text.replace('$', '').replace(',', '').strip()
+    if not text:
+        return None
+    try:
+        price = decimal.Decimal(text)
+    except decimal.InvalidOperation:
+        raise ValueError('Invalid price {0}'.format(text))
+    if not price.is_finite() or price < 0 or price > MAX_PRICE:
+        raise ValueError('Invalid price {0}'.format(text))
+    return price.quantize(CENTS, decimal.ROUND_HALF_UP)
+
+
+def formatPrice(price):
+    """Price as sent in JSON, a string such as '25.00'"""
+    if price is None:
+        return None
+    return '{0:.2f}'.format(price)
+
+
+# Document searched by the full-text index on PostgreSQL. Queries must use
+# the same expression for the index to apply.
+PRODUCT_SEARCH_DOCUMENT = (
+    "to_tsvector('simple', coalesce(name, '') || ' ' || "
+    "coalesce(description, '') || ' ' || coalesce(sku, ''))")
+
+
+if __name__ == '__main__':
+    # Create or upgrade the schema, see migrations.py
+    from migrations import upgrade
+    upgrade(create_engine(databaseUrl()))
@@ -0,0 +1,18 @@
+'''Gunicorn settings for serving the catalog with several processes and
+threads. Keep DATABASE_POOL_SIZE at least as large as WEB_THREADS.'''
+import os
+import sys
+
+bind = os.environ.get('BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+threads = int(os.environ.get('WEB_THREADS', 4))
+worker_class = 'gthread'
+
+
+def post_fork(server, worker):
+    # Connections opened in the master (e.g. with --preload) must not be
+    # shared with the workers, so start each worker with an empty pool.
+    wsgi = sys.modules.get('wsgi')
+    if wsgi is not None:
+        from application import disposeEngine
+        disposeEngine(wsgi.application)
@@ -0,0 +1,153 @@
+'''Background jobs queued in the database.
+
+Requests hand slow side effects (resizing uploaded photos, removing files)
+to enqueue(), which adds a row to the jobs table in the same transaction as
+the writes the job belongs to, and worker.py runs them. A worker leases the
+jobs it claims; if it dies before finishing, the lease runs out and another
+worker runs the job again, so handlers must be safe to run more than once.
+A handler's writes are committed together with the removal of its job.
+Failed jobs are retried with a growing delay and kept, with their error,
+after MAX_ATTEMPTS.
+'''
+import datetime
+import json
+import logging
+import time
+import traceback
+from sqlalchemy import or_
+from database_setup import Job
+
+MAX_ATTEMPTS = 5
+LEASE = datetime.timedelta(minutes=5)
+# Seconds before the first retry, doubled after each further failure
+RETRY_DELAY = 30
+BATCH_SIZE = 10
+POLL_INTERVAL = 1.0
+
+log = logging.getLogger(__name__)
+
+jobs = Job.__table__
+handlers = {}
+
+
+def handles(kind):
+    '''Register the decorated function as the handler of kind.
+
+    It is called as handler(session, **payload).
+    '''
+    def register(handler):
+        handlers[kind] = handler
+        return handler
+    return register
+
+
+def enqueue(session, kind, **payload):
+    '''Queue a job, to be run once the session commits'''
+    now = datetime.datetime.utcnow()
+    job = Job(kind=kind, payload=json.dumps(payload), attempts=0,
+              run_at=now, created=now)
+    session.add(job)
+    return job
+
+
+def enqueueMany(session, kind, payloads):
+    '''Queue a job for each payload with a single INSERT'''
+    now = datetime.datetime.utcnow()
+    rows = [{'kind': kind, 'payload': json.dumps(payload), 'attempts': 0,
+             'run_at': now, 'created': now} for payload in payloads]
+    if rows:
+        session.execute(jobs.insert(), rows)
+
+
+def readyJobs(query, now):
+    return query.filter(Job.failed_at.is_(None), Job.run_at <= now,
+                        or_(Job.locked_until.is_(None),
+                            Job.locked_until < now))
+
+
+def claimJobs(session, limit=BATCH_SIZE, lease=LEASE):
+    '''Lease up to limit jobs that are due and return them'''
+    now = datetime.datetime.utcnow()
+    query = readyJobs(session.query(Job), now) \
+        .order_by(Job.run_at, Job.id).limit(limit)
+    if session.get_bind().dialect.name == 'postgresql':
+        # Concurrent workers skip the rows another one is claiming
+        claimed = query.with_for_update(skip_locked=True).all()
+        for job in claimed:
+            job.locked_until = now + lease
+            job.attempts += 1
+    else:
+        claimed_ids = []
+        for job_id in [job.id for job in query]:
+            # Only one worker's UPDATE can still find the job unleased
+            result = session.execute(
+                jobs.update()
+                .where(jobs.c.id == job_id)
+                .where(or_(jobs.c.locked_until.is_(None),
+                           jobs.c.locked_until < now))
+                .values(locked_until=now + lease,
+                        attempts=jobs.c.attempts + 1))
+            if result.rowcount:
+                claimed_ids.append(job_id)
+        claimed = session.query(Job).filter(Job.id.in_(claimed_ids)) \
+            .order_by(Job.run_at, Job.id).all() if claimed_ids else []
+    session.commit()
+    return claimed
+
+
+def runJob(session, job):
+    '''Run a claimed job and return whether it succeeded'''
+    job_id, kind = job.id, job.kind
+    try:
+        if job.attempts > MAX_ATTEMPTS:
+            raise RuntimeError('Gave up after the lease expired {0} times'
+                               .format(MAX_ATTEMPTS))
+        handler = handlers[kind]
+        handler(session, **json.loads(job.payload))
+        session.delete(job)
+        session.commit()
+        return True
+    except Exception:
+        error = traceback.format_exc()
+        session.rollback()
+        log.exception('Job %s (%s) failed', job_id, kind)
+        job = session.query(Job).get(job_id)
+        if job is None:
+            # Finished by another worker after our lease ran out
+            return False
+        now = datetime.datetime.utcnow()
+        job.last_error = error
+        job.locked_until = None
+        if job.attempts >= MAX_ATTEMPTS:
+            job.failed_at = now
+        else:
+            job.run_at = now + datetime.timedelta(
+                seconds=RETRY_DELAY * 2 ** (job.attempts - 1))
+        session.commit()
+        return False
+
+
+def retryFailed(session):
+    '''Queue every failed job again and return how many there were'''
+    count = session.query(Job).filter(Job.failed_at.isnot(None)).update(
+        {'failed_at': None, 'attempts': 0,
+         'run_at': datetime.datetime.utcnow()}, synchronize_session=False)
+    session.commit()
+    return count
+
+
+def work(session_factory, once=False, batch_size=BATCH_SIZE,
+         poll_interval=POLL_INTERVAL):
+    '''Run due jobs, polling for more until interrupted (or done if once)'''
+    while True:
+        session = session_factory()
+        try:
+            claimed = claimJobs(session, batch_size)
+            for job in claimed:
+                runJob(session, job)
+        finally:
+            session.close()
+        if not claimed:
+            if once:
+                return
+            time.sleep(poll_interval)
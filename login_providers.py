@@ -0,0 +1,204 @@
+'''Sign-in providers used by /gconnect.
+
+A provider turns the one-time code posted by the sign-in button into the
+identity of the user (id, email, name, picture and access token).
+
+GoogleProvider exchanges the code for tokens and verifies the ID token
+locally against Google's signing keys instead of asking Google about every
+token. The keys are cached for as long as Google's Cache-Control allows
+and fetched again as soon as a token arrives signed with a key not seen
+yet, which is how a key rotation shows up. All calls to Google share one
+pooled requests.Session with connect and read timeouts.
+
+LocalProvider signs users in from a table of codes without any network
+access, for tests:
+
+    app = createApp({'LOGIN_PROVIDER': LocalProvider({
+        'code': {'id': '1', 'email': 'a@example.com', 'name': 'A',
+                 'picture': ''}})})
+'''
+import base64
+import json
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from werkzeug.http import parse_cache_control_header
+
+TOKEN_URL = 'https://oauth2.googleapis.com/token'
+CERTS_URL = 'https://www.googleapis.com/oauth2/v1/certs'
+USERINFO_URL = 'https://www.googleapis.com/oauth2/v1/userinfo'
+REVOKE_URL = 'https://accounts.google.com/o/oauth2/revoke'
+ISSUERS = ('accounts.google.com', 'https://accounts.google.com')
+
+# (connect, read) timeouts in seconds for calls to the provider
+TIMEOUT = (3.05, 10)
+# Connections kept open to each provider host
+POOL_SIZE = 10
+# Seconds the signing keys are kept when Google sends no max-age
+KEYS_TIMEOUT = 3600
+# Minimum seconds between fetches caused by an unknown key id, so forged
+# tokens cannot make every login wait for Google
+KEYS_REFRESH_INTERVAL = 10
+# Seconds of clock difference allowed when checking iat and exp
+CLOCK_SKEW = 300
+# Claims copied into the identity, fetched from userinfo if missing
+PROFILE_CLAIMS = ('email', 'name', 'picture')
+
+
+class LoginFailed(Exception):
+    '''The code or ID token was not accepted'''
+
+
+def httpSession(pool_size=POOL_SIZE):
+    '''requests.Session keeping up to pool_size connections per host'''
+    http = requests.Session()
+    http.mount('https://', HTTPAdapter(pool_maxsize=pool_size))
+    return http
+
+
+def decodeSegment(segment):
+    '''Decode one base64url segment of a JWT'''
+    segment = segment.encode('ascii')
+    return base64.urlsafe_b64decode(segment + b'=' * (-len(segment) % 4))
+
+
+class GoogleProvider(object):
+    '''Google sign-in with locally verified ID tokens'''
+
+    name = 'google'
+
+    def __init__(self, client_secrets_file, http=None, timeout=TIMEOUT):
+        with open(client_secrets_file, 'r') as f:
+            secrets = json.load(f)['web']
+        self.client_id = secrets['client_id']
+        self.client_secret = secrets['client_secret']
+        self.http = http or httpSession()
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._verifiers = {}
+        self._keys_fetched = 0
+        self._keys_expire = 0
+
+    def login(self, code):
+        '''Exchange code and return the identity of the user it belongs to'''
+        tokens = self.exchange(code)
+        claims = self.verify(tokens['id_token'])
+        identity = {'id': claims['sub'],
+                    'access_token': tokens.get('access_token')}
+        for claim in PROFILE_CLAIMS:
+            identity[claim] = claims.get(claim)
+        # The profile claims are only in the token with the profile scope
+        if not all(identity[claim] for claim in PROFILE_CLAIMS) and \
+                identity['access_token']:
+            info = self.userInfo(identity['access_token'])
+            for claim in PROFILE_CLAIMS:
+                identity[claim] = identity[claim] or info.get(claim)
+        if not identity['email']:
+            raise LoginFailed('No email address for the account.')
+        identity['picture'] = identity['picture'] or ''
+        return identity
+
+    def exchange(self, code):
+        '''Exchange a one-time code for an access token and ID token'''
+        response = self.http.post(TOKEN_URL, timeout=self.timeout, data={
+            'code': code,
+            'client_id': self.client_id,
+            'client_secret': self.client_secret,
+            'redirect_uri': 'postmessage',
+            'grant_type': 'authorization_code',
+        })
+        if response.status_code != 200 or \
+                'id_token' not in response.json():
+            raise LoginFailed('Failed to upgrade the authorization code.')
+        return response.json()
+
+    def verify(self, token):
+        '''Check the signature and claims of an ID token, returning claims'''
+        try:
+            header, payload, signature = token.split('.')
+            signed = (header + '.' + payload).encode('ascii')
+            header = json.loads(decodeSegment(header).decode('utf-8'))
+            claims = json.loads(decodeSegment(payload).decode('utf-8'))
+            signature = decodeSegment(signature)
+        except (TypeError, UnicodeError, ValueError):
+            raise LoginFailed('Malformed ID token.')
+        if header.get('alg') != 'RS256':
+            raise LoginFailed('Unsupported ID token algorithm.')
+        verifier = self.verifier(header.get('kid'))
+        if verifier is None or not verifier.verify(signed, signature):
+            raise LoginFailed('Invalid ID token signature.')
+        if claims.get('iss') not in ISSUERS:
+            raise LoginFailed('ID token was not issued by Google.')
+        if claims.get('aud') != self.client_id:
+            raise LoginFailed("Token's client ID does not match app's.")
+        now = time.time()
+        if not claims.get('iat', now) - CLOCK_SKEW <= now < \
+                claims.get('exp', 0) + CLOCK_SKEW:
+            raise LoginFailed('ID token has expired.')
+        if claims.get('email_verified') is False:
+            raise LoginFailed('Email address is not verified.')
+        return claims
+
+    def verifier(self, key_id):
+        '''Verifier for signing key key_id, None if Google has no such key'''
+        now = time.time()
+        with self._lock:
+            if now >= self._keys_expire or (
+                    key_id not in self._verifiers and
+                    now >= self._keys_fetched + KEYS_REFRESH_INTERVAL):
+                self.fetchKeys(now)
+            return self._verifiers.get(key_id)
+
+    def fetchKeys(self, now):
+        '''Replace the cached signing keys with Google's current ones'''
+        # oauth2client is slow to import, so leave it until someone signs in
+        from oauth2client.crypt import Verifier
+        response = self.http.get(CERTS_URL, timeout=self.timeout)
+        response.raise_for_status()
+        self._verifiers = dict(
+            (key_id, Verifier.from_string(cert, is_x509_cert=True))
+            for key_id, cert in response.json().items())
+        max_age = parse_cache_control_header(
+            response.headers.get('Cache-Control')).max_age
+        self._keys_fetched = now
+        self._keys_expire = now + (max_age if max_age is not None
+                                   else KEYS_TIMEOUT)
+
+    def userInfo(self, access_token):
+        '''Profile of the user access_token was issued to'''
+        response = self.http.get(USERINFO_URL, timeout=self.timeout,
+                                 params={'access_token': access_token,
+                                         'alt': 'json'})
+        if response.status_code != 200:
+            raise LoginFailed('Failed to get the user profile.')
+        return response.json()
+
+    def revoke(self, access_token):
+        '''Revoke access_token, returning whether Google accepted it'''
+        response = self.http.get(REVOKE_URL, timeout=self.timeout,
+                                 params={'token': access_token})
+        return response.status_code == 200
+
+
+class LocalProvider(object):
+    '''Stand-in provider signing in the identities mapped to codes'''
+
+    name = 'local'
+
+    def __init__(self, identities=None):
+        self.identities = identities or {}
+
+    def login(self, code):
+        if isinstance(code, bytes):
+            code = code.decode('utf-8')
+        identity = self.identities.get(code)
+        if identity is None:
+            raise LoginFailed('Failed to upgrade the authorization code.')
+        identity = dict(identity)
+        identity.setdefault('access_token', None)
+        identity.setdefault('picture', '')
+        return identity
+
+    def revoke(self, access_token):
+        return True
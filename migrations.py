@@ -0,0 +1,346 @@
+'''Versioned schema migrations.
+
+    python migrations.py            upgrade the database to the latest version
+    python migrations.py current    print the current schema version
+
+Migrations run in order, each in its own transaction, and are recorded in
+the schema_migrations table so an existing database is upgraded in place.
+Table definitions are written out in each migration rather than taken from
+database_setup.py so that a migration keeps doing the same thing as the
+models change.
+'''
+import datetime
+import decimal
+import re
+import sys
+from sqlalchemy import create_engine, inspect, MetaData, Table, Column, \
+    ForeignKey, Integer, String, DateTime, Index, Text, Numeric, select, \
+    bindparam
+from database import databaseUrl
+from catalog_slugs import slugify, freeSlug
+from database_setup import PRODUCT_SEARCH_DOCUMENT
+
+metadata = MetaData()
+schema_migrations = Table(
+    'schema_migrations', metadata,
+    Column('version', Integer, primary_key=True),
+    Column('description', String(250), nullable=False),
+    Column('applied', DateTime, nullable=False))
+
+
+def createIndex(connection, name, table, *columns, **kwargs):
+    '''Create an index unless the table already has one with that name'''
+    if name in [index['name'] for index in
+                inspect(connection).get_indexes(table.name)]:
+        return
+    Index(name, *[table.c[column] for column in columns], **kwargs) \
+        .create(connection)
+
+
+def baseline(connection):
+    '''Tables created by Base.metadata.create_all before migrations existed.
+
+    Existing tables are left alone so deployments created that way can
+    adopt migrations in place.
+    '''
+    tables = MetaData()
+    Table('users', tables,
+          Column('id', Integer, primary_key=True),
+          Column('name', String(250), nullable=False),
+          Column('email', String(250), nullable=False),
+          Column('picture', String(250)))
+    Table('categories', tables,
+          Column('id', Integer, primary_key=True),
+          Column('name', String(250), nullable=False),
+          Column('sku_code', String(10), unique=True),
+          Column('user_id', Integer, ForeignKey('users.id')))
+    Table('products', tables,
+          Column('id', Integer, primary_key=True),
+          Column('name', String(80), nullable=False),
+          Column('description', String(250)),
+          Column('price', String(8)),
+          Column('sku', String(50), unique=True),
+          Column('status', Integer),
+          Column('category_id', Integer, ForeignKey('categories.id')),
+          Column('user_id', Integer, ForeignKey('users.id')))
+    Table('product_photos', tables,
+          Column('id', Integer, primary_key=True),
+          Column('filename', String(80), nullable=False),
+          Column('order_placement', Integer),
+          Column('product_id', Integer, ForeignKey('products.id')))
+    catalog_version = Table(
+        'catalog_version', tables,
+        Column('id', Integer, primary_key=True),
+        Column('version', Integer, nullable=False),
+        Column('modified', DateTime, nullable=False))
+    tables.create_all(connection, checkfirst=True)
+    if connection.execute(select([catalog_version.c.id])).first() is None:
+        connection.execute(catalog_version.insert().values(
+            id=1, version=1, modified=datetime.datetime.utcnow()))
+
+
+def searchIndexes(connection):
+    '''Full-text and trigram indexes for product search on PostgreSQL'''
+    if connection.dialect.name != 'postgresql':
+        return
+    connection.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    connection.execute(
+        "CREATE INDEX IF NOT EXISTS ix_products_search ON products "
+        "USING gin ((" + PRODUCT_SEARCH_DOCUMENT + "))")
+    connection.execute(
+        "CREATE INDEX IF NOT EXISTS ix_products_sku_trgm ON products "
+        "USING gin (sku gin_trgm_ops)")
+
+
+def hotColumnIndexes(connection):
+    '''Indexes for the name lookups and category listings'''
+    tables = MetaData()
+    categories = Table('categories', tables, autoload_with=connection)
+    products = Table('products', tables, autoload_with=connection)
+    photos = Table('product_photos', tables, autoload_with=connection)
+    createIndex(connection, 'ix_categories_name', categories, 'name')
+    createIndex(connection, 'ix_products_name', products, 'name')
+    createIndex(connection, 'ix_products_category_status_name', products,
+                'category_id', 'status', 'name', 'id')
+    createIndex(connection, 'ix_products_category_name', products,
+                'category_id', 'name', 'id')
+    createIndex(connection, 'ix_product_photos_product_id', photos,
+                'product_id')
+
+
+def skuCounters(connection):
+    '''Per-category SKU counters, seeded from the existing product SKUs'''
+    sku_pattern = re.compile(r'^.*-(\d+)$')
+    tables = MetaData()
+    Table('categories', tables, autoload_with=connection)
+    products = Table('products', tables, autoload_with=connection)
+    counters = Table(
+        'sku_counters', tables,
+        Column('category_id', Integer, ForeignKey('categories.id'),
+               primary_key=True),
+        Column('next_number', Integer, nullable=False))
+    counters.create(connection, checkfirst=True)
+    categories = tables.tables['categories']
+    next_numbers = dict((row.id, 1) for row in
+                        connection.execute(select([categories.c.id])))
+    for row in connection.execute(select([products.c.category_id,
+                                          products.c.sku])):
+        match = sku_pattern.match(row.sku or '')
+        if match and row.category_id in next_numbers:
+            next_numbers[row.category_id] = max(
+                next_numbers[row.category_id], int(match.group(1)) + 1)
+    if next_numbers:
+        connection.execute(counters.insert(), [
+            {'category_id': category_id, 'next_number': next_number}
+            for category_id, next_number in next_numbers.items()])
+
+
+def importCheckpoints(connection):
+    '''Resume positions for catalog_import.py'''
+    Table('import_checkpoints', MetaData(),
+          Column('source', String(500), primary_key=True),
+          Column('position', Integer, nullable=False),
+          Column('updated', DateTime, nullable=False)) \
+        .create(connection, checkfirst=True)
+
+
+def photoVariants(connection):
+    '''Resized copies of product photos'''
+    tables = MetaData()
+    Table('product_photos', tables, autoload_with=connection)
+    Table('product_photo_variants', tables,
+          Column('id', Integer, primary_key=True),
+          Column('photo_id', Integer, ForeignKey('product_photos.id'),
+                 nullable=False, index=True),
+          Column('size', String(20), nullable=False),
+          Column('density', Integer, nullable=False),
+          Column('format', String(10), nullable=False),
+          Column('filename', String(80), nullable=False),
+          Column('width', Integer),
+          Column('height', Integer)) \
+        .create(connection, checkfirst=True)
+
+
+def jobs(connection):
+    '''Background job queue'''
+    Table('jobs', MetaData(),
+          Column('id', Integer, primary_key=True),
+          Column('kind', String(50), nullable=False),
+          Column('payload', Text, nullable=False),
+          Column('attempts', Integer, nullable=False),
+          Column('run_at', DateTime, nullable=False, index=True),
+          Column('locked_until', DateTime),
+          Column('failed_at', DateTime),
+          Column('last_error', Text),
+          Column('created', DateTime, nullable=False)) \
+        .create(connection, checkfirst=True)
+
+
+# Old text prices that numericPrices converts, once '$', ',' and spaces
+# are removed; anything else becomes NULL
+PRICE_PATTERN = r'^[0-9]{1,8}(\.[0-9]*)?$'
+PRICE_BATCH_SIZE = 5000
+
+
+def migratedPrice(text):
+    '''Numeric value of a price stored as text, None if it is not one'''
+    text = (text or '').replace('$', '').replace(',', '').strip()
+    if not re.match(PRICE_PATTERN, text):
+        return None
+    return decimal.Decimal(text).quantize(decimal.Decimal('0.01'),
+                                          decimal.ROUND_HALF_UP)
+
+
+def rebuildProducts(connection):
+    '''Copy products into a table with a NUMERIC price and swap it in.
+
+    For databases that cannot change a column's type in place (SQLite).
+    '''
+    tables = MetaData()
+    old = Table('products', tables, autoload_with=connection)
+    indexes = [(index.name, [column.name for column in index.columns],
+                index.unique) for index in old.indexes]
+    new = old.tometadata(tables, name='products_numeric')
+    # Index names are global, so the indexes are created after the swap
+    new.indexes.clear()
+    new.c.price.type = Numeric(10, 2)
+    new.create(connection)
+    last_id = None
+    while True:
+        query = select([old]).order_by(old.c.id).limit(PRICE_BATCH_SIZE)
+        if last_id is not None:
+            query = query.where(old.c.id > last_id)
+        rows = connection.execute(query).fetchall()
+        if not rows:
+            break
+        values = []
+        for row in rows:
+            value = dict(row)
+            value['price'] = migratedPrice(row.price)
+            values.append(value)
+        connection.execute(new.insert(), values)
+        last_id = rows[-1].id
+    old.drop(connection)
+    connection.execute("ALTER TABLE products_numeric RENAME TO products")
+    products = Table('products', MetaData(), autoload_with=connection)
+    for name, columns, unique in indexes:
+        createIndex(connection, name, products, *columns, unique=unique)
+
+
+def numericPrices(connection):
+    '''Store product prices as NUMERIC(10, 2) and index them for range
+    filters and sorting'''
+    if connection.dialect.name == 'postgresql':
+        price = "btrim(translate(price, '$,', ''))"
+        connection.execute(
+            "ALTER TABLE products ALTER COLUMN price TYPE NUMERIC(10, 2) "
+            "USING CASE WHEN " + price + " ~ '" + PRICE_PATTERN + "' "
+            "THEN round(" + price + "::numeric, 2) END")
+    else:
+        rebuildProducts(connection)
+    products = Table('products', MetaData(), autoload_with=connection)
+    createIndex(connection, 'ix_products_price', products, 'price', 'id')
+    createIndex(connection, 'ix_products_category_price', products,
+                'category_id', 'price', 'id')
+    createIndex(connection, 'ix_products_category_status_price', products,
+                'category_id', 'status', 'price', 'id')
+
+
+SLUG_BATCH_SIZE = 5000
+
+
+def backfillSlugs(connection, table):
+    '''Give every row of table without a slug one made from its name'''
+    used = set(row.slug for row in connection.execute(
+        select([table.c.slug]).where(table.c.slug.isnot(None))))
+    update = table.update().where(table.c.id == bindparam('row_id')) \
+        .values(slug=bindparam('new_slug'))
+    last_id = None
+    while True:
+        query = select([table.c.id, table.c.name]) \
+            .where(table.c.slug.is_(None)) \
+            .order_by(table.c.id).limit(SLUG_BATCH_SIZE)
+        if last_id is not None:
+            query = query.where(table.c.id > last_id)
+        rows = connection.execute(query).fetchall()
+        if not rows:
+            break
+        values = []
+        for row in rows:
+            # The oldest row keeps the plain slug of a shared name
+            slug = freeSlug(slugify(row.name), used)
+            used.add(slug)
+            values.append({'row_id': row.id, 'new_slug': slug})
+        connection.execute(update, values)
+        last_id = rows[-1].id
+
+
+def slugs(connection):
+    '''Unique URL slugs for categories and products'''
+    for name in ('categories', 'products'):
+        table = Table(name, MetaData(), autoload_with=connection)
+        if 'slug' not in table.c:
+            connection.execute(
+                "ALTER TABLE {0} ADD COLUMN slug VARCHAR(100)".format(name))
+            table = Table(name, MetaData(), autoload_with=connection)
+        backfillSlugs(connection, table)
+        createIndex(connection, 'ix_{0}_slug'.format(name), table, 'slug',
+                    unique=True)
+        if connection.dialect.name == 'postgresql':
+            connection.execute(
+                "ALTER TABLE {0} ALTER COLUMN slug SET NOT NULL".format(name))
+    # The JSON documents gain slugs, so cached copies must be rebuilt
+    connection.execute("UPDATE catalog_version SET version = version + 1")
+
+
+MIGRATIONS = [
+    (1, 'baseline schema', baseline),
+    (2, 'product search indexes', searchIndexes),
+    (3, 'indexes for hot filter columns', hotColumnIndexes),
+    (4, 'sku counters', skuCounters),
+    (5, 'import checkpoints', importCheckpoints),
+    (6, 'photo variants', photoVariants),
+    (7, 'background jobs', jobs),
+    (8, 'numeric product prices', numericPrices),
+    (9, 'unique slugs', slugs),
+]
+
+
+def appliedVersions(connection):
+    metadata.create_all(connection, tables=[schema_migrations],
+                        checkfirst=True)
+    return set(row.version for row in
+               connection.execute(select([schema_migrations.c.version])))
+
+
+def currentVersion(engine):
+    '''Return the highest migration applied to the database'''
+    with engine.connect() as connection:
+        return max(appliedVersions(connection) or [0])
+
+
+def upgrade(engine, target=None, log=sys.stdout):
+    '''Apply every migration up to target (default: all of them)'''
+    with engine.connect() as connection:
+        applied = appliedVersions(connection)
+    for version, description, migration in MIGRATIONS:
+        if version in applied or (target is not None and version > target):
+            continue
+        log.write('Applying migration {0}: {1}\n'.format(
+            version, description))
+        with engine.begin() as connection:
+            migration(connection)
+            connection.execute(schema_migrations.insert().values(
+                version=version, description=description,
+                applied=datetime.datetime.utcnow()))
+
+
+if __name__ == '__main__':
+    engine = create_engine(databaseUrl())
+    command = sys.argv[1] if len(sys.argv) > 1 else 'upgrade'
+    if command == 'upgrade':
+        upgrade(engine)
+    elif command == 'current':
+        print(currentVersion(engine))
+    else:
+        sys.exit('usage: python migrations.py [upgrade|current]')
@@ -0,0 +1,182 @@
+'''Resized variants of uploaded product photos.
+
+Every upload gets a thumbnail for the catalog grids and a medium copy for
+the product pages, each at 1x and 2x density and each also encoded as
+WebP. Variant files are named after a hash of their content, so their URLs
+never change meaning and can be cached by browsers forever.
+
+Variants are made by the background worker (see jobs.py) after the upload
+is saved, and files of deleted photos are removed there too. Variants need
+Pillow. Without it, or until the worker gets to a photo, the templates show
+the original upload.
+'''
+import hashlib
+import io
+import os
+from database_setup import ProductPhoto, ProductPhotoVariant
+from jobs import enqueue, enqueueMany, handles
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Longest side in CSS pixels for each size shown by the templates
+VARIANT_SIZES = {'thumb': 200, 'medium': 350}
+DENSITIES = (1, 2)
+# Upload formats that are re-encoded as themselves; others become PNG
+NATIVE_FORMATS = {'JPEG': 'jpeg', 'PNG': 'png'}
+EXTENSIONS = {'jpeg': 'jpg', 'png': 'png', 'webp': 'webp'}
+JPEG_QUALITY = 85
+WEBP_QUALITY = 80
+# Filenames per file removal job, and per query checking them
+FILE_BATCH_SIZE = 500
+
+
+def encode(image, format):
+    '''Return image encoded in format as bytes'''
+    output = io.BytesIO()
+    if format == 'jpeg':
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        image.save(output, 'JPEG', quality=JPEG_QUALITY, optimize=True,
+                   progressive=True)
+    elif format == 'webp':
+        image.save(output, 'WEBP', quality=WEBP_QUALITY)
+    else:
+        image.save(output, 'PNG', optimize=True)
+    return output.getvalue()
+
+
+def writeVariant(folder, data, format):
+    '''Write data under a content-hashed name and return the name'''
+    filename = '{0}.{1}'.format(hashlib.sha1(data).hexdigest()[:20],
+                                EXTENSIONS[format])
+    path = os.path.join(folder, filename)
+    if not os.path.exists(path):
+        with open(path, 'wb') as f:
+            f.write(data)
+    return filename
+
+
+def generateVariants(session, photo, upload_folder, variant_folder):
+    '''Create and record the variants of photo.
+
+    Returns the variants added, or an empty list if Pillow is missing or
+    the upload cannot be read as an image.
+    '''
+    if Image is None:
+        return []
+    try:
+        original = Image.open(os.path.join(upload_folder, photo.filename))
+        original.load()
+    except (IOError, OSError):
+        return []
+    formats = [NATIVE_FORMATS.get(original.format, 'png'), 'webp']
+    if original.mode not in ('RGB', 'RGBA', 'L'):
+        original = original.convert('RGBA')
+    if not os.path.isdir(variant_folder):
+        os.makedirs(variant_folder)
+    variants = []
+    for size, pixels in VARIANT_SIZES.items():
+        for density in DENSITIES:
+            image = original.copy()
+            image.thumbnail((pixels * density, pixels * density),
+                            Image.LANCZOS)
+            for format in formats:
+                variant = ProductPhotoVariant(
+                    photo_id=photo.id, size=size, density=density,
+                    format=format, width=image.size[0],
+                    height=image.size[1],
+                    filename=writeVariant(variant_folder,
+                                          encode(image, format), format))
+                session.add(variant)
+                variants.append(variant)
+    return variants
+
+
+def variantFor(photo, size, format=None, density=1):
+    '''Return the variant of photo matching size, format and density.
+
+    format None means the same format as the upload (anything but WebP).
+    '''
+    for variant in photo.variants:
+        if variant.size != size or variant.density != density:
+            continue
+        if (format is None and variant.format != 'webp') or \
+                variant.format == format:
+            return variant
+    return None
+
+
+
+########################################
+# JOBS
+########################################
+
+def queueVariants(session, photo, upload_folder, variant_folder):
+    '''Have the worker create the variants of a newly flushed photo'''
+    enqueue(session, 'generate_variants', photo_id=photo.id,
+            upload_folder=os.path.abspath(upload_folder),
+            variant_folder=os.path.abspath(variant_folder))
+
+
+def queueFileRemoval(session, uploads, variants, upload_folder,
+                     variant_folder):
+    '''Queue removal of upload and variant files, FILE_BATCH_SIZE per job'''
+    uploads = sorted(set(uploads))
+    variants = sorted(set(variants))
+    payloads = []
+    for start in range(0, max(len(uploads), len(variants)), FILE_BATCH_SIZE):
+        payloads.append({
+            'upload_folder': os.path.abspath(upload_folder),
+            'variant_folder': os.path.abspath(variant_folder),
+            'uploads': uploads[start:start + FILE_BATCH_SIZE],
+            'variants': variants[start:start + FILE_BATCH_SIZE]})
+    enqueueMany(session, 'delete_photo_files', payloads)
+
+
+def deletePhotos(session, photos, upload_folder, variant_folder):
+    '''Delete photos and their variants, queueing removal of their files'''
+    uploads = []
+    variants = []
+    for photo in photos:
+        uploads.append(photo.filename)
+        for variant in photo.variants:
+            variants.append(variant.filename)
+            session.delete(variant)
+        session.delete(photo)
+    queueFileRemoval(session, uploads, variants, upload_folder,
+                     variant_folder)
+
+
+@handles('generate_variants')
+def generateVariantsJob(session, photo_id, upload_folder, variant_folder):
+    photo = session.query(ProductPhoto).get(photo_id)
+    # Deleted since, or done by an earlier run of the job
+    if photo is None or photo.variants:
+        return
+    generateVariants(session, photo, upload_folder, variant_folder)
+
+
+def removeUnreferenced(session, folder, column, filenames):
+    '''Remove the files in folder that no row has in column'''
+    filenames = list(filenames)
+    for start in range(0, len(filenames), FILE_BATCH_SIZE):
+        batch = set(filenames[start:start + FILE_BATCH_SIZE])
+        # Identical uploads share a file; keep those still in use
+        batch.difference_update(row[0] for row in session.query(column)
+                                .filter(column.in_(batch)).distinct())
+        for filename in batch:
+            path = os.path.join(folder, filename)
+            if os.path.exists(path):
+                os.remove(path)
+
+
+@handles('delete_photo_files')
+def deletePhotoFilesJob(session, upload_folder, variant_folder, uploads=(),
+                        variants=()):
+    removeUnreferenced(session, upload_folder, ProductPhoto.filename,
+                       uploads)
+    removeUnreferenced(session, variant_folder, ProductPhotoVariant.filename,
+                       variants)
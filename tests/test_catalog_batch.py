@@ -0,0 +1,79 @@
+import json
+import os
+import unittest
+from application import createApp, getEngine, session
+from catalog_batch import MAX_BATCH_SIZE
+from database_setup import Category, Product, ProductPhoto, User
+from migrations import upgrade
+
+
+class BatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = createApp({'DATABASE_URL': 'sqlite://', 'TESTING': True,
+                              'ASSERT_STATEMENT_BUDGETS': True})
+        with open(os.devnull, 'w') as log:
+            upgrade(getEngine(self.app), log=log)
+        self.context = self.app.app_context()
+        self.context.push()
+        user = User(name='Owner', email='owner@example.com')
+        hats = Category(name='Hats', sku_code='HT', user=user)
+        shirts = Category(name='Shirts', sku_code='SH', user=user)
+        self.products = [Product(name='Hat {0}'.format(number),
+                                 sku='HT-{0}'.format(number), status=1,
+                                 category=hats, user=user)
+                         for number in range(1, 5)]
+        for placement in (2, 1):
+            self.products[0].photos.append(ProductPhoto(
+                filename='hat-{0}.png'.format(placement),
+                order_placement=placement))
+        session.add_all(self.products + [shirts])
+        session.commit()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        session.remove()
+        self.context.pop()
+
+    def getJSON(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200, url)
+        return json.loads(response.get_data(as_text=True))
+
+    def testProductsInRequestOrder(self):
+        ids = [product.id for product in self.products]
+        wanted = [ids[2], 999, ids[0], ids[2], ids[3]]
+        data = self.getJSON('/products/batch.json?ids={0}'.format(
+            ','.join(str(ident) for ident in wanted)))
+        self.assertEqual([product['id'] for product in data['Product']],
+                         [ids[2], ids[0], ids[3]])
+        self.assertEqual(data['missing'], [999])
+        self.assertEqual([photo['filename'] for photo in
+                          data['Product'][1]['photos']],
+                         ['hat-1.png', 'hat-2.png'])
+        self.assertEqual(data['Product'][0]['photos'], [])
+
+    def testProductsBySku(self):
+        data = self.getJSON('/products/batch.json?skus=HT-4,XX-1,HT-2')
+        self.assertEqual([product['sku'] for product in data['Product']],
+                         ['HT-4', 'HT-2'])
+        self.assertEqual(data['missing'], ['XX-1'])
+
+    def testCategoriesBySlug(self):
+        data = self.getJSON('/categories/batch.json?slugs=shirts,caps,hats')
+        self.assertEqual([category['name'] for category in data['Category']],
+                         ['Shirts', 'Hats'])
+        self.assertEqual(data['missing'], ['caps'])
+
+    def testBadRequests(self):
+        too_many = ','.join(str(ident) for ident in
+                            range(1, MAX_BATCH_SIZE + 2))
+        for url in ('/products/batch.json',
+                    '/products/batch.json?ids=1&skus=HT-1',
+                    '/products/batch.json?ids=1,x',
+                    '/categories/batch.json?ids=' + too_many):
+            self.assertEqual(self.client.get(url).status_code, 400, url)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import os
+import unittest
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+from catalog_delete import purgeCategory
+from catalog_version import trackCatalogWrites
+from database_setup import Category, Product, ProductPhoto, \
+    ProductPhotoVariant, SkuCounter, User
+from migrations import upgrade
+
+
+class PurgeCategoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        with open(os.devnull, 'w') as log:
+            upgrade(self.engine, log=log)
+        session_factory = sessionmaker(bind=self.engine)
+        trackCatalogWrites(session_factory)
+        self.session = session_factory()
+        self.user = User(name='Owner', email='owner@example.com')
+        self.statements = []
+
+        @event.listens_for(self.engine, 'before_cursor_execute')
+        def countStatement(conn, cursor, statement, parameters, context,
+                           executemany):
+            self.statements.append(statement)
+
+    def tearDown(self):
+        self.session.close()
+
+    def addCategory(self, sku_code, product_count):
+        category = Category(name=sku_code, slug=sku_code.lower(),
+                            sku_code=sku_code, user=self.user)
+        for number in range(1, product_count + 1):
+            sku = '{0}-{1}'.format(sku_code, number)
+            product = Product(name=sku, slug=sku.lower(), sku=sku,
+                              category=category, user=self.user)
+            photo = ProductPhoto(filename=sku + '.png', order_placement=1)
+            product.photos.append(photo)
+            photo.variants.append(ProductPhotoVariant(
+                size='thumb', density=1, format='webp',
+                filename=sku + '.webp'))
+            self.session.add(product)
+        self.session.add(category)
+        self.session.flush()
+        self.session.add(SkuCounter(category_id=category.id,
+                                    next_number=product_count + 1))
+        self.session.commit()
+        return category
+
+    def purgeStatements(self, category):
+        del self.statements[:]
+        purgeCategory(self.session, category, 'uploads', 'variants')
+        self.session.commit()
+        return len(self.statements)
+
+    def testStatementsDoNotGrowWithProducts(self):
+        kept = self.addCategory('KP', 2)
+        small = self.purgeStatements(self.addCategory('SM', 1))
+        large = self.purgeStatements(self.addCategory('LG', 40))
+        self.assertEqual(small, large)
+        self.assertEqual(self.session.query(Category.sku_code).all(),
+                         [('KP',)])
+        self.assertEqual(self.session.query(Product).count(), 2)
+        self.assertEqual(self.session.query(ProductPhoto).count(), 2)
+        self.assertEqual(self.session.query(ProductPhotoVariant).count(), 2)
+        self.assertEqual(self.session.query(SkuCounter.category_id).all(),
+                         [(kept.id,)])
+
+
+if __name__ == '__main__':
+    unittest.main()
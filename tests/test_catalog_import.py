@@ -0,0 +1,99 @@
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+import catalog_import
+from catalog_import import ImportFailed, Importer, importFile
+from catalog_version import trackCatalogWrites
+from database_setup import Category, ImportCheckpoint, Product, \
+    ProductPhoto, User
+from migrations import upgrade
+
+
+class ImportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        engine = create_engine('sqlite://')
+        with open(os.devnull, 'w') as log:
+            upgrade(engine, log=log)
+        session_factory = sessionmaker(bind=engine)
+        trackCatalogWrites(session_factory)
+        self.session = session_factory()
+        user = User(name='Owner', email='owner@example.com')
+        self.session.add(Category(name='Hats', slug='hats', sku_code='HT',
+                                  user=user))
+        self.session.commit()
+        self.importer = Importer(self.session, user.id)
+        self.progress = progress = catalog_import.Progress
+        self.log = log = open(os.devnull, 'w')
+        catalog_import.Progress = lambda name: progress(name, log)
+
+    def tearDown(self):
+        catalog_import.Progress = self.progress
+        self.log.close()
+        self.session.close()
+        shutil.rmtree(self.directory)
+
+    def writeRecords(self, name, records):
+        path = os.path.join(self.directory, name)
+        with io.open(path, 'w', encoding='utf-8') as f:
+            for record in records:
+                f.write(u'{0}\n'.format(json.dumps(record)))
+        return path
+
+    def testRerunResumesAfterLastBatch(self):
+        records = [{'name': 'Hat {0}'.format(number), 'category': 'HT',
+                    'price': '5.00', 'status': 1}
+                   for number in range(10)]
+        records[7]['category'] = 'XX'
+        path = self.writeRecords('products.jsonl', records)
+        with self.assertRaises(ImportFailed):
+            importFile(self.session, self.importer.importProducts, path,
+                       batch_size=3)
+        self.session.rollback()
+        self.assertEqual(self.session.query(Product).count(), 6)
+        self.assertEqual(self.session.query(ImportCheckpoint.position)
+                         .scalar(), 6)
+
+        records[7]['category'] = 'HT'
+        self.writeRecords('products.jsonl', records)
+        importFile(self.session, self.importer.importProducts, path,
+                   batch_size=3)
+        products = self.session.query(Product.name, Product.sku) \
+            .order_by(Product.id).all()
+        self.assertEqual([product.name for product in products],
+                         [record['name'] for record in records])
+        self.assertEqual(sorted(product.sku for product in products),
+                         sorted('HT-{0}'.format(number)
+                                for number in range(1, 11)))
+
+    def testInvalidValuesNameTheRecord(self):
+        products = self.writeRecords('products.jsonl', [
+            {'name': 'Hat', 'category': 'HT', 'sku': 'HT-1',
+             'status': 'active'}])
+        with self.assertRaises(ImportFailed) as failure:
+            importFile(self.session, self.importer.importProducts,
+                       products)
+        self.assertIn("'active' for product Hat", str(failure.exception))
+        self.session.rollback()
+        self.writeRecords('products.jsonl', [
+            {'name': 'Hat', 'category': 'HT', 'sku': 'HT-1'}])
+        importFile(self.session, self.importer.importProducts, products)
+        photos = self.writeRecords('photos.jsonl', [
+            {'product': 'HT-1', 'filename': 'hat.png',
+             'order_placement': 'first'}])
+        with self.assertRaises(ImportFailed) as failure:
+            importFile(self.session, self.importer.importPhotos, photos)
+        self.assertIn("'first' for photo hat.png of product HT-1",
+                      str(failure.exception))
+        self.session.rollback()
+        self.assertEqual(self.session.query(ProductPhoto).count(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
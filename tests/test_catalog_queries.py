@@ -0,0 +1,100 @@
+import decimal
+import os
+import re
+import unittest
+from application import createApp, getEngine, session
+from catalog_queries import allProducts, decodeCursor, encodeCursor, \
+    keysetPage, latestProducts, PRICE_ORDER
+from database_setup import Category, Product, User
+from migrations import upgrade
+
+NEXT_LINK = re.compile(r'href="([^"]*)">(?:Next page|More inactive items)<')
+
+
+class KeysetPagingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = createApp({'DATABASE_URL': 'sqlite://', 'TESTING': True})
+        with open(os.devnull, 'w') as log:
+            upgrade(getEngine(self.app), log=log)
+        self.context = self.app.app_context()
+        self.context.push()
+        user = User(name='Owner', email='owner@example.com')
+        for name in ('Hats', 'Shirts'):
+            category = Category(name=name, sku_code=name[:2].upper(),
+                                user=user)
+            # Repeated names and prices, so pages split between ties
+            for number in range(7):
+                session.add(Product(
+                    name='{0} {1}'.format(name, number // 2),
+                    sku='{0}-{1}'.format(category.sku_code, number + 1),
+                    price=decimal.Decimal(number % 3) + 1, status=1,
+                    category=category, user=user))
+        session.commit()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        session.remove()
+        self.context.pop()
+
+    def allPages(self, page):
+        '''Ids of every product, reading page(cursor) until the last'''
+        ids = []
+        products, cursor = page(None)
+        while True:
+            self.assertTrue(products)
+            ids.extend(product.id for product in products)
+            if cursor is None:
+                return ids
+            products, cursor = page(cursor)
+
+    def testCursorRoundTrip(self):
+        values = [3, u'Grey Crest', decimal.Decimal('9.99'), None]
+        cursor = encodeCursor(values)
+        self.assertEqual(decodeCursor(cursor, values),
+                         [3, u'Grey Crest', '9.99', None])
+        self.assertRaises(ValueError, decodeCursor, cursor, values[:2])
+        self.assertRaises(ValueError, decodeCursor, 'not a cursor', values)
+
+    def testPagesCoverEveryProductOnce(self):
+        expected = [product.id for product in session.query(Product)
+                    .order_by(Product.category_id, Product.name,
+                              Product.id)]
+        self.assertEqual(self.allPages(
+            lambda cursor: allProducts(session, cursor, 3)), expected)
+        self.assertEqual(self.allPages(
+            lambda cursor: latestProducts(session, cursor, 4)),
+            sorted(expected, reverse=True))
+        by_price = [product.id for product in session.query(Product)
+                    .order_by(Product.price.desc(), Product.id.desc())]
+        self.assertEqual(self.allPages(lambda cursor: keysetPage(
+            session.query(Product), PRICE_ORDER, cursor, 2, True)),
+            by_price)
+
+    def followNextLinks(self, url):
+        '''Return the URLs of every page reached from url'''
+        urls = [url]
+        while True:
+            html = self.client.get(urls[-1]).get_data(as_text=True)
+            links = NEXT_LINK.findall(html)
+            if not links:
+                return urls
+            urls.append(links[0].replace('&amp;', '&'))
+
+    def testNextLinksKeepLimitAndViewArguments(self):
+        urls = self.followNextLinks('/catalog/all?limit=5')
+        self.assertEqual(len(urls), 3)
+        for url in urls[1:]:
+            self.assertTrue(url.startswith('/catalog/all?'), url)
+            self.assertIn('limit=5', url)
+        urls = self.followNextLinks(
+            '/catalog/shirts/items?limit=2&min_price=2')
+        # Four of the seven shirts cost 2 or more
+        self.assertEqual(len(urls), 2)
+        self.assertTrue(urls[1].startswith('/catalog/shirts/items?'))
+        self.assertIn('limit=2', urls[1])
+        self.assertIn('min_price=2', urls[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
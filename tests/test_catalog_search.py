@@ -0,0 +1,68 @@
+import os
+import shutil
+import tempfile
+import unittest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+import catalog_search
+from application import createApp, getEngine, session
+from catalog_cache import getCache
+from catalog_version import CATALOG_VERSION_KEY, trackCatalogWrites
+from database_setup import Category, Product, User
+from migrations import upgrade
+
+
+class SearchIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        # A file, so another engine can stand in for another process
+        self.directory = tempfile.mkdtemp()
+        self.url = 'sqlite:///' + os.path.join(self.directory, 'store.db')
+        self.app = createApp({'DATABASE_URL': self.url, 'TESTING': True})
+        with open(os.devnull, 'w') as log:
+            upgrade(getEngine(self.app), log=log)
+        self.context = self.app.app_context()
+        self.context.push()
+        user = User(name='Owner', email='owner@example.com')
+        category = Category(name='Hats', sku_code='HT', user=user)
+        session.add(Product(name='Grey Crest', sku='HT-1', status=1,
+                            category=category, user=user))
+        session.commit()
+        self.user_id = user.id
+        self.category_id = category.id
+
+    def tearDown(self):
+        session.remove()
+        self.context.pop()
+        getEngine(self.app).dispose()
+        shutil.rmtree(self.directory)
+
+    def search(self, text):
+        return [product.name for product in
+                catalog_search.searchProducts(session, text)]
+
+    def testCommitsAreSearchable(self):
+        self.assertEqual(self.search('crest'), ['Grey Crest'])
+        session.add(Product(name='Red Crest', sku='HT-2', status=1,
+                            category_id=self.category_id,
+                            user_id=self.user_id))
+        session.commit()
+        self.assertEqual(self.search('crest'), ['Red Crest', 'Grey Crest'])
+
+    def testWritesFromOtherProcessesAreSearchable(self):
+        self.assertEqual(self.search('crest'), ['Grey Crest'])
+        other_factory = sessionmaker(bind=create_engine(self.url))
+        trackCatalogWrites(other_factory)
+        other = other_factory()
+        other.add(Product(name='Blue Crest', sku='HT-3', status=1,
+                          category_id=self.category_id,
+                          user_id=self.user_id))
+        other.commit()
+        other.close()
+        # As if the cached version had expired
+        getCache(session).delete(CATALOG_VERSION_KEY)
+        self.assertEqual(self.search('crest'), ['Blue Crest', 'Grey Crest'])
+
+
+if __name__ == '__main__':
+    unittest.main()
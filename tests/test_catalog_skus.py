@@ -0,0 +1,64 @@
+import os
+import unittest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from catalog_skus import claimSku, reserveNumbers, reserveSkus, skuNumber
+from database_setup import Category, Product, User
+from migrations import upgrade
+
+
+class SkuAllocationTest(unittest.TestCase):
+
+    def setUp(self):
+        engine = create_engine('sqlite://')
+        with open(os.devnull, 'w') as log:
+            upgrade(engine, log=log)
+        self.session = sessionmaker(bind=engine)()
+        self.user = User(name='Owner', email='owner@example.com')
+        self.category = Category(name='Hats', slug='hats', sku_code='HT',
+                                 user=self.user)
+        self.session.add(self.category)
+        self.session.commit()
+
+    def tearDown(self):
+        self.session.close()
+
+    def addProducts(self, *skus):
+        self.session.add_all([
+            Product(name=sku, slug=sku.lower(), sku=sku,
+                    category=self.category, user=self.user)
+            for sku in skus])
+        self.session.commit()
+
+    def testNumbersAreComparedAsNumbers(self):
+        self.assertEqual(skuNumber('HT-10'), 10)
+        self.assertEqual(skuNumber('HT'), None)
+        self.addProducts(*['HT-{0}'.format(number)
+                           for number in range(1, 10)])
+        # As strings, HT-9 sorts after HT-10 and would be handed out again
+        self.assertEqual(reserveSkus(self.session, self.category),
+                         ['HT-10'])
+        self.assertEqual(reserveSkus(self.session, self.category),
+                         ['HT-11'])
+
+    def testReservingABlock(self):
+        self.addProducts('HT-1')
+        first = reserveNumbers(self.session, self.category.id, count=5)
+        self.assertEqual(first, 2)
+        self.assertEqual(reserveSkus(self.session, self.category, 2),
+                         ['HT-7', 'HT-8'])
+
+    def testClaimedSkusAreNotHandedOut(self):
+        self.assertEqual(reserveSkus(self.session, self.category),
+                         ['HT-1'])
+        claimSku(self.session, self.category, 'HT-41')
+        self.assertEqual(reserveSkus(self.session, self.category),
+                         ['HT-42'])
+        # Claiming a number already handed out leaves the counter alone
+        claimSku(self.session, self.category, 'HT-3')
+        self.assertEqual(reserveSkus(self.session, self.category),
+                         ['HT-43'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import json
+import os
+import unittest
+import catalog_snapshot
+from application import createApp, getEngine, session
+from catalog_cache import getCache
+from database_setup import Category, Product, User
+from migrations import upgrade
+
+
+class SnapshotInvalidationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = createApp({'DATABASE_URL': 'sqlite://', 'TESTING': True})
+        with open(os.devnull, 'w') as log:
+            upgrade(getEngine(self.app), log=log)
+        self.context = self.app.app_context()
+        self.context.push()
+        user = User(name='Owner', email='owner@example.com')
+        self.categories = [Category(name=name, sku_code=name[:2].upper(),
+                                    user=user)
+                           for name in ('Hats', 'Shirts', 'Stickers')]
+        session.add_all(self.categories)
+        session.commit()
+        self.user_id = user.id
+        # Build and cache every category of the snapshot
+        catalog_snapshot.catalogDocument(session)
+        self.rebuilt = []
+        self.categoryRows = catalog_snapshot.categoryRows
+
+        def recordingCategoryRows(session, category_ids=None):
+            self.rebuilt.append(category_ids)
+            return self.categoryRows(session, category_ids)
+        catalog_snapshot.categoryRows = recordingCategoryRows
+
+    def tearDown(self):
+        catalog_snapshot.categoryRows = self.categoryRows
+        session.remove()
+        self.context.pop()
+
+    def testInsertInvalidatesOnlyItsCategory(self):
+        category = self.categories[1]
+        cache = getCache(session)
+        generation = cache.get(catalog_snapshot.GENERATION_KEY)
+        session.add(Product(name='Tee', sku='SH-1', status=1,
+                            category_id=category.id, user_id=self.user_id))
+        session.commit()
+        self.assertEqual(cache.get(catalog_snapshot.GENERATION_KEY),
+                         generation)
+        for other in self.categories:
+            cached = cache.get(catalog_snapshot.categoryKey(generation,
+                                                            other.id))
+            self.assertEqual(cached is None, other.id == category.id)
+        document = json.loads(catalog_snapshot.catalogDocument(session))
+        self.assertEqual(self.rebuilt, [[category.id]])
+        self.assertEqual([[product['name'] for product in item['products']]
+                          for item in document['Category']],
+                         [[], ['Tee'], []])
+
+
+if __name__ == '__main__':
+    unittest.main()
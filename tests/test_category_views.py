@@ -0,0 +1,44 @@
+import os
+import unittest
+from application import createApp, getEngine, session
+from database_setup import Category, User
+from migrations import upgrade
+
+
+class EditCategoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = createApp({'DATABASE_URL': 'sqlite://', 'TESTING': True,
+                              'SECRET_KEY': 'test'})
+        with open(os.devnull, 'w') as log:
+            upgrade(getEngine(self.app), log=log)
+        self.context = self.app.app_context()
+        self.context.push()
+        user = User(name='Owner', email='owner@example.com')
+        session.add(Category(name='Hats', sku_code='HT', user=user))
+        session.commit()
+        self.client = self.app.test_client()
+        with self.client.session_transaction() as login_session:
+            login_session['username'] = user.name
+            login_session['user_id'] = user.id
+        session.remove()
+
+    def tearDown(self):
+        session.remove()
+        self.context.pop()
+
+    def testEditRenamesTheCategory(self):
+        response = self.client.post('/category/hats/edit',
+                                    data={'name': 'Caps', 'sku_code': 'CP'})
+        self.assertEqual(response.status_code, 302)
+        categories = session.query(Category.name, Category.slug,
+                                   Category.sku_code).all()
+        self.assertEqual(categories, [('Caps', 'caps', 'CP')])
+        self.assertEqual(self.client.get('/catalog/caps/items').status_code,
+                         200)
+        self.assertEqual(self.client.get('/catalog/hats/items').status_code,
+                         404)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import os
+import unittest
+import catalog_formats
+from application import createApp, getEngine, session
+from database_setup import Category, User
+from migrations import upgrade
+
+
+class ConditionalResponseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = createApp({'DATABASE_URL': 'sqlite://', 'TESTING': True})
+        with open(os.devnull, 'w') as log:
+            upgrade(getEngine(self.app), log=log)
+        self.context = self.app.app_context()
+        self.context.push()
+        self.user = User(name='Owner', email='owner@example.com')
+        session.add(Category(name='Hats', sku_code='HT', user=self.user))
+        session.commit()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        session.remove()
+        self.context.pop()
+
+    def testIfNoneMatch(self):
+        response = self.client.get('/catalog.json')
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers['ETag']
+        response = self.client.get('/catalog.json',
+                                   headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.get_data(), b'')
+        self.assertEqual(response.headers['ETag'], etag)
+
+        session.add(Category(name='Shirts', sku_code='SH', user=self.user))
+        session.commit()
+        response = self.client.get('/catalog.json',
+                                   headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        self.assertIn(b'Shirts', response.get_data())
+
+    def testIfModifiedSince(self):
+        response = self.client.get('/categories.json')
+        self.assertEqual(response.status_code, 200)
+        modified = response.headers['Last-Modified']
+        response = self.client.get('/categories.json',
+                                   headers={'If-Modified-Since': modified})
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get('/categories.json', headers={
+            'If-Modified-Since': 'Mon, 01 Jan 2001 00:00:00 GMT'})
+        self.assertEqual(response.status_code, 200)
+
+    @unittest.skipIf(catalog_formats.msgpack is None,
+                     'msgpack is not installed')
+    def testFormatsHaveTheirOwnETag(self):
+        etag = self.client.get('/catalog.json').headers['ETag']
+        response = self.client.get('/catalog.json', headers={
+            'If-None-Match': etag, 'Accept': catalog_formats.MSGPACK})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+
+if __name__ == '__main__':
+    unittest.main()
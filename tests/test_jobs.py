@@ -0,0 +1,109 @@
+import datetime
+import os
+import unittest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+import jobs
+from database_setup import Job
+from migrations import upgrade
+
+
+class WorkerTest(unittest.TestCase):
+
+    def setUp(self):
+        engine = create_engine('sqlite://')
+        with open(os.devnull, 'w') as log:
+            upgrade(engine, log=log)
+        self.session_factory = sessionmaker(bind=engine)
+        self.session = self.session_factory()
+        self.runs = []
+
+        def record(session, **payload):
+            self.runs.append(payload)
+
+        def fail(session, **payload):
+            raise ValueError('Broken job')
+        self.handlers = dict(jobs.handlers)
+        jobs.handlers.update({'test.record': record, 'test.fail': fail})
+        # Failures are expected here; keep their tracebacks out of the output
+        jobs.log.disabled = True
+
+    def tearDown(self):
+        jobs.log.disabled = False
+        jobs.handlers.clear()
+        jobs.handlers.update(self.handlers)
+        self.session.close()
+
+    def enqueue(self, kind, **payload):
+        job = jobs.enqueue(self.session, kind, **payload)
+        self.session.commit()
+        return job.id
+
+    def job(self, job_id):
+        self.session.expire_all()
+        return self.session.query(Job).get(job_id)
+
+    def makeDue(self, job_id, **values):
+        '''Move the run time (and any other values) of a job to the past'''
+        values.setdefault('run_at', datetime.datetime.utcnow() -
+                          datetime.timedelta(seconds=1))
+        self.session.query(Job).filter_by(id=job_id).update(values)
+        self.session.commit()
+
+    def testFailedJobsBackOffAndGiveUp(self):
+        job_id = self.enqueue('test.fail')
+        for attempt in range(1, jobs.MAX_ATTEMPTS + 1):
+            started = datetime.datetime.utcnow()
+            jobs.work(self.session_factory, once=True)
+            job = self.job(job_id)
+            self.assertEqual(job.attempts, attempt)
+            self.assertIsNone(job.locked_until)
+            self.assertIn('Broken job', job.last_error)
+            if attempt < jobs.MAX_ATTEMPTS:
+                self.assertIsNone(job.failed_at)
+                delay = jobs.RETRY_DELAY * 2 ** (attempt - 1)
+                self.assertTrue(
+                    started + datetime.timedelta(seconds=delay) <=
+                    job.run_at <=
+                    datetime.datetime.utcnow() +
+                    datetime.timedelta(seconds=delay))
+                # Not due again until the delay has passed
+                jobs.work(self.session_factory, once=True)
+                self.assertEqual(self.job(job_id).attempts, attempt)
+                self.makeDue(job_id)
+        self.assertIsNotNone(job.failed_at)
+        self.makeDue(job_id)
+        jobs.work(self.session_factory, once=True)
+        self.assertEqual(self.job(job_id).attempts, jobs.MAX_ATTEMPTS)
+
+        self.assertEqual(jobs.retryFailed(self.session), 1)
+        job = self.job(job_id)
+        self.assertEqual((job.attempts, job.failed_at), (0, None))
+
+    def testExpiredLeaseIsReclaimed(self):
+        job_id = self.enqueue('test.record', photo_id=7)
+        # A worker claims the job and dies before running it
+        self.assertEqual([job.id for job in jobs.claimJobs(self.session)],
+                         [job_id])
+        jobs.work(self.session_factory, once=True)
+        self.assertEqual(self.runs, [])
+        self.makeDue(job_id, locked_until=datetime.datetime.utcnow() -
+                     datetime.timedelta(seconds=1))
+        jobs.work(self.session_factory, once=True)
+        self.assertEqual(self.runs, [{'photo_id': 7}])
+        self.assertIsNone(self.job(job_id))
+
+    def testJobsWhoseLeaseKeepsExpiringGiveUp(self):
+        job_id = self.enqueue('test.record')
+        self.makeDue(job_id, attempts=jobs.MAX_ATTEMPTS,
+                     locked_until=datetime.datetime.utcnow() -
+                     datetime.timedelta(seconds=1))
+        jobs.work(self.session_factory, once=True)
+        self.assertEqual(self.runs, [])
+        job = self.job(job_id)
+        self.assertIsNotNone(job.failed_at)
+        self.assertIn('lease expired', job.last_error)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import os
+import unittest
+import application
+from application import createApp, getEngine, session
+from database_setup import Category, Product, ProductPhoto, \
+    ProductPhotoVariant, User
+from migrations import upgrade
+
+
+class StatementBudgetTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = createApp({'DATABASE_URL': 'sqlite://', 'TESTING': True,
+                              'ASSERT_STATEMENT_BUDGETS': True})
+        with open(os.devnull, 'w') as log:
+            upgrade(getEngine(self.app), log=log)
+        self.context = self.app.app_context()
+        self.context.push()
+        user = User(name='Owner', email='owner@example.com')
+        # Enough rows that a query per category, product or photo would
+        # go over every budget
+        for name in ('Hats', 'Shirts', 'Stickers'):
+            category = Category(name=name, sku_code=name[:2].upper(),
+                                user=user)
+            for number in range(1, 6):
+                product = Product(
+                    name='{0} {1}'.format(name, number), status=number % 2,
+                    sku='{0}-{1}'.format(category.sku_code, number),
+                    price='9.99', category=category, user=user)
+                for placement in (1, 2):
+                    photo = ProductPhoto(
+                        filename='{0}-{1}.png'.format(product.sku, placement),
+                        order_placement=placement)
+                    product.photos.append(photo)
+                    photo.variants.append(ProductPhotoVariant(
+                        size='thumb', density=1, format='webp',
+                        filename='{0}-{1}.webp'.format(product.sku,
+                                                       placement)))
+                session.add(product)
+        session.commit()
+        session.remove()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        session.remove()
+        self.context.pop()
+
+    def assertWithinBudget(self, url):
+        # Twice: with cold caches and then with whatever they hold
+        for attempt in range(2):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200, url)
+
+    def testShowCatalog(self):
+        self.assertWithinBudget('/catalog')
+
+    def testShowCatalogAll(self):
+        self.assertWithinBudget('/catalog/all')
+        self.assertWithinBudget('/catalog/all?limit=2')
+
+    def testShowCategory(self):
+        self.assertWithinBudget('/catalog/shirts/items')
+        self.assertWithinBudget('/catalog/shirts/items?limit=2&sort=-price')
+
+    def testCatalogJSON(self):
+        self.assertWithinBudget('/catalog.json')
+
+    def testGoingOverBudgetFails(self):
+        budgets = application.STATEMENT_BUDGETS
+        budget = budgets['showCatalogAll']
+        budgets['showCatalogAll'] = 0
+        try:
+            self.assertRaises(AssertionError, self.client.get,
+                              '/catalog/all')
+        finally:
+            budgets['showCatalogAll'] = budget
+
+
+if __name__ == '__main__':
+    unittest.main()
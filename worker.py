@@ -0,0 +1,47 @@
+'''Run queued background jobs, see jobs.py.
+
+    python worker.py                 run jobs as they come until interrupted
+    python worker.py --once          run the jobs that are due, then exit
+    python worker.py --retry-failed  queue the jobs that gave up again
+
+Start one or more workers next to the web server. They connect with the same
+DATABASE_URL and pool settings, and must run from the same directory (or
+share the upload folder) as the app.
+'''
+import argparse
+import logging
+from sqlalchemy.orm import sessionmaker
+from database import createEngine
+from catalog_version import trackCatalogWrites
+from jobs import work, retryFailed, BATCH_SIZE, POLL_INTERVAL
+# Imported for the job handlers they register
+import photo_variants  # noqa: F401
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run background jobs')
+    parser.add_argument('--once', action='store_true',
+                        help='exit when no job is due')
+    parser.add_argument('--retry-failed', action='store_true',
+                        help='queue failed jobs again and exit')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--poll-interval', type=float, default=POLL_INTERVAL)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s')
+
+    session_factory = sessionmaker(bind=createEngine())
+    trackCatalogWrites(session_factory)
+    if args.retry_failed:
+        logging.info('Queued %d failed jobs again',
+                     retryFailed(session_factory()))
+        return
+    try:
+        work(session_factory, once=args.once, batch_size=args.batch_size,
+             poll_interval=args.poll_interval)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
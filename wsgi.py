@@ -0,0 +1,16 @@
+'''WSGI entry point for running the catalog under a production server.
+
+    gunicorn -c gunicorn.conf.py wsgi:application
+
+SECRET_KEY must be set in the environment so that every worker process
+signs login sessions with the same key.
+'''
+import logging
+import os
+from application import createApp
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s %(levelname)s %(name)s %(message)s')
+
+application = createApp()
+application.secret_key = os.environ['SECRET_KEY']